@@ -2,6 +2,8 @@ import setup_path
 import airsim
 
 import os
+import cntk_instrumentation
+from cntk_replay_memory import ReplayMemory
 import traceback
 import math
 import time
@@ -21,123 +23,6 @@ from cntk.train import Trainer
 
 import pickle
 
-class ReplayMemory(object):
-    """
-    ReplayMemory keeps track of the environment dynamic.
-    We store all the transitions (s(t), action, s(t+1), reward, done).
-    The replay memory allows us to efficiently sample minibatches from it, and generate the correct state representation
-    (w.r.t the number of previous frames needed).
-    """
-    def __init__(self, size, sample_shape, history_length=4):
-        self._pos = 0
-        self._count = 0
-        self._max_size = size
-        self._history_length = max(1, history_length)
-        self._state_shape = sample_shape
-        self._states = np.zeros((size,) + sample_shape, dtype=np.float32)
-        self._actions = np.zeros(size, dtype=np.uint8)
-        self._rewards = np.zeros(size, dtype=np.float32)
-        self._terminals = np.zeros(size, dtype=np.float32)
-
-    def __len__(self):
-        """ Returns the number of items currently present in the memory
-        Returns: Int >= 0
-        """
-        return self._count
-
-    def append(self, state, action, reward, done):
-        """ Appends the specified transition to the memory.
-
-        Attributes:
-            state (Tensor[sample_shape]): The state to append
-            action (int): An integer representing the action done
-            reward (float): An integer representing the reward received for doing this action
-            done (bool): A boolean specifying if this state is a terminal (episode has finished)
-        """
-        assert state.shape == self._state_shape, \
-            'Invalid state shape (required: %s, got: %s)' % (self._state_shape, state.shape)
-
-        self._states[self._pos] = state
-        self._actions[self._pos] = action
-        self._rewards[self._pos] = reward
-        self._terminals[self._pos] = done
-
-        self._count = max(self._count, self._pos + 1)
-        self._pos = (self._pos + 1) % self._max_size
-
-    def sample(self, size):
-        """ Generate size random integers mapping indices in the memory.
-            The returned indices can be retrieved using #get_state().
-            See the method #minibatch() if you want to retrieve samples directly.
-
-        Attributes:
-            size (int): The minibatch size
-
-        Returns:
-             Indexes of the sampled states ([int])
-        """
-
-        # Local variable access is faster in loops
-        count, pos, history_len, terminals = self._count - 1, self._pos, \
-                                             self._history_length, self._terminals
-        indexes = []
-
-        while len(indexes) < size:
-            index = np.random.randint(history_len, count)
-
-            if index not in indexes:
-
-                # if not wrapping over current pointer,
-                # then check if there is terminal state wrapped inside
-                if not (index >= pos > index - history_len):
-                    if not terminals[(index - history_len):index].any():
-                        indexes.append(index)
-
-        return indexes
-
-    def minibatch(self, size):
-        """ Generate a minibatch with the number of samples specified by the size parameter.
-
-        Attributes:
-            size (int): Minibatch size
-
-        Returns:
-            tuple: Tensor[minibatch_size, input_shape...], [int], [float], [bool]
-        """
-        indexes = self.sample(size)
-
-        pre_states = np.array([self.get_state(index) for index in indexes], dtype=np.float32)
-        post_states = np.array([self.get_state(index + 1) for index in indexes], dtype=np.float32)
-        actions = self._actions[indexes]
-        rewards = self._rewards[indexes]
-        dones = self._terminals[indexes]
-
-        return pre_states, actions, post_states, rewards, dones
-
-    def get_state(self, index):
-        """
-        Return the specified state with the replay memory. A state consists of
-        the last `history_length` perceptions.
-
-        Attributes:
-            index (int): State's index
-
-        Returns:
-            State at specified index (Tensor[history_length, input_shape...])
-        """
-        if self._count == 0:
-            raise IndexError('Empty Memory')
-
-        index %= self._count
-        history_length = self._history_length
-
-        # If index > history_length, take from a slice
-        if index >= history_length:
-            return self._states[(index - (history_length - 1)):index + 1, ...]
-        else:
-            indexes = np.arange(index - history_length + 1, index + 1)
-            return self._states.take(indexes, mode='wrap', axis=0)
-
 class History(object):
     """
     Accumulator keeping track of the N previous frames to be used by the agent
@@ -279,6 +164,7 @@ class DeepQAgent(object):
         self._memory = ReplayMemory(memory_size, input_shape[1:], 4)
         self._num_actions_taken = 0
         self._num_trains = 0
+        self._instrumentation = cntk_instrumentation.default_instrumentation()
 
         # Metrics accumulator
         self._episode_rewards, self._episode_q_means, self._episode_q_stddev = [], [], []
@@ -361,13 +247,15 @@ class DeepQAgent(object):
         # If policy requires agent to explore, sample random action
         if self._explorer.is_exploring(self._num_actions_taken):
             action = self._explorer(self.nb_actions)
+            self._instrumentation.count('random_actions')
         else:
             # Use the network to output the best action
             env_with_history = self._history.value
-            q_values = self._action_value_net.eval(
-                # Append batch axis with only one sample to evaluate
-                env_with_history.reshape((1,) + env_with_history.shape)
-            )
+            with self._instrumentation.timer('act_eval_seconds'):
+                q_values = self._action_value_net.eval(
+                    # Append batch axis with only one sample to evaluate
+                    env_with_history.reshape((1,) + env_with_history.shape)
+                )
 
             self._episode_q_means.append(np.mean(q_values))
             self._episode_q_stddev.append(np.std(q_values))
@@ -377,6 +265,7 @@ class DeepQAgent(object):
 
         # Keep track of interval action counter
         self._num_actions_taken += 1
+        self._instrumentation.count('actions')
         #print(self._num_actions_taken)
         return action
 
@@ -400,9 +289,12 @@ class DeepQAgent(object):
 
             # Reset the short term memory
             self._history.reset()
+            self._instrumentation.count('episodes')
 
         # Append to long term memory
-        self._memory.append(old_state, action, reward, done)
+        with self._instrumentation.timer('replay_append_seconds'):
+            self._memory.append(old_state, action, reward, done)
+        self._instrumentation.count('transitions')
 
     def train(self):
         """ This allows the agent to train itself to better understand the environment dynamics.
@@ -421,23 +313,28 @@ class DeepQAgent(object):
             #if (agent_step % self._train_interval) == 0:
             print('\nTraining minibatch\n')
             client.setCarControls(zero_controls)
-            pre_states, actions, post_states, rewards, terminals = self._memory.minibatch(self._minibatch_size)
-            self._trainer.train_minibatch(
-                self._trainer.loss_function.argument_map(
-                    pre_states=pre_states,
-                    actions=Value.one_hot(actions.reshape(-1, 1).tolist(), self.nb_actions),
-                    post_states=post_states,
-                    rewards=rewards,
-                    terminals=terminals
+            with self._instrumentation.timer('minibatch_seconds'):
+                pre_states, actions, post_states, rewards, terminals = self._memory.minibatch(self._minibatch_size)
+            with self._instrumentation.timer('train_minibatch_seconds'):
+                self._trainer.train_minibatch(
+                    self._trainer.loss_function.argument_map(
+                        pre_states=pre_states,
+                        actions=Value.one_hot(actions.reshape(-1, 1).tolist(), self.nb_actions),
+                        post_states=post_states,
+                        rewards=rewards,
+                        terminals=terminals
+                    )
                 )
-            )
+            self._instrumentation.count('minibatches')
             self._num_trains += 1
             # Update the Target Network if needed
             if self._num_trains % 20 == 0:
                 print('updating network')
-                self._target_net = self._action_value_net.clone(CloneMethod.freeze)
+                with self._instrumentation.timer('target_sync_seconds'):
+                    self._target_net = self._action_value_net.clone(CloneMethod.freeze)
                 filename = dirname+"\model%d" % agent_step
-                self._trainer.save_checkpoint(filename)
+                with self._instrumentation.timer('checkpoint_seconds'):
+                    self._trainer.save_checkpoint(filename)
     
     def _plot_metrics(self):
         """Plot current buffers accumulated values to visualize agent learning
@@ -553,6 +450,8 @@ SizeState = 7
 #SizeCols = 84
 NumActions = 5
 agent = DeepQAgent((NumBufferFrames, SizeState), NumActions, monitor=True)
+# Set DQN_METRICS_CSV to export the agent's timers and counters to a CSV file
+cntk_instrumentation.configure(os.environ.get('DQN_METRICS_CSV'))
 
 # Train
 epoch = 100
@@ -7,6 +7,10 @@ from argparse import ArgumentParser
 import os
 import cv2
 import sys
+import threading
+import traceback
+import cntk_instrumentation
+from cntk_replay_memory import ReplayMemory, PrioritizedReplayMemory
 
 
 #import gym #pip install gym
@@ -17,129 +21,12 @@ from cntk.layers import Sequential, Convolution2D, Dense, default_options
 from cntk.layers.typing import Signature, Tensor
 from cntk.learners import adam, learning_rate_schedule, momentum_schedule, UnitType
 from cntk.logging import TensorBoardProgressWriter
-from cntk.ops import abs, argmax, element_select, less, relu, reduce_max, reduce_sum, square
+from cntk.ops import abs, argmax, constant, element_select, less, parameter, relu, reduce_max, reduce_sum, square
 from cntk.ops.functions import CloneMethod, Function
 from cntk.train import Trainer
 
 import pickle
 
-class ReplayMemory(object):
-    """
-    ReplayMemory keeps track of the environment dynamic.
-    We store all the transitions (s(t), action, s(t+1), reward, done).
-    The replay memory allows us to efficiently sample minibatches from it, and generate the correct state representation
-    (w.r.t the number of previous frames needed).
-    """
-    def __init__(self, size, sample_shape, history_length=4):
-        self._pos = 0
-        self._count = 0
-        self._max_size = size
-        self._history_length = max(1, history_length)
-        self._state_shape = sample_shape
-        self._states = np.zeros((size,) + sample_shape, dtype=np.float32)
-        self._actions = np.zeros(size, dtype=np.uint8)
-        self._rewards = np.zeros(size, dtype=np.float32)
-        self._terminals = np.zeros(size, dtype=np.float32)
-
-    def __len__(self):
-        """ Returns the number of items currently present in the memory
-        Returns: Int >= 0
-        """
-        return self._count
-
-    def append(self, state, action, reward, done):
-        """ Appends the specified transition to the memory.
-
-        Attributes:
-            state (Tensor[sample_shape]): The state to append
-            action (int): An integer representing the action done
-            reward (float): An integer representing the reward received for doing this action
-            done (bool): A boolean specifying if this state is a terminal (episode has finished)
-        """
-        assert state.shape == self._state_shape, \
-            'Invalid state shape (required: %s, got: %s)' % (self._state_shape, state.shape)
-
-        self._states[self._pos] = state
-        self._actions[self._pos] = action
-        self._rewards[self._pos] = reward
-        self._terminals[self._pos] = done
-
-        self._count = max(self._count, self._pos + 1)
-        self._pos = (self._pos + 1) % self._max_size
-
-    def sample(self, size):
-        """ Generate size random integers mapping indices in the memory.
-            The returned indices can be retrieved using #get_state().
-            See the method #minibatch() if you want to retrieve samples directly.
-
-        Attributes:
-            size (int): The minibatch size
-
-        Returns:
-             Indexes of the sampled states ([int])
-        """
-
-        # Local variable access is faster in loops
-        count, pos, history_len, terminals = self._count - 1, self._pos, \
-                                             self._history_length, self._terminals
-        indexes = []
-
-        while len(indexes) < size:
-            index = np.random.randint(history_len, count)
-
-            if index not in indexes:
-
-                # if not wrapping over current pointer,
-                # then check if there is terminal state wrapped inside
-                if not (index >= pos > index - history_len):
-                    if not terminals[(index - history_len):index].any():
-                        indexes.append(index)
-
-        return indexes
-
-    def minibatch(self, size):
-        """ Generate a minibatch with the number of samples specified by the size parameter.
-
-        Attributes:
-            size (int): Minibatch size
-
-        Returns:
-            tuple: Tensor[minibatch_size, input_shape...], [int], [float], [bool]
-        """
-        indexes = self.sample(size)
-
-        pre_states = np.array([self.get_state(index) for index in indexes], dtype=np.float32)
-        post_states = np.array([self.get_state(index + 1) for index in indexes], dtype=np.float32)
-        actions = self._actions[indexes]
-        rewards = self._rewards[indexes]
-        dones = self._terminals[indexes]
-
-        return pre_states, actions, post_states, rewards, dones
-
-    def get_state(self, index):
-        """
-        Return the specified state with the replay memory. A state consists of
-        the last `history_length` perceptions.
-
-        Attributes:
-            index (int): State's index
-
-        Returns:
-            State at specified index (Tensor[history_length, input_shape...])
-        """
-        if self._count == 0:
-            raise IndexError('Empty Memory')
-
-        index %= self._count
-        history_length = self._history_length
-
-        # If index > history_length, take from a slice
-        if index >= history_length:
-            return self._states[(index - (history_length - 1)):index + 1, ...]
-        else:
-            indexes = np.arange(index - history_length + 1, index + 1)
-            return self._states.take(indexes, mode='wrap', axis=0)
-
 class History(object):
     """
     Accumulator keeping track of the N previous frames to be used by the agent
@@ -257,16 +144,50 @@ def huber_loss(y, y_hat, delta):
 
     return reduce_sum(loss_per_sample, name='loss')
 
+def copy_network(network, make_weight):
+    """ Clones a network, replacing each of its parameters by make_weight(parameter).
+
+    Attributes:
+        network (Function): The network to copy
+        make_weight (callable): Returns the constant or parameter that replaces a parameter in the copy
+
+    Returns:
+        The copy, and the (copy weight, network parameter) pairs, matched by parameter uid rather than by list order
+    """
+    substitutions = {weight: make_weight(weight) for weight in network.parameters}
+    copy = network.clone(CloneMethod.share, substitutions)
+    pairs = [(substitutions[weight], weight) for weight in network.parameters]
+
+    copy_uids = set(weight.uid for weight in list(copy.parameters) + list(copy.constants))
+    for copy_weight, weight in pairs:
+        if copy_weight.uid not in copy_uids or copy_weight.name != weight.name or copy_weight.shape != weight.shape:
+            raise RuntimeError('The copy of the network has no weight matching the parameter %s %s' % (weight.name, weight.shape))
+    return copy, pairs
+
 class DeepQAgent(object):
     """
     Implementation of Deep Q Neural Network agent like in:
         Nature 518. "Human-level control through deep reinforcement learning" (Mnih & al. 2015)
+
+    With prioritized_replay, minibatches are drawn from a PrioritizedReplayMemory, the Huber loss of each sample is
+    scaled by its importance-sampling weight, and the TD errors of every trained minibatch become its new priorities.
+
+    Actions are picked with a copy of the Q-network. There are two copies: the actor reads the front one while the
+    learner copies new weights into the back one and then swaps them, so acting never waits for training.
+    After #start_learner(), a background thread trains continuously, updates_per_step minibatches per action taken,
+    and #train() only raises the error that stopped the learner, if any. Otherwise #train() trains synchronously, as before.
+
+    The target network is built once. Every target_update_interval minibatches its weights are overwritten with
+    those of the Q-network, or, with target_update_tau, moved towards them by a soft update after every minibatch.
+    A checkpoint is saved every checkpoint_interval minibatches, with the time taken by the target updates so far and
+    the peak memory of the process.
     """
     def __init__(self, input_shape, nb_actions,
                  gamma=0.7, explorer=LinearEpsilonAnnealingExplorer(1, 0.1, 100000),
                  learning_rate=0.001, momentum=0.2, minibatch_size=32,
                  memory_size=500000, train_after=100, train_interval=100, target_update_interval=100,
-                 monitor=True):
+                 monitor=True, prioritized_replay=True, priority_alpha=0.6, priority_beta=0.4,
+                 updates_per_step=0.25, actor_sync_interval=1, target_update_tau=None, checkpoint_interval=100):
         self.input_shape = input_shape
         self.nb_actions = nb_actions
         self.gamma = gamma
@@ -274,13 +195,32 @@ class DeepQAgent(object):
         self._train_after = train_after
         self._train_interval = train_interval
         self._target_update_interval = target_update_interval
+        self._target_update_tau = target_update_tau
+        self._checkpoint_interval = checkpoint_interval
+        self._num_target_syncs = 0
+        self._target_sync_seconds = 0.0
 
         self._explorer = explorer
         self._minibatch_size = minibatch_size
         self._history = History(input_shape)
-        self._memory = ReplayMemory(memory_size, input_shape[1:], 4)
+        self._prioritized_replay = prioritized_replay
+        if prioritized_replay:
+            self._memory = PrioritizedReplayMemory(memory_size, input_shape[1:], 4, alpha=priority_alpha, beta=priority_beta)
+        else:
+            self._memory = ReplayMemory(memory_size, input_shape[1:], 4)
         self._num_actions_taken = 0
         self._num_trains = 0
+        self._num_updates = 0
+        self._updates_per_step = updates_per_step
+        self._actor_sync_interval = actor_sync_interval
+
+        # The learner thread samples and updates the replay memory while the actor appends to it
+        self._memory_lock = threading.Lock()
+        self._learner_thread = None
+        self._learner_stop = threading.Event()
+        self._learner_error = None
+        self._new_steps = threading.Condition()
+        self._instrumentation = cntk_instrumentation.default_instrumentation()
 
         # Metrics accumulator
         self._episode_rewards, self._episode_q_means, self._episode_q_stddev = [], [], []
@@ -296,9 +236,18 @@ class DeepQAgent(object):
         
         self._action_value_net.update_signature(Tensor[input_shape])
 
+        # The front and back copies of the Q-network used for acting. The lock is held while the actor evaluates the
+        # front copy, so the learner only swaps the copies between two evaluations.
+        copy_parameter = lambda weight: parameter(shape=weight.shape, init=weight.value, name=weight.name)
+        self._actor_nets, self._actor_pairs = zip(*[copy_network(self._action_value_net, copy_parameter) for _ in range(2)])
+        self._actor_front = 0
+        self._actor_lock = threading.Lock()
+
         # Target model used to compute the target Q-values in training, updated
-        # less frequently for increased stability.
-        self._target_net = self._action_value_net.clone(CloneMethod.freeze)
+        # less frequently for increased stability. Its weights are constants, overwritten in place by #_sync_target(),
+        # so the graph of the criterion below keeps using it.
+        self._target_net, self._target_pairs = copy_network(
+            self._action_value_net, lambda weight: constant(value=weight.value, name=weight.name))
 
         # Function computing Q-values targets as part of the computation graph
         @Function
@@ -310,11 +259,11 @@ class DeepQAgent(object):
                 gamma * reduce_max(self._target_net(post_states), axis=0) + rewards,
             )
 
-        # Define the loss, using Huber Loss (more robust to outliers)
+        # Define the loss, using Huber Loss (more robust to outliers), weighted per sample by the importance-sampling weights
         @Function
         @Signature(pre_states=Tensor[input_shape], actions=Tensor[nb_actions],
-                   post_states=Tensor[input_shape], rewards=Tensor[()], terminals=Tensor[()])
-        def criterion(pre_states, actions, post_states, rewards, terminals):
+                   post_states=Tensor[input_shape], rewards=Tensor[()], terminals=Tensor[()], weights=Tensor[()])
+        def criterion(pre_states, actions, post_states, rewards, terminals, weights):
             # Compute the q_targets
             q_targets = compute_q_targets(post_states, rewards, terminals)
 
@@ -322,7 +271,16 @@ class DeepQAgent(object):
             q_acted = reduce_sum(self._action_value_net(pre_states) * actions, axis=0)
 
             # Define training criterion as the Huber Loss function
-            return huber_loss(q_targets, q_acted, 1.0)
+            return weights * huber_loss(q_targets, q_acted, 1.0)
+
+        # The TD errors of a minibatch, which become the priorities of its states
+        @Function
+        @Signature(pre_states=Tensor[input_shape], actions=Tensor[nb_actions],
+                   post_states=Tensor[input_shape], rewards=Tensor[()], terminals=Tensor[()])
+        def td_errors(pre_states, actions, post_states, rewards, terminals):
+            return compute_q_targets(post_states, rewards, terminals) - reduce_sum(self._action_value_net(pre_states) * actions, axis=0)
+
+        self._td_errors = td_errors
 
         # Adam based SGD
         lr_schedule = learning_rate_schedule(learning_rate, UnitType.minibatch)
@@ -352,13 +310,15 @@ class DeepQAgent(object):
         # If policy requires agent to explore, sample random action
         if self._explorer.is_exploring(self._num_actions_taken):
             action = self._explorer(self.nb_actions)
+            self._instrumentation.count('random_actions')
         else:
             # Use the network to output the best action
             env_with_history = self._history.value
-            q_values = self._action_value_net.eval(
-                # Append batch axis with only one sample to evaluate
-                env_with_history.reshape((1,) + env_with_history.shape)
-            )
+            with self._instrumentation.timer('act_eval_seconds'), self._actor_lock:
+                q_values = self._actor_nets[self._actor_front].eval(
+                    # Append batch axis with only one sample to evaluate
+                    env_with_history.reshape((1,) + env_with_history.shape)
+                )
 
             self._episode_q_means.append(np.mean(q_values))
             self._episode_q_stddev.append(np.std(q_values))
@@ -368,6 +328,9 @@ class DeepQAgent(object):
 
         # Keep track of interval action counter
         self._num_actions_taken += 1
+        self._instrumentation.count('actions')
+        with self._new_steps:
+            self._new_steps.notify()
         return action
 
     def observe(self, old_state, action, reward, done):
@@ -390,9 +353,12 @@ class DeepQAgent(object):
 
             # Reset the short term memory
             self._history.reset()
+            self._instrumentation.count('episodes')
 
         # Append to long term memory
-        self._memory.append(old_state, action, reward, done)
+        with self._instrumentation.timer('replay_append_seconds'), self._memory_lock:
+            self._memory.append(old_state, action, reward, done)
+        self._instrumentation.count('transitions')
 
     def train(self):
         """ This allows the agent to train itself to better understand the environment dynamics.
@@ -402,9 +368,14 @@ class DeepQAgent(object):
         The target expectation is computed through the Target Network, which is a more stable version
         of the Action Value Network for increasing training stability.
 
-        The Target Network is a frozen copy of the Action Value Network updated as regular intervals.
+        The Target Network is a frozen copy of the Action Value Network updated as regular intervals, see #_sync_target().
         """
 
+        if self._learner_thread is not None:
+            if self._learner_error is not None:
+                raise RuntimeError('The background learner stopped: %s' % self._learner_error)
+            return
+
         agent_step = self._num_actions_taken
 
         if agent_step >= self._train_after:
@@ -413,23 +384,130 @@ class DeepQAgent(object):
             if self._num_trains % 3 == 0:
                 print('\nTraining minibatch\n')
                 client.setCarControls(zero_controls)
-                pre_states, actions, post_states, rewards, terminals = self._memory.minibatch(self._minibatch_size)
-                self._trainer.train_minibatch(
-                    self._trainer.loss_function.argument_map(
+                self._train_minibatch()
+
+    def start_learner(self):
+        """ Starts training on a background thread, see the class documentation """
+        if self._learner_thread is not None:
+            return
+        self._learner_stop.clear()
+        self._learner_thread = threading.Thread(target=self._learn, daemon=True)
+        self._learner_thread.start()
+
+    def stop_learner(self):
+        """ Stops the background learner after its current minibatch """
+        if self._learner_thread is None:
+            return
+        self._learner_stop.set()
+        with self._new_steps:
+            self._new_steps.notify()
+        self._learner_thread.join()
+        self._learner_thread = None
+
+    def _learn(self):
+        """ The learner thread: trains whenever fewer than updates_per_step minibatches per action have been trained
+        since train_after actions, and otherwise waits for the actor to take more actions.
+        A minibatch that can't be sampled yet is retried once more transitions are in. Any other error stops the
+        learner, and #train() raises it in the main loop.
+        """
+        while not self._learner_stop.is_set():
+            steps = self._num_actions_taken - self._train_after
+            if steps < 0 or self._num_updates >= self._updates_per_step * steps:
+                with self._new_steps:
+                    self._new_steps.wait(0.1)
+                continue
+
+            try:
+                self._train_minibatch()
+            except ValueError as e:
+                print('Learner could not sample a minibatch, waiting for more transitions: %s' % e)
+                self._learner_stop.wait(1)
+            except Exception as e:
+                traceback.print_exc()
+                self._learner_error = e
+                return
+
+    def _train_minibatch(self):
+        """ Trains the Q-network on one minibatch from the replay memory, publishes it to the actor, and updates the
+        target network and saves a checkpoint when they are due
+        """
+        with self._instrumentation.timer('minibatch_seconds'), self._memory_lock:
+            if self._prioritized_replay:
+                indexes = self._memory.sample(self._minibatch_size)
+                weights = self._memory.importance_weights(indexes)
+            else:
+                indexes = None
+                weights = np.ones(self._minibatch_size, dtype=np.float32)
+            pre_states, actions, post_states, rewards, terminals = self._memory.minibatch(self._minibatch_size, indexes)
+            actions = actions.reshape(-1, 1).tolist()
+
+        # The TD errors before this step, like the loss it minimizes, are the new priorities
+        if self._prioritized_replay:
+            with self._instrumentation.timer('priority_update_seconds'):
+                errors = self._td_errors.eval(
+                    self._td_errors.argument_map(
                         pre_states=pre_states,
-                        actions=Value.one_hot(actions.reshape(-1, 1).tolist(), self.nb_actions),
+                        actions=Value.one_hot(actions, self.nb_actions),
                         post_states=post_states,
                         rewards=rewards,
                         terminals=terminals
                     )
                 )
-            # Update the Target Network if needed
-            if self._num_trains % 30 == 0:
-                print('updating network')
-                self._target_net = self._action_value_net.clone(CloneMethod.freeze)
-                filename = dirname+"\model%d" % agent_step
-                self._trainer.save_checkpoint(filename)
-                
+                with self._memory_lock:
+                    self._memory.update_priorities(indexes, errors)
+
+        with self._instrumentation.timer('train_minibatch_seconds'):
+            self._trainer.train_minibatch(
+                self._trainer.loss_function.argument_map(
+                    pre_states=pre_states,
+                    actions=Value.one_hot(actions, self.nb_actions),
+                    post_states=post_states,
+                    rewards=rewards,
+                    terminals=terminals,
+                    weights=weights
+                )
+            )
+        self._instrumentation.count('minibatches')
+        self._num_updates += 1
+        if self._num_updates % self._actor_sync_interval == 0:
+            self._publish_actor_net()
+        if self._target_update_tau is not None or self._num_updates % self._target_update_interval == 0:
+            self._sync_target(self._target_update_tau)
+        if self._num_updates % self._checkpoint_interval == 0:
+            self._save_checkpoint()
+
+    def _publish_actor_net(self):
+        """ Copies the Q-network's weights into the back copy used for acting, and makes it the front one """
+        with self._instrumentation.timer('actor_sync_seconds'):
+            for target, source in self._actor_pairs[1 - self._actor_front]:
+                target.value = source.value
+            with self._actor_lock:
+                self._actor_front = 1 - self._actor_front
+
+    def _sync_target(self, tau=None):
+        """ Copies the Q-network's weights into the target network, or with tau, makes each target weight
+        tau * weight + (1 - tau) * target weight
+        """
+        start = time.perf_counter()
+        with self._instrumentation.timer('target_sync_seconds'):
+            for target, source in self._target_pairs:
+                if tau is None:
+                    target.value = source.value
+                else:
+                    target.value = tau * source.value + (1 - tau) * target.value
+        self._num_target_syncs += 1
+        self._target_sync_seconds += time.perf_counter() - start
+        self._instrumentation.count('target_syncs')
+
+    def _save_checkpoint(self):
+        filename = dirname+"\model%d" % self._num_actions_taken
+        with self._instrumentation.timer('checkpoint_seconds'):
+            self._trainer.save_checkpoint(filename)
+        peak_rss = cntk_instrumentation.peak_rss_mb()
+        print('saved {0}: {1} target syncs, {2:.3f} ms per sync, peak RSS {3} MB'.format(
+            filename, self._num_target_syncs, 1000 * self._target_sync_seconds / max(1, self._num_target_syncs),
+            '{0:.1f}'.format(peak_rss) if peak_rss is not None else 'unknown'))
+
     def _plot_metrics(self):
         """Plot current buffers accumulated values to visualize agent learning
         """
@@ -625,7 +703,9 @@ zero_controls = car_controls
 NumBufferFrames = 4
 SizeState = 5
 NumActions = 5
-agent = DeepQAgent((NumBufferFrames, SizeState), NumActions, monitor=True)
+agent = DeepQAgent((NumBufferFrames, SizeState), NumActions, monitor=True, target_update_interval=10)
+# Set DQN_METRICS_CSV to export the agent's timers and counters to a CSV file
+cntk_instrumentation.configure(os.environ.get('DQN_METRICS_CSV'))
 current_state = np.zeros(SizeState)
 
 #Loading YOLO
@@ -660,6 +740,10 @@ try:
     f = open(dirname+ '/log.txt','w')
     firstline = 'x,y,distance,reward\n'
 
+    # Set DQN_BACKGROUND_LEARNER to train on a background thread instead of stopping the car at the end of every episode
+    if os.environ.get('DQN_BACKGROUND_LEARNER'):
+        agent.start_learner()
+
     while True:
 
         action = agent.act(current_state)
@@ -727,6 +811,7 @@ try:
             
         
 except KeyboardInterrupt as inst:
+    agent.stop_learner()
     import traceback
     print(type(inst))    # the exception instance
     print(inst.args)     # arguments stored in .args
@@ -0,0 +1,104 @@
+import numpy as np
+import time
+import sys
+from cntk_replay_memory import ReplayMemory, PrioritizedReplayMemory
+
+# Micro-benchmarks for the parts of the CNTK DQN scripts that don't need AirSim or CNTK.
+#
+# Usage: python benchmark.py <benchmark> [name=value ...]
+#   minibatch    compares the minibatch assembly of the replay memory, one get_state per state, with the gathered minibatch,
+#                at batch sizes 32 to 1024, and checks that they agree
+#   prioritized  times sampling, importance weights and priority updates of the prioritized replay memory against
+#                uniform sampling, at the default memory size of 500000
+
+# A replay memory of size transitions of random states, with a terminal state every episode_length transitions on average
+def make_replay_memory(size, state_shape, episode_length, memory_class=ReplayMemory):
+    memory = memory_class(size, state_shape, 4)
+    for _ in range(0, size, 1):
+        memory.append(np.random.random_sample(state_shape).astype(np.float32), np.random.randint(0, 5), np.random.random_sample(),
+                      np.random.random_sample() < 1.0 / episode_length)
+    return memory
+
+# The minibatch assembly before the gather, one get_state per state
+def minibatch_with_get_state(memory, indexes):
+    pre_states = np.array([memory.get_state(index) for index in indexes], dtype=np.float32)
+    post_states = np.array([memory.get_state(index + 1) for index in indexes], dtype=np.float32)
+    return pre_states, memory._actions[indexes], post_states, memory._rewards[indexes], memory._terminals[indexes]
+
+def benchmark_minibatch(parameters):
+    memory_size = int(parameters.get('memory_size', 100000))
+    state_size = int(parameters.get('state_size', 5))
+    episode_length = float(parameters.get('episode_length', 100))
+    batch_sizes = [int(b) for b in parameters.get('batch_sizes', '32,64,128,256,512,1024').split(',')]
+    repeats = int(parameters.get('repeats', 200))
+    memory = make_replay_memory(memory_size, (state_size,), episode_length)
+
+    results = {}
+    for batch_size in batch_sizes:
+        # Both paths on the same indexes, so that the time of sample() is left out and the results can be compared
+        indexes = [memory.sample(batch_size) for _ in range(0, repeats, 1)]
+        for name, assemble in [('get_state', lambda i: minibatch_with_get_state(memory, i)), ('gather', lambda i: memory.minibatch(len(i), i))]:
+            latencies = []
+            for batch_indexes in indexes:
+                start = time.perf_counter()
+                assemble(batch_indexes)
+                latencies.append(time.perf_counter() - start)
+            results.setdefault(batch_size, {})[name] = 1000 * float(np.median(latencies))
+
+        for expected, actual in zip(minibatch_with_get_state(memory, indexes[0]), memory.minibatch(batch_size, indexes[0])):
+            if not np.array_equal(expected, actual):
+                raise RuntimeError('The gathered minibatch differs from the one built with get_state')
+
+        print('batch size {0}: get_state {1:.3f} ms, gather {2:.3f} ms, speedup {3:.1f}x'.format(
+            batch_size, results[batch_size]['get_state'], results[batch_size]['gather'], results[batch_size]['get_state'] / results[batch_size]['gather']))
+    return results
+
+def benchmark_prioritized(parameters):
+    memory_size = int(parameters.get('memory_size', 500000))
+    episode_length = float(parameters.get('episode_length', 100))
+    batch_sizes = [int(b) for b in parameters.get('batch_sizes', '32,256,1024').split(',')]
+    repeats = int(parameters.get('repeats', 200))
+    start = time.perf_counter()
+    memory = make_replay_memory(memory_size, (5,), episode_length, PrioritizedReplayMemory)
+    print('filled {0} transitions in {1:.1f} s ({2:.1f} us per append)'.format(memory_size, time.perf_counter() - start, 1e6 * (time.perf_counter() - start) / memory_size))
+    uniform = make_replay_memory(min(memory_size, 100000), (5,), episode_length)
+
+    results = {}
+    for batch_size in batch_sizes:
+        timings = {'uniform_sample': [], 'sample': [], 'weights': [], 'update': []}
+        for _ in range(0, repeats, 1):
+            start = time.perf_counter()
+            uniform.sample(batch_size)
+            timings['uniform_sample'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            indexes = memory.sample(batch_size)
+            timings['sample'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            memory.importance_weights(indexes)
+            timings['weights'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            memory.update_priorities(indexes, np.random.standard_normal(batch_size))
+            timings['update'].append(time.perf_counter() - start)
+
+        results[batch_size] = {name: 1000 * float(np.median(values)) for name, values in timings.items()}
+        print('batch size {0}: uniform sample {1:.3f} ms, prioritized sample {2:.3f} ms, weights {3:.3f} ms, update {4:.3f} ms'.format(
+            batch_size, results[batch_size]['uniform_sample'], results[batch_size]['sample'], results[batch_size]['weights'], results[batch_size]['update']))
+    return results
+
+BENCHMARKS = {
+    'minibatch': benchmark_minibatch,
+    'prioritized': benchmark_prioritized,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('Usage: python benchmark.py <{0}> [name=value ...]'.format('|'.join(BENCHMARKS.keys())))
+        sys.exit(1)
+
+    parameters = {}
+    for arg in sys.argv[2:]:
+        name, value = arg.split('=', 1)
+        parameters[name] = value
+
+    BENCHMARKS[sys.argv[1]](parameters)
@@ -0,0 +1,145 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+# Counters and timers for the CNTK DQN scripts, with a periodic export to a CSV file.
+#
+# A timer keeps the count, sum and maximum of the durations of its body in seconds, so it takes constant memory however
+# long the agent runs. The CSV rows have the same columns as those of DQN_tensorflow_model/instrumentation.py.
+#
+# A disabled Instrumentation does nothing: count returns at once and timer returns a shared no-op context manager, so the
+# calls can stay in the hot paths of the agents. The module-level default instance is disabled until configure is called.
+#
+# Usage:
+#   instruments = cntk_instrumentation.default_instrumentation()
+#   with instruments.timer('train_minibatch_seconds'):
+#       ...
+#   instruments.count('transitions')
+#
+#   cntk_instrumentation.configure(csv_file='metrics.csv')   # once, at startup
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+    def __init__(self, instrumentation, name):
+        self._instrumentation = instrumentation
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._instrumentation.observe(self._name, time.perf_counter() - self._start)
+        return False
+
+class Instrumentation(object):
+    def __init__(self, enabled=True):
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = collections.OrderedDict()
+        self._timers = collections.OrderedDict()
+        self._start_time = time.time()
+        self._export_thread = None
+        self._stop_export = threading.Event()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def count(self, name, amount=1):
+        """ Adds amount to the counter name """
+        if not self._enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """ Adds a duration to the timer name """
+        if not self._enabled:
+            return
+        with self._lock:
+            count, total, maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def timer(self, name):
+        """ A context manager adding the time its body takes to the timer name """
+        if not self._enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """ Returns copies of the metrics: {'counters': {name: value}, 'timers': {name: (count, sum, max)}} """
+        with self._lock:
+            return {'counters': collections.OrderedDict(self._counters), 'timers': collections.OrderedDict(self._timers)}
+
+    def write_csv(self, file_name):
+        """ Appends one row per metric to file_name, with the header if the file is new """
+        snapshot = self.snapshot()
+        now = time.time()
+        elapsed = now - self._start_time
+        is_new_file = not os.path.isfile(file_name)
+        with open(file_name, 'a') as f:
+            if is_new_file:
+                f.write('time,elapsed_sec,metric,type,count,sum,mean\n')
+            for name, value in snapshot['counters'].items():
+                f.write('{0:.3f},{1:.3f},{2},counter,{3},,\n'.format(now, elapsed, name, value))
+            for name, (count, total, _) in snapshot['timers'].items():
+                f.write('{0:.3f},{1:.3f},{2},histogram,{3},{4!r},{5!r}\n'.format(now, elapsed, name, count, total, total / count))
+
+    def start_export(self, csv_file, interval_sec=10.0):
+        """ Enables the instrumentation and writes it to csv_file every interval_sec seconds """
+        self.stop_export()
+        self._enabled = True
+        self._stop_export.clear()
+        self._export_thread = threading.Thread(target=self._export_csv, args=(csv_file, float(interval_sec)), daemon=True)
+        self._export_thread.start()
+
+    def stop_export(self):
+        """ Stops the export, writing the CSV file one last time """
+        if self._export_thread is not None:
+            self._stop_export.set()
+            self._export_thread.join()
+            self._export_thread = None
+
+    def _export_csv(self, csv_file, interval_sec):
+        while not self._stop_export.wait(interval_sec):
+            self._try_write_csv(csv_file)
+        self._try_write_csv(csv_file)
+
+    def _try_write_csv(self, csv_file):
+        try:
+            self.write_csv(csv_file)
+        except Exception as e:
+            print('Failed to write metrics to {0}. Message is {1}'.format(csv_file, e))
+
+def peak_rss_mb():
+    """ The peak resident set size of the process in MB, or None where the resource module is not available (Windows) """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak_rss / 1024.0
+
+_default_instrumentation = Instrumentation(enabled=False)
+
+def default_instrumentation():
+    """ The instance shared by the agent and the driving loop of a script """
+    return _default_instrumentation
+
+def configure(csv_file=None, interval_sec=10.0):
+    """ Enables the default instrumentation and starts exporting it to csv_file. Does nothing if csv_file is None. """
+    if csv_file is not None:
+        _default_instrumentation.start_export(csv_file, interval_sec)
+    return _default_instrumentation
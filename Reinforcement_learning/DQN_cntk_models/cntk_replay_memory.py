@@ -0,0 +1,334 @@
+import numpy as np
+
+
+class ReplayMemory(object):
+    """
+    ReplayMemory keeps track of the environment dynamic.
+    We store all the transitions (s(t), action, s(t+1), reward, done).
+    The replay memory allows us to efficiently sample minibatches from it, and generate the correct state representation
+    (w.r.t the number of previous frames needed).
+
+    A mask of the indexes that can be sampled (see #sample()) is updated as transitions are appended, so a minibatch
+    is drawn in a few vectorized calls instead of one candidate at a time.
+    """
+    def __init__(self, size, sample_shape, history_length=4):
+        self._pos = 0
+        self._count = 0
+        self._max_size = size
+        self._history_length = max(1, history_length)
+        self._state_shape = sample_shape
+        self._states = np.zeros((size,) + sample_shape, dtype=np.float32)
+        self._actions = np.zeros(size, dtype=np.uint8)
+        self._rewards = np.zeros(size, dtype=np.float32)
+        self._terminals = np.zeros(size, dtype=np.float32)
+        self._valid = np.zeros(size, dtype=bool)
+        self._num_valid = 0
+
+        # Offsets of the frames of a state relative to its index, oldest first, and the minibatch output buffers
+        self._history_offsets = np.arange(1 - self._history_length, 1)
+        self._minibatch_buffers = None
+
+    def __len__(self):
+        """ Returns the number of items currently present in the memory
+        Returns: Int >= 0
+        """
+        return self._count
+
+    def append(self, state, action, reward, done):
+        """ Appends the specified transition to the memory.
+
+        Attributes:
+            state (Tensor[sample_shape]): The state to append
+            action (int): An integer representing the action done
+            reward (float): An integer representing the reward received for doing this action
+            done (bool): A boolean specifying if this state is a terminal (episode has finished)
+        """
+        assert state.shape == self._state_shape, \
+            'Invalid state shape (required: %s, got: %s)' % (self._state_shape, state.shape)
+
+        self._states[self._pos] = state
+        self._actions[self._pos] = action
+        self._rewards[self._pos] = reward
+        self._terminals[self._pos] = done
+
+        self._count = max(self._count, self._pos + 1)
+        self._pos = (self._pos + 1) % self._max_size
+
+        # The new terminal flag changes the indexes whose history holds it, the new position those whose history
+        # overlaps it, and a growing count makes one more index eligible
+        written = (self._pos - 1) % self._max_size
+        self._update_valid(written - 1, written + self._history_length + 1)
+
+    def _update_valid(self, start, end):
+        """ Recomputes whether the indexes in [start, end) can be sampled.
+        An index can be sampled if it and the next one are in the memory, if its history doesn't wrap over the
+        current position and if there is no terminal state in its history.
+        """
+        indexes = np.arange(max(start, 0), min(end, self._max_size))
+        history_len = self._history_length
+
+        valid = (indexes >= history_len) & (indexes < self._count - 1)
+        valid &= ~((indexes >= self._pos) & (self._pos > indexes - history_len))
+        history = np.maximum(indexes[:, np.newaxis] - history_len + np.arange(history_len), 0)
+        valid &= ~self._terminals[history].any(axis=1)
+
+        self._num_valid += int(np.count_nonzero(valid)) - int(np.count_nonzero(self._valid[indexes]))
+        self._valid[indexes] = valid
+
+    def sample(self, size):
+        """ Generate size random integers mapping indices in the memory.
+            The returned indices can be retrieved using #get_state().
+            See the method #minibatch() if you want to retrieve samples directly.
+
+        Attributes:
+            size (int): The minibatch size
+
+        The indexes are drawn uniformly without replacement among the valid ones (see #_update_valid()).
+        Candidates are drawn uniformly over the whole range at once, and the first occurrences of the valid ones are
+        kept in the order they were drawn, which gives the same distribution as drawing the valid indexes one by one.
+        If a few rounds of candidates are not enough, the valid indexes are listed and drawn from directly.
+
+        Returns:
+             Indexes of the sampled states (np.ndarray of int)
+        """
+        if self._num_valid < size:
+            raise ValueError('Cannot sample %d states, only %d can be sampled' % (size, self._num_valid))
+
+        low, high = self._history_length, self._count - 1
+        num_candidates = int(np.ceil(2.0 * size * (high - low) / self._num_valid)) + 8
+        for _ in range(3):
+            candidates = np.random.randint(low, high, size=num_candidates)
+            candidates = candidates[self._valid[candidates]]
+            _, first = np.unique(candidates, return_index=True)
+            if len(first) >= size:
+                return candidates[np.sort(first)[:size]]
+
+        return np.random.choice(np.flatnonzero(self._valid), size, replace=False)
+
+    def minibatch(self, size, indexes=None):
+        """ Generate a minibatch with the number of samples specified by the size parameter.
+
+        Attributes:
+            size (int): Minibatch size
+            indexes (np.ndarray of int): The indexes of the states to gather, drawn with #sample() if not given
+
+        The states are gathered with one np.take each, from a (size, history_length) array of frame rows that wraps
+        around like #get_state(). Everything is written into output buffers that are allocated once per minibatch
+        size and reused, so the returned arrays are only valid until the next call.
+
+        Returns:
+            tuple: Tensor[minibatch_size, input_shape...], [int], [float], [bool]
+        """
+        if indexes is None:
+            indexes = self.sample(size)
+        buffers = self._get_minibatch_buffers(size)
+
+        self._state_rows(indexes, 0, buffers)
+        np.take(self._states, buffers['rows'], axis=0, out=buffers['pre_states'], mode='wrap')
+        self._state_rows(indexes, 1, buffers)
+        np.take(self._states, buffers['rows'], axis=0, out=buffers['post_states'], mode='wrap')
+        np.take(self._actions, indexes, out=buffers['actions'])
+        np.take(self._rewards, indexes, out=buffers['rewards'])
+        np.take(self._terminals, indexes, out=buffers['dones'])
+
+        return buffers['pre_states'], buffers['actions'], buffers['post_states'], buffers['rewards'], buffers['dones']
+
+    def _get_minibatch_buffers(self, size):
+        """ Returns the output buffers of #minibatch() for minibatches of the given size, allocating them on a size change """
+        if self._minibatch_buffers is None or self._minibatch_buffers['actions'].shape[0] != size:
+            self._minibatch_buffers = {
+                'index': np.zeros(size, dtype=np.int64),
+                'rows': np.zeros((size, self._history_length), dtype=np.int64),
+                'pre_states': np.zeros((size, self._history_length) + self._state_shape, dtype=np.float32),
+                'post_states': np.zeros((size, self._history_length) + self._state_shape, dtype=np.float32),
+                'actions': np.zeros(size, dtype=self._actions.dtype),
+                'rewards': np.zeros(size, dtype=self._rewards.dtype),
+                'dones': np.zeros(size, dtype=self._terminals.dtype),
+            }
+        return self._minibatch_buffers
+
+    def _state_rows(self, indexes, shift, buffers):
+        """ Writes the rows of the frames of the states at indexes + shift into buffers['rows'], as #get_state() picks them.
+        Negative rows are left for np.take to wrap around.
+        """
+        index = buffers['index']
+        np.add(indexes, shift, out=index)
+        np.remainder(index, self._count, out=index)
+        np.add(index[:, np.newaxis], self._history_offsets, out=buffers['rows'])
+
+    def get_state(self, index):
+        """
+        Return the specified state with the replay memory. A state consists of
+        the last `history_length` perceptions.
+
+        Attributes:
+            index (int): State's index
+
+        Returns:
+            State at specified index (Tensor[history_length, input_shape...])
+        """
+        if self._count == 0:
+            raise IndexError('Empty Memory')
+
+        index %= self._count
+        history_length = self._history_length
+
+        # If index > history_length, take from a slice
+        if index >= history_length:
+            return self._states[(index - (history_length - 1)):index + 1, ...]
+        else:
+            indexes = np.arange(index - history_length + 1, index + 1)
+            return self._states.take(indexes, mode='wrap', axis=0)
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    A ReplayMemory sampling states in proportion to their priority, like in:
+        "Prioritized Experience Replay" (Schaul & al. 2016)
+
+    The priority of a transition is (|TD error| + epsilon) ^ alpha. New transitions get the highest priority seen so far,
+    so each is likely to be replayed at least once, until #update_priorities() sets their TD error after a train step.
+    The priorities are kept in a Fenwick tree (binary indexed tree) over the memory, where the indexes that can't be
+    sampled have a priority of 0, so sampling and updating priorities are O(log N) per index.
+
+    The importance-sampling weights returned by #importance_weights() correct for the non-uniform sampling. Their
+    exponent beta grows linearly from beta to 1 over beta_steps minibatches.
+    """
+    def __init__(self, size, sample_shape, history_length=4, alpha=0.6, beta=0.4, beta_steps=100000, epsilon=0.01):
+        super(PrioritizedReplayMemory, self).__init__(size, sample_shape, history_length)
+        self._alpha = alpha
+        self._beta = beta
+        self._beta_increment = (1.0 - beta) / max(1, beta_steps)
+        self._epsilon = epsilon
+        self._max_priority = 1.0
+        self._priorities = np.zeros(size, dtype=np.float64)
+
+        # The priorities that can be sampled (0 for invalid indexes), and the Fenwick tree of their partial sums:
+        # node i (1-based) holds the sum of the i & -i sampled priorities ending at index i - 1
+        self._sampled = np.zeros(size, dtype=np.float64)
+        self._tree = np.zeros(size + 1, dtype=np.float64)
+        self._top_step = 1 << (size.bit_length() - 1)
+        # The tree is rebuilt from the priorities every size updates, so rounding errors don't pile up
+        self._num_tree_updates = 0
+
+    @property
+    def beta(self):
+        return self._beta
+
+    def append(self, state, action, reward, done):
+        self._priorities[self._pos] = self._max_priority
+        super(PrioritizedReplayMemory, self).append(state, action, reward, done)
+
+    def _update_valid(self, start, end):
+        """ Also sets the sampled priorities of the indexes in [start, end), 0 for those that can't be sampled """
+        super(PrioritizedReplayMemory, self)._update_valid(start, end)
+        indexes = np.arange(max(start, 0), min(end, self._max_size))
+        self._set_sampled(indexes, np.where(self._valid[indexes], self._priorities[indexes], 0))
+
+    def _set_sampled(self, indexes, priorities):
+        """ Sets the sampled priorities of unique indexes and adds the differences along the tree """
+        changed = self._sampled[indexes] != priorities
+        indexes, priorities = indexes[changed], priorities[changed]
+        if len(indexes) == 0:
+            return
+        deltas = priorities - self._sampled[indexes]
+        self._sampled[indexes] = priorities
+
+        self._num_tree_updates += len(indexes)
+        if self._num_tree_updates >= self._max_size:
+            self._rebuild_tree()
+            return
+
+        # Usually one or two of them change, which is cheaper to walk up with scalars
+        if len(indexes) == 1:
+            node, delta = int(indexes[0]) + 1, float(deltas[0])
+            while node <= self._max_size:
+                self._tree[node] += delta
+                node += node & -node
+            return
+
+        nodes = indexes.astype(np.int64) + 1
+        while len(nodes) > 0:
+            np.add.at(self._tree, nodes, deltas)
+            nodes = nodes + (nodes & -nodes)
+            inside = nodes <= self._max_size
+            nodes, deltas = nodes[inside], deltas[inside]
+
+    def _rebuild_tree(self):
+        sums = np.concatenate(([0.0], np.cumsum(self._sampled)))
+        nodes = np.arange(1, self._max_size + 1)
+        self._tree[1:] = sums[nodes] - sums[nodes - (nodes & -nodes)]
+        self._num_tree_updates = 0
+
+    def _total(self):
+        """ The sum of the sampled priorities """
+        node, total = self._max_size, 0.0
+        while node > 0:
+            total += self._tree[node]
+            node -= node & -node
+        return total
+
+    def sample(self, size):
+        """ Draws size indexes in proportion to their priority, with replacement.
+        The draws are stratified: the total is split into size equal segments and one value is drawn in each.
+
+        Attributes:
+            size (int): The minibatch size
+
+        Returns:
+             Indexes of the sampled states (np.ndarray of int)
+        """
+        if self._num_valid == 0:
+            raise ValueError('Cannot sample %d states, none can be sampled' % size)
+
+        indexes = self._find(self._draw_values(size))
+        # Rounding in the tree can land a draw on an index with no priority, draw those again
+        invalid = ~self._valid[indexes]
+        while invalid.any():
+            indexes[invalid] = self._find(self._draw_values(int(np.count_nonzero(invalid))))
+            invalid = ~self._valid[indexes]
+        np.random.shuffle(indexes)
+
+        self._beta = min(1.0, self._beta + self._beta_increment)
+        return indexes
+
+    def _draw_values(self, size):
+        total = self._total()
+        values = (np.arange(size) + np.random.random_sample(size)) * (total / size)
+        return np.minimum(values, np.nextafter(total, 0))
+
+    def _find(self, values):
+        """ The indexes where the running sum of the sampled priorities first exceeds each value """
+        positions = np.zeros(len(values), dtype=np.int64)
+        values = values.copy()
+        step = self._top_step
+        while step > 0:
+            candidates = positions + step
+            inside = candidates <= self._max_size
+            partial = self._tree[np.minimum(candidates, self._max_size)]
+            go = inside & (partial <= values)
+            values -= np.where(go, partial, 0)
+            positions += np.where(go, step, 0)
+            step >>= 1
+        return np.minimum(positions, self._count - 1)
+
+    def importance_weights(self, indexes):
+        """ The importance-sampling weights of sampled indexes, (N * P(i)) ^ -beta, scaled so that the largest is 1
+
+        Returns:
+            np.ndarray of float32
+        """
+        probabilities = self._sampled[indexes] / self._total()
+        weights = (self._num_valid * probabilities) ** -self._beta
+        return (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, indexes, td_errors):
+        """ Sets the priorities of the sampled indexes from their TD errors, as computed when they were trained on """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        priorities = (np.abs(np.asarray(td_errors, dtype=np.float64).reshape(-1)) + self._epsilon) ** self._alpha
+        # An index drawn more than once gets the priority of its last occurrence
+        last = len(indexes) - 1 - np.unique(indexes[::-1], return_index=True)[1]
+        indexes, priorities = indexes[last], priorities[last]
+        self._priorities[indexes] = priorities
+        self._set_sampled(indexes, np.where(self._valid[indexes], priorities, 0))
+        self._max_priority = max(self._max_priority, float(priorities.max()))
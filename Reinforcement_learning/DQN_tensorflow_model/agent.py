@@ -1,24 +1,50 @@
 from airsim_client import *
 from rl_model import RlModel
+from replay_memory import ReplayMemory
+from replay_snapshot import ReplaySnapshotWriter, load_latest_snapshot
+from trainer_client import TrainerClient, backoff_delay
+from checkpoint_manager import CheckpointManager
+from camera_frames import decode_scene_image
+from control_loop import ControlLoop, LatencyStats
+import distance_field
+import instrumentation
+from gradient_compression import GradientCompressor
 import time
 import numpy as np
 import threading
-import json
+import queue
+import types
 import os
 import uuid
 import glob
 import datetime
-import h5py
 import sys
-import requests
 import PIL
-import copy
 import datetime
 import airsim
 
+# The episode bookkeeping of one vehicle when the agent drives several
+class VehicleState():
+    def __init__(self, name, epsilon):
+        self.name = name
+        self.epsilon = epsilon
+        self.start_pose = None
+        self.state_buffer = []
+        self.previous_step = None
+        self.warmup_steps_left = 0
+        self.last_collision_time_stamp = None
+        self.num_episodes = 0
+
+    def end_episode(self, collision_time_stamp):
+        self.previous_step = None
+        self.state_buffer = []
+        self.last_collision_time_stamp = collision_time_stamp
+        self.num_episodes += 1
+
 # A class that represents the agent that will drive the vehicle, train the model, and send the gradient updates to the trainer.
+# car_client_factory returns a new CarClient. By default that is airsim.CarClient, the offline benchmark passes a fake one.
 class DistributedAgent():
-    def __init__(self, parameters):
+    def __init__(self, parameters, car_client_factory=None):
         required_parameters = ['data_dir', 'max_epoch_runtime_sec', 'replay_memory_size', 'batch_size', 'min_epsilon', 'per_iter_epsilon_reduction', 'experiment_name', 'train_conv_layers']
         for required_parameter in required_parameters:
             if required_parameter not in parameters:
@@ -37,9 +63,19 @@ class DistributedAgent():
         self.__max_epoch_runtime_sec = float(parameters['max_epoch_runtime_sec'])
         self.__replay_memory_size = int(parameters['replay_memory_size'])
         self.__batch_size = int(parameters['batch_size'])
+
+        # Minibatches are drawn in proportion to the surprise factor of each transition, unless uniform_sampling is given
+        self.__sample_randomly = 'uniform_sampling' in parameters
+
+        # The minibatch size of a single training step. Every epoch trains on batch_size examples per frame in steps of this size.
+        if 'train_batch_size' in parameters:
+            self.__train_batch_size = int(parameters['train_batch_size'])
+        else:
+            self.__train_batch_size = 32
         self.__experiment_name = parameters['experiment_name']
         self.__train_conv_layers = bool((parameters['train_conv_layers'].lower().strip() == 'true'))
         self.__epsilon = 1
+        self.__trainer_epsilon = None
         self.__num_batches_run = 0
         self.__last_checkpoint_batch_count = 0
         
@@ -58,7 +94,70 @@ class DistributedAgent():
 
         self.__local_run = 'local_run' in parameters
 
-        self.__car_client = airsim.CarClient()
+        # Training on the sampled minibatches and exchanging the update with the trainer happens on a background thread,
+        # so that the car keeps collecting experiences in the meantime. This limits how many epochs can be waiting to be published.
+        if 'max_outstanding_updates' in parameters:
+            self.__max_outstanding_updates = int(parameters['max_outstanding_updates'])
+        else:
+            self.__max_outstanding_updates = 1
+        self.__publish_queue = queue.Queue()
+        self.__num_skipped_publishes = 0
+
+        # Weights and gradients are exchanged with the trainer as binary packets, in float32 unless float16 is requested.
+        if 'wire_dtype' in parameters:
+            self.__wire_dtype = np.dtype(parameters['wire_dtype'])
+        else:
+            self.__wire_dtype = np.dtype(np.float32)
+
+        # Optionally compress the weight deltas sent to the trainer, e.g. gradient_topk_ratio=0.01 gradient_quantize_bits=8
+        topk_ratio = float(parameters['gradient_topk_ratio']) if 'gradient_topk_ratio' in parameters else None
+        quantize_bits = int(parameters['gradient_quantize_bits']) if 'gradient_quantize_bits' in parameters else None
+        if (topk_ratio is not None or quantize_bits is not None):
+            self.__gradient_compressor = GradientCompressor(topk_ratio, quantize_bits, self.__wire_dtype)
+        else:
+            self.__gradient_compressor = None
+
+        # The driving loop runs at a fixed rate. Steps that take longer than 1 / control_frequency_hz are counted as missed deadlines.
+        if 'control_frequency_hz' in parameters:
+            self.__control_frequency_hz = float(parameters['control_frequency_hz'])
+        else:
+            self.__control_frequency_hz = 20.0
+        self.__control_loop = None
+
+        # Counters and timers of the agent and its model, exported every metrics_interval_sec to metrics_csv and served
+        # in the Prometheus text format on metrics_port. They are disabled unless one of the two is given.
+        if 'metrics_interval_sec' in parameters:
+            metrics_interval_sec = float(parameters['metrics_interval_sec'])
+        else:
+            metrics_interval_sec = 10.0
+        self.__instrumentation = instrumentation.configure(parameters.get('metrics_csv'), parameters.get('metrics_port'), metrics_interval_sec)
+
+        # The time spent in each stage of the agent: the control loop's RPCs, capture, predict, reward, replay_add, sample, train and publish
+        self.__stats = LatencyStats(instrumentation=self.__instrumentation)
+        self.__num_transitions = 0
+
+        # The priorities of new transitions are computed at the end of each epoch, this many transitions per forward pass
+        if 'priority_batch_size' in parameters:
+            self.__priority_batch_size = int(parameters['priority_batch_size'])
+        else:
+            self.__priority_batch_size = 256
+
+        # Stop after this many training epochs. By default the agent runs until it is killed.
+        if 'max_epochs' in parameters:
+            self.__max_epochs = int(parameters['max_epochs'])
+        else:
+            self.__max_epochs = None
+
+        # Drive several vehicles of the same AirSim instance, e.g. vehicle_names=Car1,Car2,Car3.
+        # Their greedy actions are predicted together, and all of them record into the replay memory.
+        if 'vehicle_names' in parameters:
+            self.__vehicle_names = [name.strip() for name in parameters['vehicle_names'].split(',') if len(name.strip()) > 0]
+        else:
+            self.__vehicle_names = None
+        self.__vehicles = None
+
+        self.__car_client_factory = car_client_factory if car_client_factory is not None else airsim.CarClient
+        self.__car_client = self.__car_client_factory()
         self.__car_controls = airsim.CarControls()
 
         self.__minibatch_dir = os.path.join(self.__data_dir, 'minibatches')
@@ -66,12 +165,43 @@ class DistributedAgent():
 
         self.__make_dir_if_not_exist(self.__minibatch_dir)
         self.__make_dir_if_not_exist(self.__output_model_dir)
+
+        # Checkpoints of local runs, written in the background. Keep the latest few and every 10th one.
+        if self.__local_run:
+            checkpoint_dir = os.path.join(os.path.join(self.__data_dir, 'checkpoint'), self.__experiment_name)
+            self.__checkpoints = CheckpointManager(checkpoint_dir, keep_last=5, keep_every=10)
+        else:
+            self.__checkpoints = None
         self.__last_model_file = ''
 
         self.__possible_ip_addresses = []
-        self.__trainer_ip_address = None
 
-        self.__experiences = {}
+        # The port the trainer listens on. Several trainers or agents on one machine can't all use port 80.
+        if 'trainer_port' in parameters:
+            trainer_port = int(parameters['trainer_port'])
+        else:
+            trainer_port = 80
+        self.__trainer_client = TrainerClient(trainer_port, self.__wire_dtype, pool_size=self.__max_outstanding_updates + 1)
+
+        # With replay_memory_dir, the replay memory is kept in memory-mapped files there, so it can be larger than RAM
+        if 'replay_memory_dir' in parameters:
+            replay_memory_dir = parameters['replay_memory_dir']
+        else:
+            replay_memory_dir = None
+        self.__replay_memory = ReplayMemory(self.__replay_memory_size, storage_dir=replay_memory_dir)
+
+        # The replay memory is saved to (data_dir)/replay_snapshot/(experiment_name) every replay_snapshot_every epochs,
+        # and reloaded from there at startup, so that a restarted agent doesn't have to fill it again. 0 disables the snapshots.
+        if 'replay_snapshot_every' in parameters:
+            self.__replay_snapshot_every = int(parameters['replay_snapshot_every'])
+        else:
+            self.__replay_snapshot_every = 25
+        self.__replay_snapshot_dir = os.path.join(os.path.join(self.__data_dir, 'replay_snapshot'), self.__experiment_name)
+        if (self.__replay_snapshot_every > 0):
+            self.__replay_snapshots = ReplaySnapshotWriter(self.__replay_snapshot_dir)
+        else:
+            self.__replay_snapshots = None
+        self.__num_epochs_run = 0
 
         self.__init_road_points()
         self.__init_reward_points()
@@ -80,6 +210,15 @@ class DistributedAgent():
     def start(self):
         self.__run_function()
 
+    @property
+    def stats(self):
+        return self.__stats
+
+    # The number of transitions recorded so far, including the random pre-fill
+    @property
+    def num_transitions(self):
+        return self.__num_transitions
+
     # The function that will be run during training.
     # It will initialize the connection to the trainer, start AirSim, and continuously run training iterations.
     def __run_function(self):
@@ -88,85 +227,109 @@ class DistributedAgent():
         # Once the trainer is online, it will write its IP to a file in (data_dir)\trainer_ip\trainer_ip.txt
         # Wait for that file to exist
         if not self.__local_run:
+            attempt = 0
             while True:
                 trainer_ip_dir = os.path.join(os.path.join(self.__data_dir, 'trainer_ip'), self.__experiment_name)
                 print('Checking {0}...'.format(trainer_ip_dir))
-                if os.path.isdir(trainer_ip_dir):
+                if os.path.isfile(os.path.join(trainer_ip_dir, 'trainer_ip.txt')):
                     with open(os.path.join(trainer_ip_dir, 'trainer_ip.txt'), 'r') as f:
                         self.__possible_ip_addresses.append(f.read().replace('\n', ''))
                         break
-                time.sleep(5)
+                time.sleep(backoff_delay(attempt, base_delay=1.0, max_delay=10.0))
+                attempt += 1
         
             # We now have the IP address for the trainer. Attempt to ping the trainer.
-            ping_idx = -1
-            while True:
-                ping_idx += 1
-                try:
-                    print('\tPinging {0}...'.format(self.__possible_ip_addresses[ping_idx % len(self.__possible_ip_addresses)]))
-                    response = requests.get('http://{0}:80/ping'.format(self.__possible_ip_addresses[ping_idx % len(self.__possible_ip_addresses)])).json()
-                    if response['message'] != 'pong':
-                        raise ValueError('Received unexpected message: {0}'.format(response))
-                    print('Success!')
-                    self.__trainer_ip_address = self.__possible_ip_addresses[ping_idx % len(self.__possible_ip_addresses)]
-                    break
-                except Exception as e:
-                    print('Could not get response. Message is {0}'.format(e))
-                    if (ping_idx % len(self.__possible_ip_addresses) == 0):
-                        print('Waiting 5 seconds and trying again...')
-                        time.sleep(5)
+            self.__trainer_client.connect(self.__possible_ip_addresses)
 
             print('Getting model from the trainer')
             sys.stdout.flush()
-            self.__model = RlModel(self.__weights_path, self.__train_conv_layers)
+            self.__model = RlModel(self.__weights_path, self.__train_conv_layers, self.__train_batch_size)
             self.__get_latest_model()
         
         else:
             print('Run is local. Skipping connection to trainer.')
-            self.__model = RlModel(self.__weights_path, self.__train_conv_layers)
+            self.__model = RlModel(self.__weights_path, self.__train_conv_layers, self.__train_batch_size)
             
 
         self.__connect_to_airsim()
 
-        while True:
+        # Resume from the last snapshot of the replay memory, if there is one
+        if (self.__replay_snapshots is not None):
             try:
-                self.__run_airsim_epoch(True)
-                percent_full = 100.0 * len(self.__experiences['actions'])/self.__replay_memory_size
+                load_latest_snapshot(self.__replay_snapshot_dir, self.__replay_memory)
+            except Exception as e:
+                print('Could not load the replay memory snapshot, filling the replay memory from scratch. Message is {0}'.format(e))
+                self.__replay_memory = ReplayMemory(self.__replay_memory.capacity, storage_dir=self.__replay_memory.storage_dir)
 
-                if (percent_full >= 100.0):
-                    break
+        while not self.__replay_memory.is_full():
+            try:
+                self.__run_airsim_epoch(True)
+                self.__save_replay_snapshot_if_due()
             except msgpackrpc.error.TimeoutError:
                 self.__connect_to_airsim()
 
         
         if not self.__local_run:
             self.__get_latest_model()
-        while True:
+
+        publisher_thread = threading.Thread(target=self.__publisher_function, daemon=True)
+        publisher_thread.start()
+
+        num_epochs = 0
+        while (self.__max_epochs is None or num_epochs < self.__max_epochs):
             try:
                 if (self.__model is not None):
-                    experiences, frame_count = self.__run_airsim_epoch(False)
+                    frame_count = self.__run_airsim_epoch(False)
+                    num_epochs += 1
+                    self.__instrumentation.count('epochs')
                     # If we didn't immediately crash, train on the gathered experiences
                     if (frame_count > 0):
-                        sampled_experiences = self.__sample_experiences(experiences, frame_count, True)
+                        with self.__stats.timed('sample'):
+                            sampled_experiences = self.__sample_experiences(frame_count, self.__sample_randomly)
                         self.__num_batches_run += frame_count
                         # If we successfully sampled, train on the collected minibatches and send the gradients to the trainer node
                         if (len(sampled_experiences) > 0):
-                            print('Publishing AirSim Epoch.')
-                            self.__publish_batch_and_update_model(sampled_experiences, frame_count)
+                            self.__queue_batch_for_publishing(sampled_experiences, frame_count)
+                    self.__save_replay_snapshot_if_due()
 
             except msgpackrpc.error.TimeoutError:
                 print('Lost connection to AirSim. Attempting to reconnect.')
+                self.__instrumentation.count('airsim_reconnects')
                 self.__connect_to_airsim()
 
+        # Only reached with max_epochs. Let the last updates go out before returning.
+        self.__publish_queue.join()
+        self.__instrumentation.stop_export()
+        print('Stopping after {0} epochs. {1}'.format(num_epochs, self.__stats.summary_line()))
+
+    # Starts saving a snapshot of the replay memory in the background every replay_snapshot_every epochs
+    def __save_replay_snapshot_if_due(self):
+        self.__num_epochs_run += 1
+        if (self.__replay_snapshots is not None and self.__num_epochs_run % self.__replay_snapshot_every == 0):
+            if not self.__replay_snapshots.save(self.__replay_memory):
+                print('The previous replay memory snapshot is still being written, skipping this one.')
+
     # Connects to the AirSim Exe.
     def __connect_to_airsim(self):
         attempt_count = 0
         while True:
             try:
                 print('Attempting to connect to AirSim (attempt {0})'.format(attempt_count))
-                self.__car_client = airsim.CarClient()
-                self.__car_client.confirmConnection()
-                self.__car_client.enableApiControl(True)
+                self.__car_client = self.__new_car_client()
+                if (self.__vehicle_names is None):
+                    self.__car_client.enableApiControl(True)
+                else:
+                    for vehicle_name in self.__vehicle_names:
+                        self.__car_client.enableApiControl(True, vehicle_name)
                 self.__car_controls = airsim.CarControls()
+
+                # The control loop talks to AirSim over connections of its own, so that its RPCs can overlap
+                if (self.__control_loop is not None):
+                    try:
+                        self.__control_loop.close()
+                    except Exception:
+                        pass
+                self.__control_loop = ControlLoop(self.__new_car_client, [ImageRequest(0, AirSimImageType.Scene, False, False)], self.__control_frequency_hz, self.__stats, self.__vehicle_names)
                 return
             except:
                 print('Failed to connect.')
@@ -180,6 +343,11 @@ class DistributedAgent():
                         os.system('START "" powershell.exe D:\\AD_Cookbook_AirSim\\Scripts\\DistributedRL\\restart_airsim_if_agent.ps1')
                 time.sleep(10)
 
+    def __new_car_client(self):
+        car_client = self.__car_client_factory()
+        car_client.confirmConnection()
+        return car_client
+
     # Appends a sample to a ring buffer.
     # If the appended example takes the size of the buffer over buffer_size, the example at the front will be removed.
     def __append_to_ring_buffer(self, item, buffer, buffer_size):
@@ -190,15 +358,54 @@ class DistributedAgent():
     
     # Runs an interation of data generation from AirSim.
     # Data will be saved in the replay memory.
+    # Returns the number of transitions that were recorded.
     def __run_airsim_epoch(self, always_random):
+        if (self.__vehicle_names is not None):
+            num_actions = self.__run_multi_vehicle_epoch(always_random)
+        else:
+            num_actions = self.__run_single_vehicle_epoch(always_random)
+        self.__num_transitions += num_actions
+        self.__instrumentation.count('transitions', num_actions)
+        self.__update_pending_priorities()
+        return num_actions
+
+    # The transitions recorded while driving only have a provisional priority. Their TD errors are computed here,
+    # at the end of the epoch while the car is stopped, in batched forward passes of priority_batch_size transitions,
+    # and become their priorities. With uniform_sampling, the priorities are never used, so they are not computed.
+    def __update_pending_priorities(self):
+        if self.__sample_randomly:
+            return
+        indices = self.__replay_memory.pending_indices()
+        if (len(indices) == 0):
+            return
+
+        start_time = time.time()
+        with self.__stats.timed('priorities'):
+            for start in range(0, len(indices), self.__priority_batch_size):
+                batch_indices = indices[start:start + self.__priority_batch_size]
+                batches = self.__replay_memory.gather(batch_indices, latest_only=True)
+                q_taken, td_errors = self.__model.compute_td_errors(batches, self.__priority_batch_size)
+                self.__replay_memory.update_priorities(batch_indices, td_errors, predicted_rewards=q_taken)
+        elapsed = time.time() - start_time
+        print('Computed the priorities of {0} transitions in {1:.1f} ms ({2:.1f} ms per thousand transitions)'.format(
+            len(indices), 1000 * elapsed, 1e6 * elapsed / len(indices)))
+
+    def __run_single_vehicle_epoch(self, always_random):
         print('Running AirSim epoch.')
+
+        # If the trainer sent us an epsilon with the last model, allow it to override our local value
+        trainer_epsilon = self.__trainer_epsilon
+        if (trainer_epsilon is not None):
+            print('Overriding local epsilon with {0}, which was sent from trainer'.format(trainer_epsilon))
+            self.__epsilon = trainer_epsilon
+            self.__trainer_epsilon = None
         
         # Pick a random starting point on the roads
         starting_points, starting_direction = self.__get_next_starting_point()
         
         # Initialize the state buffer.
         # For now, save 4 images at 0.01 second intervals.
-        state_buffer_len = 4
+        state_buffer_len = self.__replay_memory.history_length
         state_buffer = []
         wait_delta_sec = 0.01
 
@@ -208,203 +415,325 @@ class DistributedAgent():
         self.__car_client.setCarControls(self.__car_controls)
         time.sleep(2)
         
+        # Release the brake and start the car rolling, otherwise every episode ends at once on the speed < 2 check.
         # While the car is rolling, start initializing the state buffer
+        self.__car_controls.throttle = 1
+        self.__car_controls.brake = 0
+        self.__car_client.setCarControls(self.__car_controls)
         stop_run_time =datetime.datetime.now() + datetime.timedelta(seconds=2)
         while(datetime.datetime.now() < stop_run_time):
             time.sleep(wait_delta_sec)
             state_buffer = self.__append_to_ring_buffer(self.__get_image(), state_buffer, state_buffer_len)
+
+        # From now on, every frame goes into the replay memory's frame store exactly once.
+        # The state buffer only tracks the ids of the frames that make up the current state.
+        state_buffer = [self.__replay_memory.add_frame(frame) for frame in state_buffer]
         done = False
-        actions = [] #records the state we go to
-        pre_states = []
-        post_states = []
-        rewards = []
-        predicted_rewards = []
-        car_state = self.__car_client.getCarState()
+        num_actions = 0
 
         start_time = datetime.datetime.utcnow()
         end_time = start_time + datetime.timedelta(seconds=self.__max_epoch_runtime_sec)
         
         num_random = 0
-        far_off = False
         
-        # Main data collection loop
+        # Main data collection loop.
+        # Each step observes the outcome of the previous action, picks the next action and stores the previous transition.
+        # The control loop paces the steps and fetches the image, car state and collision info of each step concurrently.
+        control_loop = self.__control_loop
+        control_loop.start()
+        previous_step = None
         while not done:
-            collision_info = self.__car_client.simGetCollisionInfo()
+            with self.__stats.timed('capture'):
+                observation = control_loop.observe()
+                frame = decode_scene_image(observation.image_response)
             utc_now = datetime.datetime.utcnow()
+            car_state = observation.car_state
+            with self.__stats.timed('replay_add'):
+                frame_id = self.__replay_memory.add_frame(frame)
+            state_buffer = self.__append_to_ring_buffer(frame_id, state_buffer, state_buffer_len)
+
+            # Observe the outcome of the previous action and compute its reward
+            transition = None
+            far_off = False
+            if (previous_step is not None):
+                pre_state, action = previous_step
+                with self.__stats.timed('reward'):
+                    reward, far_off = self.__compute_reward(observation.collision_info, car_state)
+                transition = (pre_state + [frame_id], action, reward)
             
             # Check for terminal conditions:
             # 1) Car has collided
             # 2) Car is stopped
             # 3) The run has been running for longer than max_epoch_runtime_sec. 
             # 4) The car has run off the road
-            if (collision_info.has_collided or car_state.speed < 2 or far_off): # or utc_now > end_time or far_off):
-                self.__car_client.reset()
-                sys.stderr.flush()
-            else:
-
+            terminal = (observation.collision_info.has_collided or car_state.speed < 2 or far_off) # or utc_now > end_time or far_off)
+            if not terminal:
                 # The Agent should occasionally pick random action instead of best action
                 do_greedy = np.random.random_sample()
-                pre_state = copy.deepcopy(state_buffer)
+                pre_state = list(state_buffer)
                 if (do_greedy < self.__epsilon or always_random):
                     num_random += 1
                     next_state = self.__model.get_random_state()
-                    predicted_reward = 0
                     
                 else:
-                    next_state, predicted_reward = self.__model.predict_state(pre_state)
+                    with self.__stats.timed('predict'):
+                        next_state, _ = self.__model.predict_state(self.__replay_memory.get_frames(pre_state))
                     print('Model predicts {0}'.format(next_state))
 
                 # Convert the selected state to a control signal
-                next_control_signals = self.__model.state_to_control_signals(next_state, self.__car_client.getCarState())
-
-                # Take the action
-                self.__car_controls.steering = next_control_signals[0]
-                self.__car_controls.throttle = next_control_signals[1]
-                self.__car_controls.brake = next_control_signals[2]
-                self.__car_client.setCarControls(self.__car_controls)
-                
-                # Wait for a short period of time to see outcome
-                time.sleep(wait_delta_sec)
-
-                # Observe outcome and compute reward from action
-                state_buffer = self.__append_to_ring_buffer(self.__get_image(), state_buffer, state_buffer_len)
-                car_state = self.__car_client.getCarState()
-                collision_info = self.__car_client.simGetCollisionInfo()
-                reward, far_off = self.__compute_reward(collision_info, car_state)
-                
-                # Add the experience to the set of examples from this iteration
-                pre_states.append(pre_state)
-                post_states.append(state_buffer)
-                rewards.append(reward)
-                predicted_rewards.append(predicted_reward)
-                actions.append(next_state)
+                next_control_signals = self.__model.state_to_control_signals(next_state, car_state)
+
+                # Take the action. The controls are sent in the background.
+                self.__car_controls = airsim.CarControls(throttle=next_control_signals[1], steering=next_control_signals[0], brake=next_control_signals[2])
+                control_loop.apply(self.__car_controls)
+                previous_step = (pre_state, next_state)
+
+            # Add the previous experience directly to the replay memory. Its priority is computed at the end of the epoch.
+            if (transition is not None):
+                with self.__stats.timed('replay_add'):
+                    self.__replay_memory.add(*transition)
+                num_actions += 1
+
+            if terminal:
+                control_loop.stop()
+                self.__car_client.reset()
+                sys.stderr.flush()
+                done = True
+            else:
+                # Wait for the next control period to see the outcome
+                control_loop.wait_for_next_tick()
+
+        print('Control loop: {0}'.format(self.__stats.summary_line()))
 
         # Only the last state is a terminal state.
-        is_not_terminal = [1 for i in range(0, len(actions)-1, 1)]
-        is_not_terminal.append(0)
-        
-        # Add all of the states from this iteration to the replay memory
-        self.__add_to_replay_memory('pre_states', pre_states)
-        self.__add_to_replay_memory('post_states', post_states)
-        self.__add_to_replay_memory('actions', actions)
-        self.__add_to_replay_memory('rewards', rewards)
-        self.__add_to_replay_memory('predicted_rewards', predicted_rewards)
-        self.__add_to_replay_memory('is_not_terminal', is_not_terminal)
+        if (num_actions > 0):
+            self.__replay_memory.mark_last_terminal()
         
         # If we are in the main loop, reduce the epsilon parameter so that the model will be called more often
         if not always_random:
             self.__epsilon -= self.__per_iter_epsilon_reduction
             self.__epsilon = max(self.__epsilon, self.__min_epsilon)
         
-        return self.__experiences, len(actions)
+        self.__instrumentation.count('episodes')
+        return num_actions
 
-    # Adds a set of examples to the replay memory
-    def __add_to_replay_memory(self, field_name, data):
-        if field_name not in self.__experiences:
-            self.__experiences[field_name] = data
-        else:
-            self.__experiences[field_name] += data
-            start_index = max(0, len(self.__experiences[field_name]) - self.__replay_memory_size)
-            self.__experiences[field_name] = self.__experiences[field_name][start_index:]
+    # Runs the vehicles in vehicle_names until as many episodes have ended as there are vehicles.
+    # Data will be saved in the replay memory.
+    # Returns the number of transitions that were recorded.
+    #
+    # Every step observes all of the vehicles at once. The vehicles that act greedily share one batched prediction,
+    # and the controls of all vehicles are sent together. A vehicle whose episode ends is put back where it started and
+    # warms up again while the others keep driving, so the vehicles' episodes are not in step. Each vehicle has its own
+    # epsilon, which decays at the end of each of its episodes, and its state carries over to the next epoch.
+    def __run_multi_vehicle_epoch(self, always_random):
+        print('Running AirSim epoch with {0} vehicles.'.format(len(self.__vehicle_names)))
+        control_loop = self.__control_loop
+        state_buffer_len = self.__replay_memory.history_length
+
+        # The vehicles drive for 2 seconds before their episode starts, like the single vehicle does.
+        # That also fills their state buffers.
+        warmup_steps = max(state_buffer_len, int(2 * self.__control_frequency_hz))
+
+        if (self.__vehicles is None):
+            self.__vehicles = []
+            for vehicle_name in self.__vehicle_names:
+                vehicle = VehicleState(vehicle_name, self.__epsilon)
+                vehicle.start_pose = self.__car_client.simGetVehiclePose(vehicle_name)
+                vehicle.warmup_steps_left = warmup_steps
+                self.__vehicles.append(vehicle)
+
+        # If the trainer sent us an epsilon with the last model, allow it to override the vehicles' local values
+        trainer_epsilon = self.__trainer_epsilon
+        if (trainer_epsilon is not None):
+            print('Overriding local epsilon with {0}, which was sent from trainer'.format(trainer_epsilon))
+            for vehicle in self.__vehicles:
+                vehicle.epsilon = trainer_epsilon
+            self.__trainer_epsilon = None
+
+        num_actions = 0
+        num_episodes_ended = 0
+        control_loop.start()
+        while (num_episodes_ended < len(self.__vehicles)):
+            with self.__stats.timed('capture'):
+                observations = control_loop.observe_all()
+                frames = [decode_scene_image(observation.image_response) for observation in observations]
+            car_controls = [None] * len(self.__vehicles)
+            transitions = []
+            greedy_vehicles = []
+
+            for i, (vehicle, observation, frame) in enumerate(zip(self.__vehicles, observations, frames)):
+                with self.__stats.timed('replay_add'):
+                    frame_id = self.__replay_memory.add_frame(frame)
+                vehicle.state_buffer = self.__append_to_ring_buffer(frame_id, vehicle.state_buffer, state_buffer_len)
+                car_state = observation.car_state
+
+                if (vehicle.warmup_steps_left > 0):
+                    vehicle.warmup_steps_left -= 1
+                    car_controls[i] = airsim.CarControls(throttle=1, steering=0, brake=0)
+                    continue
+
+                # Observe the outcome of the previous action and compute its reward.
+                # A collision is only new if it happened after the one that ended the vehicle's last episode.
+                has_collided = observation.collision_info.has_collided and getattr(observation.collision_info, 'time_stamp', None) != vehicle.last_collision_time_stamp
+                far_off = False
+                if (vehicle.previous_step is not None):
+                    pre_state, action = vehicle.previous_step
+                    with self.__stats.timed('reward'):
+                        reward, far_off = self.__compute_reward(types.SimpleNamespace(has_collided=has_collided), car_state)
+
+                terminal = (has_collided or car_state.speed < 2 or far_off)
+                if (vehicle.previous_step is not None):
+                    transitions.append((pre_state + [frame_id], action, reward, 0 if terminal else 1))
+
+                if terminal:
+                    num_episodes_ended += 1
+                    vehicle.end_episode(getattr(observation.collision_info, 'time_stamp', None))
+                    self.__instrumentation.count('episodes')
+                    if not always_random:
+                        vehicle.epsilon = max(vehicle.epsilon - self.__per_iter_epsilon_reduction, self.__min_epsilon)
+
+                    # Put the vehicle back where it started. It warms up again before its next episode.
+                    self.__car_client.simSetVehiclePose(vehicle.start_pose, True, vehicle.name)
+                    vehicle.warmup_steps_left = warmup_steps
+                    car_controls[i] = airsim.CarControls(throttle=0, steering=0, brake=1)
+                elif (always_random or np.random.random_sample() < vehicle.epsilon):
+                    next_state = self.__model.get_random_state()
+                    car_controls[i] = self.__to_car_controls(next_state, car_state)
+                    vehicle.previous_step = (list(vehicle.state_buffer), next_state)
+                else:
+                    greedy_vehicles.append((i, frame, car_state))
+
+            # One prediction for all of the vehicles that act greedily
+            if (len(greedy_vehicles) > 0):
+                with self.__stats.timed('predict'):
+                    next_states, _ = self.__model.predict_states([frame for _, frame, _ in greedy_vehicles])
+                for (i, _, car_state), next_state in zip(greedy_vehicles, next_states):
+                    car_controls[i] = self.__to_car_controls(next_state, car_state)
+                    self.__vehicles[i].previous_step = (list(self.__vehicles[i].state_buffer), next_state)
+
+            control_loop.apply_all(car_controls)
+
+            # Add the previous experiences directly to the replay memory while the controls are sent.
+            # Their priorities are computed at the end of the epoch.
+            with self.__stats.timed('replay_add'):
+                for frame_ids, action, reward, is_not_terminal in transitions:
+                    self.__replay_memory.add(frame_ids, action, reward, is_not_terminal=is_not_terminal)
+                    num_actions += 1
+
+            control_loop.wait_for_next_tick()
+
+        control_loop.stop()
+        print('Control loop: {0}'.format(self.__stats.summary_line()))
+        print('Vehicle epsilons: {0}'.format(', '.join('{0} {1:.3f}'.format(v.name, v.epsilon) for v in self.__vehicles)))
+        return num_actions
+
+    # Converts a selected state to the controls of a vehicle
+    def __to_car_controls(self, state, car_state):
+        next_control_signals = self.__model.state_to_control_signals(state, car_state)
+        return airsim.CarControls(throttle=next_control_signals[1], steering=next_control_signals[0], brake=next_control_signals[2])
 
     # Sample experiences from the replay memory
-    def __sample_experiences(self, experiences, frame_count, sample_randomly):
-        sampled_experiences = {}
-        sampled_experiences['pre_states'] = []
-        sampled_experiences['post_states'] = []
-        sampled_experiences['actions'] = []
-        sampled_experiences['rewards'] = []
-        sampled_experiences['predicted_rewards'] = []
-        sampled_experiences['is_not_terminal'] = []
-
-        # Compute the surprise factor, which is the difference between the predicted an the actual Q value for each state.
+    def __sample_experiences(self, frame_count, sample_randomly):
+        if (len(self.__replay_memory) < self.__batch_size):
+            return {}
+
+        # The replay memory keeps the surprise factor of each state, which is the difference between the predicted and the actual Q value, in a sum-tree.
         # We can use that to weight examples so that we are more likely to train on examples that the model got wrong.
-        suprise_factor = np.abs(np.array(experiences['rewards'], dtype=np.dtype(float)) - np.array(experiences['predicted_rewards'], dtype=np.dtype(float)))
-        suprise_factor_normalizer = np.sum(suprise_factor)
-        suprise_factor /= float(suprise_factor_normalizer)
-
-        # Generate one minibatch for each frame of the run
-        for _ in range(0, frame_count, 1):
-            if sample_randomly:
-                idx_set = set(np.random.choice(list(range(0, suprise_factor.shape[0], 1)), size=(self.__batch_size), replace=False))
-            else:
-                idx_set = set(np.random.choice(list(range(0, suprise_factor.shape[0], 1)), size=(self.__batch_size), replace=False, p=suprise_factor))
-        
-            sampled_experiences['pre_states'] += [experiences['pre_states'][i] for i in idx_set]
-            sampled_experiences['post_states'] += [experiences['post_states'][i] for i in idx_set]
-            sampled_experiences['actions'] += [experiences['actions'][i] for i in idx_set]
-            sampled_experiences['rewards'] += [experiences['rewards'][i] for i in idx_set]
-            sampled_experiences['predicted_rewards'] += [experiences['predicted_rewards'][i] for i in idx_set]
-            sampled_experiences['is_not_terminal'] += [experiences['is_not_terminal'][i] for i in idx_set]
-            
-        return sampled_experiences
+        # One minibatch is generated for each frame of the run, and all of them are drawn in a single pass.
+        try:
+            idx = self.__replay_memory.sample_indices(frame_count * self.__batch_size, not sample_randomly)
+        except IndexError as e:
+            print('Not training on this epoch: {0}'.format(e))
+            return {}
+        # The model only looks at the latest frame of each state, so don't gather the full stacks
+        return self.__replay_memory.gather(idx, latest_only=True)
         
      
+    # Hands the minibatches of an epoch to the publisher thread.
+    # If too many updates are already outstanding, the minibatches are dropped rather than making the car wait:
+    # the experiences stay in the replay memory and will be sampled again.
+    def __queue_batch_for_publishing(self, batches, batches_count):
+        outstanding = self.__publish_queue.unfinished_tasks
+        if (outstanding >= self.__max_outstanding_updates):
+            self.__num_skipped_publishes += 1
+            self.__instrumentation.count('skipped_publishes')
+            print('{0} updates outstanding, not publishing this epoch ({1} skipped so far).'.format(outstanding, self.__num_skipped_publishes))
+            return
+
+        print('Publishing AirSim Epoch.')
+        self.__publish_queue.put((batches, batches_count))
+
+    # Runs on the publisher thread: trains on the queued minibatches and exchanges the update with the trainer, one epoch at a time.
+    # The new weights are swapped in from this thread as well. RlModel does the swap under its lock, so the driving loop
+    # always predicts with either the old or the new weights, and the next training iteration starts from the new ones.
+    def __publisher_function(self):
+        while True:
+            batches, batches_count = self.__publish_queue.get()
+            try:
+                self.__publish_batch_and_update_model(batches, batches_count)
+            except Exception as e:
+                print('Failed to publish epoch data. Message is {0}'.format(e))
+                self.__instrumentation.count('failed_publishes')
+            finally:
+                self.__publish_queue.task_done()
+
     # Train the model on minibatches and post to the trainer node.
     def __publish_batch_and_update_model(self, batches, batches_count):
         # Train and get the gradients
         print('Publishing epoch data and getting latest model from parameter server...')
-        gradients = self.__model.get_gradient_update_from_batches(batches)
-        
-        # Post the data to the trainer node
-        if not self.__local_run:
-            post_data = {}
-            post_data['gradients'] = gradients
-            post_data['batch_count'] = batches_count
-            
-            response = requests.post('http://{0}:80/gradient_update'.format(self.__trainer_ip_address), json=post_data)
-            print('Response:')
-            print(response)
+        with self.__stats.timed('train'):
+            gradients = self.__model.get_gradient_update_from_batches(batches)
+
+        # Post the data to the trainer node, or update the critic and checkpoint on a local run
+        with self.__stats.timed('publish'):
+            if not self.__local_run:
+                if (self.__gradient_compressor is not None):
+                    compress_start = time.time()
+                    with self.__instrumentation.timer('compress_gradients_seconds'):
+                        post_data = self.__gradient_compressor.compress(gradients)
+                    print('Compressed gradients in {0:.1f} ms'.format(1000 * (time.time() - compress_start)))
+                else:
+                    post_data = {}
+                    post_data['gradients'] = gradients
+                post_data['batch_count'] = batches_count
+                self.__instrumentation.count('published_batches', batches_count)
 
-            new_model_parameters = response.json()
-            
-            # Update the existing model with the new parameters
-            self.__model.from_packet(new_model_parameters)
-            
-            #If the trainer sends us a epsilon, allow it to override our local value
-            if ('epsilon' in new_model_parameters):
-                new_epsilon = float(new_model_parameters['epsilon'])
-                print('Overriding local epsilon with {0}, which was sent from trainer'.format(new_epsilon))
-                self.__epsilon = new_epsilon
-                
-        else:
-            if (self.__num_batches_run > self.__batch_update_frequency + self.__last_checkpoint_batch_count):
-                self.__model.update_critic()
-                
-                checkpoint = {}
-                checkpoint['model'] = self.__model.to_packet(get_target=True)
-                checkpoint['batch_count'] = batches_count
-                checkpoint_str = json.dumps(checkpoint)
-
-                checkpoint_dir = os.path.join(os.path.join(self.__data_dir, 'checkpoint'), self.__experiment_name)
-                
-                if not os.path.isdir(checkpoint_dir):
-                    try:
-                        os.makedirs(checkpoint_dir)
-                    except OSError as e:
-                        if e.errno != errno.EEXIST:
-                            raise
-                            
-                file_name = os.path.join(checkpoint_dir,'{0}.json'.format(self.__num_batches_run)) 
-                with open(file_name, 'w') as f:
+                new_model_parameters = self.__trainer_client.post_packet('gradient_update', post_data)
+
+                # Update the existing model with the new parameters
+                self.__model.from_packet(new_model_parameters)
+
+                #If the trainer sends us a epsilon, the driving loop will use it from the next epoch on
+                if ('epsilon' in new_model_parameters):
+                    self.__trainer_epsilon = float(new_model_parameters['epsilon'])
+
+            else:
+                if (self.__num_batches_run > self.__batch_update_frequency + self.__last_checkpoint_batch_count):
+                    self.__model.update_critic()
+
+                    checkpoint = self.__model.to_packet(get_target=True)
+                    checkpoint['batch_count'] = batches_count
+                    file_name = self.__checkpoints.save('{0}'.format(self.__num_batches_run), checkpoint)
                     print('Checkpointing to {0}'.format(file_name))
-                    f.write(checkpoint_str)
-                
-                self.__last_checkpoint_batch_count = self.__num_batches_run
-                
+                    self.__instrumentation.count('checkpoints')
+
+                    self.__last_checkpoint_batch_count = self.__num_batches_run
+
     # Gets the latest model from the trainer node
+    # Nothing is downloaded if we already have the latest version, and only the changed tensors otherwise
     def __get_latest_model(self):
         print('Getting latest model from parameter server...')
-        response = requests.get('http://{0}:80/latest'.format(self.__trainer_ip_address)).json()
-        self.__model.from_packet(response)
+        packet = self.__trainer_client.get_latest()
+        if (packet is None):
+            print('Model is up to date (version {0})'.format(self.__trainer_client.model_version))
+            return
+        self.__model.from_packet(packet)
 
     # Gets an image from AirSim
+    # The frame is a uint8 view on the response, it is copied once when it is added to the replay memory
     def __get_image(self):
         image_response = self.__car_client.simGetImages([ImageRequest(0, AirSimImageType.Scene, False, False)])[0]
-        image1d = np.fromstring(image_response.image_data_uint8, dtype=np.uint8)
-        image_rgba = image1d.reshape(108,256,4)
-        image_resized = image_rgba[49:108,0:255,0:3].astype(float)
-        return image_resized
+        return decode_scene_image(image_response)
 
     # Computes the reward functinon based on the car position.
     def __compute_reward(self, collision_info, car_state):
@@ -432,17 +761,8 @@ class DistributedAgent():
         car_point = np.array([car_state.kinematics_estimated.position.x_val, car_state.kinematics_estimated.position.y_val, 0])
         
         # Distance component is exponential distance to nearest line
-        distance = 999
-        
-        #Compute the distance to the nearest center line
-        for line in self.__reward_points:
-            local_distance = 0
-            length_squared = ((line[0][0]-line[1][0])**2) + ((line[0][1]-line[1][1])**2)
-            if (length_squared != 0):
-                t = max(0, min(1, np.dot(car_point-line[0], line[1]-line[0]) / length_squared))
-                proj = line[0] + (t * (line[1]-line[0]))
-                local_distance = np.linalg.norm(proj - car_point)
-            distance = min(local_distance, distance)
+        # Look up the distance to the nearest center line in the precomputed distance field
+        distance = self.__distance_field.distance(car_point[0], car_point[1])
             
         distance_reward = math.exp(-(distance * DISTANCE_DECAY_RATE))
         if(distance_reward<THRESH_DIST):
@@ -470,14 +790,10 @@ class DistributedAgent():
                 point[1] /= 100
               
     # Initializes the points used for determining the optimal position of the vehicle during the reward function
+    # The center lines are rasterized into a distance field, which is cached in (data_dir)/cache between runs
     def __init_reward_points(self):
-        self.__reward_points = []
-        with open(os.path.join(os.path.join(self.__data_dir, 'data'), 'reward_points.txt'), 'r') as f:
-            for line in f:
-                point_values = line.split('\t')
-                first_point = np.array([float(point_values[0]), float(point_values[1]), 0])
-                second_point = np.array([float(point_values[2]), float(point_values[3]), 0])
-                self.__reward_points.append(tuple((first_point, second_point)))
+        reward_points_file = os.path.join(os.path.join(self.__data_dir, 'data'), 'reward_points.txt')
+        self.__distance_field = distance_field.load_or_build(reward_points_file, os.path.join(self.__data_dir, 'cache'))
 
     # Randomly selects a starting point on the road
     # Used for initializing an iteration of data generation from AirSim
@@ -518,45 +834,46 @@ class DistributedAgent():
                 if e.errno != errno.EEXIST:
                     raise
 
-# Parse the command line parameters
-parameters = {}
-for arg in sys.argv:
-    if '=' in arg:
-        args = arg.split('=')
-        print('0: {0}, 1: {1}'.format(args[0], args[1]))
-        parameters[args[0].replace('--', '')] = args[1]
-    if arg.replace('-', '') == 'local_run':
-        parameters['local_run'] = True
-
-#Make the debug statements easier to read
-np.set_printoptions(threshold=sys.maxsize, suppress=True)
-
-# Check additional parameters needed for local run
-if 'local_run' in parameters:
-    if 'airsim_path' not in parameters:
-        print('ERROR: for a local run, airsim_path must be defined.')
-        print('Please provide the path to airsim in a parameter like "airsim_path=<path_to_airsim>"')
-        print('It should point to the folder containing AD_Cookbook_Start_AirSim.ps1')
-        sys.exit()
-    if 'batch_update_frequency' not in parameters:
-        print('ERROR: for a local run, batch_update_frequency must be defined.')
-        print('Please provide the path to airsim in a parameter like "batch_update_frequency=<int>"')
-        sys.exit()
-
-print('------------STARTING AGENT----------------')
-print(parameters)
-
-print('***')
-print(os.environ)
-print('***')
-
-# Identify the node as an agent and start AirSim
-if 'local_run' not in parameters:
-    os.system('echo 1 >> D:\\agent.agent')
-    os.system('START "" powershell.exe D:\\AD_Cookbook_AirSim\\Scripts\\DistributedRL\\restart_airsim_if_agent.ps1')
-else:
-    os.system('START "" powershell.exe {0}'.format(os.path.join(parameters['airsim_path'], 'AD_Cookbook_Start_AirSim.ps1 neighborhood -windowed')))
-    
-# Start the training
-agent = DistributedAgent(parameters)
-agent.start()
+if __name__ == '__main__':
+    # Parse the command line parameters
+    parameters = {}
+    for arg in sys.argv:
+        if '=' in arg:
+            args = arg.split('=')
+            print('0: {0}, 1: {1}'.format(args[0], args[1]))
+            parameters[args[0].replace('--', '')] = args[1]
+        if arg.replace('-', '') == 'local_run':
+            parameters['local_run'] = True
+
+    #Make the debug statements easier to read
+    np.set_printoptions(threshold=sys.maxsize, suppress=True)
+
+    # Check additional parameters needed for local run
+    if 'local_run' in parameters:
+        if 'airsim_path' not in parameters:
+            print('ERROR: for a local run, airsim_path must be defined.')
+            print('Please provide the path to airsim in a parameter like "airsim_path=<path_to_airsim>"')
+            print('It should point to the folder containing AD_Cookbook_Start_AirSim.ps1')
+            sys.exit()
+        if 'batch_update_frequency' not in parameters:
+            print('ERROR: for a local run, batch_update_frequency must be defined.')
+            print('Please provide the path to airsim in a parameter like "batch_update_frequency=<int>"')
+            sys.exit()
+
+    print('------------STARTING AGENT----------------')
+    print(parameters)
+
+    print('***')
+    print(os.environ)
+    print('***')
+
+    # Identify the node as an agent and start AirSim
+    if 'local_run' not in parameters:
+        os.system('echo 1 >> D:\\agent.agent')
+        os.system('START "" powershell.exe D:\\AD_Cookbook_AirSim\\Scripts\\DistributedRL\\restart_airsim_if_agent.ps1')
+    else:
+        os.system('START "" powershell.exe {0}'.format(os.path.join(parameters['airsim_path'], 'AD_Cookbook_Start_AirSim.ps1 neighborhood -windowed')))
+
+    # Start the training
+    agent = DistributedAgent(parameters)
+    agent.start()
@@ -0,0 +1,502 @@
+import numpy as np
+import tracemalloc
+import time
+import sys
+from camera_frames import decode_scene_image
+from control_loop import ControlLoop, LatencyStats
+from fake_car_client import FakeCarSimulator, FakeCarClient, FakeCarControls
+import distance_field
+import tempfile
+from replay_memory import ReplayMemory
+from instrumentation import peak_rss_mb
+from gradient_compression import GradientCompressor, decompress
+import model_packet
+from replay_snapshot import ReplaySnapshotWriter, load_latest_snapshot, list_snapshots, snapshot_size
+import os
+import json
+import datetime
+import platform
+
+# Micro-benchmarks for the DQN agent stack. None of them need AirSim.
+# The ones that need TensorFlow import rl_model themselves, so the others run without it.
+# With output=<file>, the results are also written to a JSON file along with the parameters and the time of the run.
+#
+# Usage: python benchmark.py <benchmark> [name=value ...] [output=<file>]
+#   agent        runs DistributedAgent end to end against a fake AirSim, and reports the steps per second, the time spent
+#                in each stage and the peak RSS
+#   train_step   compares the fused train step with the Keras predict/predict/fit path, in training steps per second
+#   frame_path   compares the per-frame time and allocations of the old float64 camera frame decoding with the uint8 view
+#   predict_state compares the latency of the predict step with Keras predict for a single state, and checks that they agree
+#   multi_vehicle measures the transitions per second of the multi-vehicle control loop for 1 to vehicles vehicles,
+#                against a fake AirSim instance that serves a limited number of calls at once
+#   replay_sampling compares the sampling throughput of the in-memory and the memory-mapped replay memory at several sizes
+#   priorities   reports the cost per thousand transitions of computing the priorities of new transitions in batched
+#                forward passes, against batches of one (what computing them at every step would cost)
+#   replay_snapshot reports the size, write time and restore time of a replay memory snapshot
+#   reward_distance compares the per-segment loop of the reward function with the distance field lookup, and reports the lookup error
+#   compression  round-trips weight deltas of several magnitudes through compression, the binary encoding and back, for
+#                each wire dtype and compression setting, and checks the decoding error and that error feedback keeps up
+#   control_loop compares the control rate of sequential AirSim RPCs with the pipelined ControlLoop, against a fake CarClient with injected latency
+
+# Random examples shaped like the ones gathered from the replay memory (latest frame only)
+def make_batches(count):
+    batches = {}
+    batches['pre_states'] = np.random.randint(0, 256, size=(count, 59, 255, 3), dtype=np.uint8)
+    batches['post_states'] = np.random.randint(0, 256, size=(count, 59, 255, 3), dtype=np.uint8)
+    batches['actions'] = np.random.randint(0, 5, size=count).astype(np.int8)
+    batches['rewards'] = np.random.random_sample(count).astype(np.float32)
+    batches['predicted_rewards'] = np.zeros(count, dtype=np.float32)
+    batches['is_not_terminal'] = (np.random.random_sample(count) > 0.05).astype(np.float32)
+    return batches
+
+def benchmark_train_step(parameters):
+    from rl_model import RlModel
+    train_batch_size = int(parameters.get('train_batch_size', 32))
+    num_steps = int(parameters.get('steps', 50))
+    model = RlModel(None, True, train_batch_size)
+    batches = make_batches(train_batch_size * num_steps)
+
+    results = {}
+    for name, use_fused_train_step in [('keras_fit', False), ('fused', True)]:
+        # Warm up, the first call builds the Keras train and predict functions
+        model.get_gradient_update_from_batches(make_batches(train_batch_size), use_fused_train_step=use_fused_train_step)
+
+        start = time.time()
+        model.get_gradient_update_from_batches(batches, use_fused_train_step=use_fused_train_step)
+        elapsed = time.time() - start
+        results[name] = num_steps / elapsed
+
+    for name, steps_per_second in results.items():
+        print('{0}: {1:.2f} train steps/s (batch size {2})'.format(name, steps_per_second, train_batch_size))
+    print('speedup: {0:.2f}x'.format(results['fused'] / results['keras_fit']))
+    return results
+
+def benchmark_predict_state(parameters):
+    from rl_model import RlModel
+    num_predictions = int(parameters.get('predictions', 500))
+    model = RlModel(None, True)
+    states = np.random.randint(0, 256, size=(num_predictions, 4, 59, 255, 3), dtype=np.uint8)
+
+    results = {}
+    predictions = {}
+    for name, use_predict_step in [('keras_predict', False), ('predict_step', True)]:
+        # Warm up, the first Keras predict builds the predict function
+        model.predict_state(states[0], use_predict_step=use_predict_step)
+
+        latencies = []
+        predictions[name] = []
+        for i in range(0, num_predictions, 1):
+            start = time.time()
+            predictions[name].append(model.predict_state(states[i], use_predict_step=use_predict_step))
+            latencies.append(time.time() - start)
+
+        latencies_ms = 1000 * np.array(latencies)
+        results[name] = {'p50_ms': float(np.percentile(latencies_ms, 50)), 'p99_ms': float(np.percentile(latencies_ms, 99))}
+        print('{0}: p50 {1:.2f} ms, p99 {2:.2f} ms'.format(name, results[name]['p50_ms'], results[name]['p99_ms']))
+
+    same_actions = all(a[0] == b[0] for a, b in zip(predictions['keras_predict'], predictions['predict_step']))
+    max_q_difference = max(abs(float(a[1]) - float(b[1])) for a, b in zip(predictions['keras_predict'], predictions['predict_step']))
+    results['same_actions'] = same_actions
+    results['max_q_difference'] = max_q_difference
+    print('same actions: {0}, max Q value difference: {1:.3g}'.format(same_actions, max_q_difference))
+    return results
+
+# The nearest center line distance as the reward function computed it before distance_field.py
+def loop_distance(car_point, reward_points):
+    distance = 999
+    for line in reward_points:
+        local_distance = 0
+        length_squared = ((line[0][0]-line[1][0])**2) + ((line[0][1]-line[1][1])**2)
+        if (length_squared != 0):
+            t = max(0, min(1, np.dot(car_point-line[0], line[1]-line[0]) / length_squared))
+            proj = line[0] + (t * (line[1]-line[0]))
+            local_distance = np.linalg.norm(proj - car_point)
+        distance = min(local_distance, distance)
+    return distance
+
+def benchmark_reward_distance(parameters):
+    num_lookups = int(parameters.get('lookups', 2000))
+    resolution = float(parameters.get('resolution', 0.25))
+
+    # A grid of roads over a 300 m x 300 m map, like the neighborhood
+    lines = []
+    for i in range(0, 7, 1):
+        for j in range(0, 6, 1):
+            lines.append('{0}\t{1}\t{2}\t{3}'.format(50 * j, 50 * i, 50 * (j + 1), 50 * i))
+            lines.append('{0}\t{1}\t{2}\t{3}'.format(50 * i, 50 * j, 50 * i, 50 * (j + 1)))
+    segments = np.array([[float(v) for v in line.split('\t')] for line in lines]).reshape(-1, 2, 2)
+    reward_points = [(np.array([s[0][0], s[0][1], 0]), np.array([s[1][0], s[1][1], 0])) for s in segments]
+    points = np.random.uniform(-30, 330, size=(num_lookups, 2))
+
+    results = {'num_segments': len(lines)}
+    with tempfile.TemporaryDirectory() as directory:
+        points_file = os.path.join(directory, 'reward_points.txt')
+        with open(points_file, 'w') as f:
+            f.write('\n'.join(lines))
+        for name in ['build_seconds', 'cached_load_seconds']:
+            start = time.time()
+            field = distance_field.load_or_build(points_file, os.path.join(directory, 'cache'), resolution)
+            results[name] = time.time() - start
+
+    start = time.time()
+    loop_distances = [loop_distance(np.array([x, y, 0]), reward_points) for x, y in points]
+    results['loop_us_per_lookup'] = 1e6 * (time.time() - start) / num_lookups
+
+    start = time.time()
+    field_distances = [field.distance(x, y) for x, y in points]
+    results['field_us_per_lookup'] = 1e6 * (time.time() - start) / num_lookups
+    results['max_error'] = float(np.max(np.abs(np.array(field_distances) - np.array(loop_distances))))
+
+    print('{0} segments, grid of {1} built in {2:.2f} s, loaded from cache in {3:.3f} s'.format(len(lines), field.grid.shape, results['build_seconds'], results['cached_load_seconds']))
+    print('per-segment loop: {0:.1f} us/lookup'.format(results['loop_us_per_lookup']))
+    print('distance field: {0:.1f} us/lookup, max error {1:.3f}'.format(results['field_us_per_lookup'], results['max_error']))
+    return results
+
+# Stands in for the response of simGetImages
+class FakeImageResponse():
+    def __init__(self, height=108, width=256, channels=4):
+        self.height = height
+        self.width = width
+        self.image_data_uint8 = np.random.randint(0, 256, size=height * width * channels, dtype=np.uint8).tobytes()
+
+# The frame decoding used before camera_frames.py: a copying decode, then a float64 copy of the crop
+def decode_scene_image_float64(image_response):
+    image1d = np.array(np.frombuffer(image_response.image_data_uint8, dtype=np.uint8))
+    image_rgba = image1d.reshape(108,256,4)
+    return image_rgba[49:108,0:255,0:3].astype(float)
+
+def benchmark_frame_path(parameters):
+    num_frames = int(parameters.get('frames', 2000))
+    response = FakeImageResponse()
+
+    results = {}
+    for name, decode in [('float64_copy', decode_scene_image_float64), ('uint8_view', decode_scene_image)]:
+        # The agent stacks each frame into a state before it is stored, which is when a view gets copied
+        start = time.time()
+        for _ in range(0, num_frames, 1):
+            np.ascontiguousarray(decode(response))
+        elapsed = time.time() - start
+
+        tracemalloc.start()
+        frame = np.ascontiguousarray(decode(response))
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = {'us_per_frame': 1e6 * elapsed / num_frames, 'bytes_allocated_per_frame': allocated, 'frame_bytes': frame.nbytes}
+        print('{0}: {1:.1f} us/frame, {2} bytes allocated per frame, {3} bytes kept per frame'.format(name, results[name]['us_per_frame'], allocated, frame.nbytes))
+    return results
+
+# One step of the driving loop before ControlLoop: every RPC waits for the previous one
+def run_sequential_step(car_client, predict_sec, wait_delta_sec):
+    stats = {}
+    start = time.time()
+    car_client.simGetCollisionInfo()
+    time.sleep(predict_sec)
+    car_client.getCarState()
+    car_client.setCarControls(FakeCarControls(throttle=0.5))
+    time.sleep(wait_delta_sec)
+    decode_scene_image(car_client.simGetImages([None])[0])
+    car_client.getCarState()
+    car_client.simGetCollisionInfo()
+    return time.time() - start
+
+def benchmark_control_loop(parameters):
+    latency_sec = float(parameters.get('latency_ms', 10)) / 1000
+    jitter_sec = float(parameters.get('jitter_ms', 2)) / 1000
+    predict_sec = float(parameters.get('predict_ms', 5)) / 1000
+    control_frequency_hz = float(parameters.get('control_frequency_hz', 20))
+    num_steps = int(parameters.get('steps', 100))
+
+    simulator = FakeCarSimulator(collide_after_steps=num_steps * 10)
+    new_client = lambda: FakeCarClient(simulator, latency_sec, jitter_sec)
+    results = {}
+
+    car_client = new_client()
+    start = time.time()
+    step_times = [run_sequential_step(car_client, predict_sec, 0.01) for _ in range(0, num_steps, 1)]
+    elapsed = time.time() - start
+    results['sequential'] = {'steps_per_second': num_steps / elapsed, 'p99_step_ms': 1000 * float(np.percentile(step_times, 99))}
+    print('sequential: {0:.1f} steps/s, p99 step {1:.1f} ms'.format(results['sequential']['steps_per_second'], results['sequential']['p99_step_ms']))
+
+    loop = ControlLoop(new_client, [None], control_frequency_hz, LatencyStats())
+    loop.start()
+    start = time.time()
+    for _ in range(0, num_steps, 1):
+        observation = loop.observe()
+        decode_scene_image(observation.image_response)
+        time.sleep(predict_sec)
+        loop.apply(FakeCarControls(throttle=0.5))
+        loop.wait_for_next_tick()
+    elapsed = time.time() - start
+    loop.close()
+    results['pipelined'] = {'steps_per_second': num_steps / elapsed, 'missed_deadlines': loop.stats.num_missed_deadlines, 'stages': loop.stats.summary()}
+    print('pipelined at {0:.0f} Hz: {1:.1f} steps/s'.format(control_frequency_hz, results['pipelined']['steps_per_second']))
+    print('  {0}'.format(loop.stats.summary_line()))
+    return results
+
+def benchmark_multi_vehicle(parameters):
+    max_vehicles = int(parameters.get('vehicles', 8))
+    latency_sec = float(parameters.get('latency_ms', 10)) / 1000
+    max_concurrent_calls = int(parameters.get('max_concurrent_calls', 12))
+    # The cost of a batched prediction: a fixed overhead plus a cost per state
+    predict_sec = float(parameters.get('predict_ms', 5)) / 1000
+    predict_per_state_sec = float(parameters.get('predict_per_state_ms', 0.5)) / 1000
+    num_steps = int(parameters.get('steps', 50))
+
+    results = {}
+    num_vehicles = 1
+    while num_vehicles <= max_vehicles:
+        simulator = FakeCarSimulator(collide_after_steps=num_steps * 10, max_concurrent_calls=max_concurrent_calls)
+        vehicle_names = ['Car{0}'.format(i) for i in range(0, num_vehicles, 1)]
+        # As fast as the loop can go
+        loop = ControlLoop(lambda: FakeCarClient(simulator, latency_sec), [None], 1000.0, LatencyStats(), vehicle_names)
+
+        loop.start()
+        start = time.time()
+        for _ in range(0, num_steps, 1):
+            frames = [decode_scene_image(observation.image_response) for observation in loop.observe_all()]
+            time.sleep(predict_sec + predict_per_state_sec * len(frames))
+            loop.apply_all([FakeCarControls(throttle=0.5) for _ in frames])
+            loop.wait_for_next_tick()
+        elapsed = time.time() - start
+        loop.close()
+
+        results[num_vehicles] = num_steps * num_vehicles / elapsed
+        print('{0} vehicles: {1:.1f} transitions/s ({2:.2f}x one vehicle)'.format(num_vehicles, results[num_vehicles], results[num_vehicles] / results[1]))
+        num_vehicles *= 2
+    return results
+
+def benchmark_replay_sampling(parameters):
+    sizes = [int(size) for size in parameters.get('sizes', '1000,5000,20000').split(',')]
+    batch_size = int(parameters.get('batch_size', 32))
+    num_batches = int(parameters.get('batches', 200))
+    frame = np.random.randint(0, 256, size=(59, 255, 3), dtype=np.uint8)
+
+    results = {}
+    for size in sizes:
+        results[size] = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, storage_dir in [('in_memory', None), ('memmap', directory)]:
+                memory = ReplayMemory(size, storage_dir=storage_dir)
+                start = time.time()
+                frame_ids = [memory.add_frame(frame) for _ in range(0, 4, 1)]
+                while len(memory) < size:
+                    frame_ids = frame_ids[1:] + [memory.add_frame(frame)]
+                    memory.add(frame_ids + [frame_ids[-1]], 0, 1.0, 0.0)
+                fill_seconds = time.time() - start
+
+                start = time.time()
+                for _ in range(0, num_batches, 1):
+                    memory.gather(memory.sample_indices(batch_size, True))
+                elapsed = time.time() - start
+                results[size][name] = {'batches_per_second': num_batches / elapsed, 'fill_seconds': fill_seconds}
+                print('{0} transitions, {1}: {2:.1f} batches/s of {3}, filled in {4:.2f} s'.format(size, name, num_batches / elapsed, batch_size, fill_seconds))
+                del memory
+    return results
+
+# Camera-like frames: smooth gradients with some noise, which compress about as well as the real thing
+def make_camera_frames(count):
+    rows = np.linspace(0, 1, 59)[:, np.newaxis, np.newaxis]
+    columns = np.linspace(0, 1, 255)[np.newaxis, :, np.newaxis]
+    colors = np.random.random_sample((count, 1, 1, 1, 3))
+    base = 255 * (0.5 * rows + 0.3 * columns) * (0.5 + 0.5 * colors)
+    noise = np.random.randint(0, 8, size=(count, 59, 255, 3))
+    return np.clip(base[:, 0] + noise, 0, 255).astype(np.uint8)
+
+def benchmark_replay_snapshot(parameters):
+    size = int(parameters.get('size', 5000))
+    frames = make_camera_frames(64)
+
+    memory = ReplayMemory(size)
+    frame_ids = [memory.add_frame(frames[i]) for i in range(0, 4, 1)]
+    while len(memory) < size:
+        frame_ids = frame_ids[1:] + [memory.add_frame(frames[len(memory) % 64])]
+        memory.add(frame_ids + [frame_ids[-1]], np.random.randint(0, 5), np.random.random_sample(), 0.0)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        writer = ReplaySnapshotWriter(directory)
+        start = time.time()
+        writer.save(memory)
+        results['save_call_seconds'] = time.time() - start
+        writer.flush()
+        results['write_seconds'] = time.time() - start
+        path = list_snapshots(directory)[-1][1]
+        results['snapshot_bytes'] = snapshot_size(path)
+
+        restored = ReplayMemory(size)
+        start = time.time()
+        load_latest_snapshot(directory, restored)
+        results['restore_seconds'] = time.time() - start
+
+    indices = memory.sample_indices(256, False)
+    original, copy = memory.gather(indices), restored.gather(indices)
+    results['identical'] = len(restored) == len(memory) and all(np.array_equal(original[key], copy[key]) for key in original)
+
+    print('{0} transitions: snapshot of {1:.1f} MB ({2:.1f} MB in memory)'.format(size, results['snapshot_bytes'] / 1e6, memory.frame_capacity * frames[0].nbytes / 1e6))
+    print('save() returned in {0:.3f} s, written in {1:.1f} s, restored in {2:.1f} s, identical: {3}'.format(
+        results['save_call_seconds'], results['write_seconds'], results['restore_seconds'], results['identical']))
+    return results
+
+def benchmark_priorities(parameters):
+    from rl_model import RlModel
+    num_transitions = int(parameters.get('transitions', 1024))
+    batch_sizes = [int(b) for b in parameters.get('batch_sizes', '1,32,256').split(',')]
+    model = RlModel(None, True)
+    frames = make_camera_frames(64)
+
+    results = {}
+    for batch_size in batch_sizes:
+        memory = ReplayMemory(num_transitions)
+        frame_ids = [memory.add_frame(frames[i % len(frames)]) for i in range(0, 4, 1)]
+        for i in range(0, num_transitions, 1):
+            frame_ids = frame_ids[1:] + [memory.add_frame(frames[i % len(frames)])]
+            memory.add(frame_ids + [frame_ids[-1]], np.random.randint(0, 5), np.random.random_sample())
+
+        # Warm up the TD error step and allocate its input buffers
+        model.compute_td_errors(memory.gather(np.arange(batch_size), latest_only=True), batch_size)
+
+        start = time.time()
+        indices = memory.pending_indices()
+        for begin in range(0, len(indices), batch_size):
+            batch_indices = indices[begin:begin + batch_size]
+            q_taken, td_errors = model.compute_td_errors(memory.gather(batch_indices, latest_only=True), batch_size)
+            memory.update_priorities(batch_indices, td_errors, predicted_rewards=q_taken)
+        elapsed = time.time() - start
+        if len(memory.pending_indices()) != 0:
+            raise RuntimeError('Some priorities are still pending')
+
+        results[batch_size] = 1e6 * elapsed / len(indices)
+        print('batch size {0}: {1:.1f} ms per thousand transitions'.format(batch_size, results[batch_size]))
+    return results
+
+def benchmark_agent(parameters):
+    from agent import DistributedAgent
+    latency_sec = float(parameters.get('latency_ms', 5)) / 1000
+    collide_after_steps = int(parameters.get('collide_after_steps', 100))
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        # A straight road along x, with its center line on the x axis, where the fake car drives
+        os.makedirs(os.path.join(data_dir, 'data'))
+        with open(os.path.join(data_dir, 'data', 'road_lines.txt'), 'w') as f:
+            f.write('12961.722656,6660.329102\t112961.722656,6660.329102\n')
+        with open(os.path.join(data_dir, 'data', 'reward_points.txt'), 'w') as f:
+            f.write('-100\t0\t1000\t0\n')
+
+        agent_parameters = {
+            'data_dir': data_dir,
+            'experiment_name': 'benchmark',
+            'local_run': True,
+            'airsim_path': data_dir,
+            'train_conv_layers': 'false',
+            'max_epoch_runtime_sec': '30',
+            'replay_memory_size': '1000',
+            'batch_size': '32',
+            'batch_update_frequency': '300',
+            'min_epsilon': '0.1',
+            'per_iter_epsilon_reduction': '0.003',
+            'max_epochs': '5',
+            'replay_snapshot_every': '0',
+        }
+        for name, value in parameters.items():
+            if name not in ['latency_ms', 'collide_after_steps', 'output']:
+                agent_parameters[name] = value
+
+        simulator = FakeCarSimulator(collide_after_steps=collide_after_steps)
+        agent = DistributedAgent(agent_parameters, car_client_factory=lambda: FakeCarClient(simulator, latency_sec))
+        start = time.time()
+        agent.start()
+        elapsed = time.time() - start
+
+    stages = agent.stats.summary()
+    results = {
+        'seconds': elapsed,
+        'transitions': agent.num_transitions,
+        'steps_per_second': agent.num_transitions / elapsed,
+        'missed_deadlines': agent.stats.num_missed_deadlines,
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': stages,
+    }
+
+    print('{0} transitions in {1:.1f} s: {2:.1f} steps/s, peak RSS {3} MB'.format(results['transitions'], elapsed, results['steps_per_second'], results['peak_rss_mb']))
+    for stage in ['capture', 'predict', 'reward', 'replay_add', 'sample', 'train', 'publish']:
+        if stage in stages:
+            print('  {0:<10} {1:8.2f} s total ({2:5.1f}%), p50 {3:.2f} ms, p99 {4:.2f} ms'.format(
+                stage, stages[stage]['total_seconds'], 100 * stages[stage]['total_seconds'] / elapsed, stages[stage]['p50_ms'], stages[stage]['p99_ms']))
+    return results
+
+# Compresses, encodes, decodes and decompresses the same deltas rounds times, and checks that each decoded delta is
+# within one quantization step of what was sent, and that error feedback makes the decoded deltas add up to the sent ones
+def benchmark_compression(parameters):
+    rounds = int(parameters.get('rounds', 20))
+    size = int(parameters.get('size', 10000))
+    settings = [(None, None), (None, 8), (0.01, None), (0.01, 8)]
+
+    results = {}
+    for wire_dtype in [np.float32, np.float16]:
+        for scale in [1e-6, 1e-3, 1.0]:
+            gradients = [np.random.uniform(-scale, scale, size).astype(np.float32), np.random.uniform(-scale, scale, (size // 10, 10)).astype(np.float32)]
+            for topk_ratio, quantize_bits in settings:
+                compressor = GradientCompressor(topk_ratio, quantize_bits, wire_dtype)
+                totals = [np.zeros(g.shape, dtype=np.float64) for g in gradients]
+                start = time.time()
+                for _ in range(0, rounds, 1):
+                    packet = model_packet.decode_binary(model_packet.encode_binary(compressor.compress(gradients), wire_dtype))
+                    decoded = decompress(packet)
+                    for i in range(0, len(gradients), 1):
+                        totals[i] += decoded[i]
+                elapsed = time.time() - start
+
+                if quantize_bits is not None and topk_ratio is None and len(np.unique(decoded[0])) < 64:
+                    raise RuntimeError('Quantized deltas of scale {0} in {1} decoded to {2} distinct values'.format(scale, np.dtype(wire_dtype).name, len(np.unique(decoded[0]))))
+                # What is still owed after rounds rounds is the residual: about one round of deltas, or with top-k as many
+                # rounds as it takes to send every entry once
+                errors = [float(np.max(np.abs(totals[i] - rounds * gradients[i].astype(np.float64)))) for i in range(0, len(gradients), 1)]
+                owed_rounds = 1 if topk_ratio is None else min(rounds, 1.0 / topk_ratio)
+                if max(errors) > 2 * scale * owed_rounds:
+                    raise RuntimeError('Error feedback fell behind: {0} after {1} rounds of deltas of scale {2}'.format(max(errors), rounds, scale))
+
+                name = '{0} scale={1:g} topk={2} bits={3}'.format(np.dtype(wire_dtype).name, scale, topk_ratio, quantize_bits)
+                results[name] = {'max_error': max(errors) / scale, 'ms_per_round': 1000 * elapsed / rounds}
+                print('{0}: accumulated error {1:.2e} of the scale, {2:.2f} ms per round'.format(name, results[name]['max_error'], results[name]['ms_per_round']))
+    return results
+
+BENCHMARKS = {
+    'agent': benchmark_agent,
+    'compression': benchmark_compression,
+    'priorities': benchmark_priorities,
+    'train_step': benchmark_train_step,
+    'frame_path': benchmark_frame_path,
+    'predict_state': benchmark_predict_state,
+    'control_loop': benchmark_control_loop,
+    'multi_vehicle': benchmark_multi_vehicle,
+    'reward_distance': benchmark_reward_distance,
+    'replay_sampling': benchmark_replay_sampling,
+    'replay_snapshot': benchmark_replay_snapshot,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('Usage: python benchmark.py <{0}> [name=value ...]'.format('|'.join(sorted(BENCHMARKS.keys()))))
+        sys.exit(1)
+
+    parameters = {}
+    for arg in sys.argv[2:]:
+        if '=' in arg:
+            args = arg.split('=')
+            parameters[args[0].replace('--', '')] = args[1]
+
+    results = BENCHMARKS[sys.argv[1]](parameters)
+
+    if 'output' in parameters:
+        report = {
+            'benchmark': sys.argv[1],
+            'parameters': parameters,
+            'time': datetime.datetime.utcnow().isoformat() + 'Z',
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'results': results,
+        }
+        with open(parameters['output'], 'w') as f:
+            json.dump(report, f, indent=2, default=lambda value: value.item() if isinstance(value, np.generic) else str(value))
+        print('Wrote results to {0}'.format(parameters['output']))
@@ -0,0 +1,28 @@
+import numpy as np
+
+# Decoding of the uncompressed scene images returned by simGetImages.
+#
+# The model looks at rows 49 to 108 and columns 0 to 255 of the RGB channels of a 108x256 camera image.
+# Frames stay uint8 all the way into the replay memory; they are only converted to float32 when fed to the model.
+
+FRAME_HEIGHT = 108
+FRAME_WIDTH = 256
+CROP_ROWS = slice(49, 108)
+CROP_COLUMNS = slice(0, 255)
+CROP_SHAPE = (59, 255, 3)
+
+# Returns the cropped RGB frame of an image response as a uint8 view on the response's buffer.
+# The image shape is read from the response header rather than assumed, and a mismatch raises a ValueError.
+def decode_scene_image(image_response):
+    height = image_response.height
+    width = image_response.width
+    if (height, width) != (FRAME_HEIGHT, FRAME_WIDTH):
+        raise ValueError('Expected a {0}x{1} image, got {2}x{3}. Check the camera settings.'.format(FRAME_HEIGHT, FRAME_WIDTH, height, width))
+
+    image1d = np.frombuffer(image_response.image_data_uint8, dtype=np.uint8)
+    channels = image1d.size // (height * width)
+    if channels not in (3, 4) or image1d.size != height * width * channels:
+        raise ValueError('Image data has {0} bytes, which is not a {1}x{2} RGB or RGBA image'.format(image1d.size, height, width))
+
+    image = image1d.reshape(height, width, channels)
+    return image[CROP_ROWS, CROP_COLUMNS, 0:3]
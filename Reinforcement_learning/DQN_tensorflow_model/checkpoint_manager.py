@@ -0,0 +1,139 @@
+import os
+import re
+import threading
+import collections
+import numpy as np
+
+# Writes model checkpoints without blocking the training thread.
+#
+# save() only copies the weights in memory. A background thread writes the copies to disk as .npz files
+# (a zip of raw .npy buffers, much smaller and faster than JSON), first to a temporary name and then renamed,
+# so a crash never leaves a truncated checkpoint behind.
+#
+# Checkpoints are numbered in the order they are saved. After every write, the last keep_last checkpoints
+# and every keep_every-th checkpoint are kept, and the others are deleted.
+class CheckpointManager():
+    __FILE_PATTERN = re.compile(r'^(\d+)-(.*)\.npz$')
+
+    def __init__(self, directory, keep_last=5, keep_every=10, max_pending=2):
+        self.__directory = directory
+        self.__keep_last = int(keep_last)
+        self.__keep_every = int(keep_every)
+        self.__max_pending = int(max_pending)
+
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory, exist_ok=True)
+
+        # Continue the numbering of a previous run
+        existing = self.__list_checkpoints()
+        self.__next_index = existing[-1][0] + 1 if len(existing) > 0 else 0
+
+        self.__pending = collections.deque()
+        self.__condition = threading.Condition()
+        self.__num_dropped = 0
+        self.__writing = False
+        self.__writer_thread = threading.Thread(target=self.__writer_function, daemon=True)
+        self.__writer_thread.start()
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    # Snapshots a packet (see model_packet.py) and queues it for writing under the given label.
+    # If the writer has fallen behind, the oldest queued snapshot is dropped instead of blocking the caller.
+    def save(self, label, packet):
+        snapshot = {}
+        for name, value in packet.items():
+            if isinstance(value, (list, tuple)):
+                for i in range(0, len(value), 1):
+                    snapshot['{0}.{1}'.format(name, i)] = np.array(value[i], copy=True)
+            else:
+                snapshot[name] = np.array(value)
+
+        with self.__condition:
+            index = self.__next_index
+            self.__next_index += 1
+            if len(self.__pending) >= self.__max_pending:
+                self.__pending.popleft()
+                self.__num_dropped += 1
+                print('Checkpoint writer is behind, dropped a snapshot ({0} so far)'.format(self.__num_dropped))
+            self.__pending.append((index, label, snapshot))
+            self.__condition.notify()
+
+        return os.path.join(self.__directory, '{0:06d}-{1}.npz'.format(index, label))
+
+    # Blocks until every queued snapshot has been written
+    def flush(self):
+        with self.__condition:
+            while len(self.__pending) > 0 or self.__writing:
+                self.__condition.wait()
+
+    # Returns the path of the most recent checkpoint on disk, or None
+    def latest(self):
+        existing = self.__list_checkpoints()
+        if len(existing) == 0:
+            return None
+        return existing[-1][1]
+
+    def __writer_function(self):
+        while True:
+            with self.__condition:
+                while len(self.__pending) == 0:
+                    self.__condition.wait()
+                index, label, snapshot = self.__pending.popleft()
+                self.__writing = True
+
+            try:
+                self.__write(index, label, snapshot)
+                self.__apply_retention()
+            except Exception as e:
+                print('Failed to write checkpoint {0}. Message is {1}'.format(index, e))
+            finally:
+                with self.__condition:
+                    self.__writing = False
+                    self.__condition.notify_all()
+
+    def __write(self, index, label, snapshot):
+        file_name = os.path.join(self.__directory, '{0:06d}-{1}.npz'.format(index, label))
+        temp_file_name = file_name + '.tmp'
+        with open(temp_file_name, 'wb') as f:
+            np.savez(f, **snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_name, file_name)
+        print('Checkpointed to {0}'.format(file_name))
+
+    def __apply_retention(self):
+        existing = self.__list_checkpoints()
+        keep_from = len(existing) - self.__keep_last
+        for position, (index, path) in enumerate(existing):
+            if position >= keep_from:
+                continue
+            if self.__keep_every > 0 and index % self.__keep_every == 0:
+                continue
+            os.remove(path)
+
+    # The checkpoints on disk as (index, path), oldest first
+    def __list_checkpoints(self):
+        checkpoints = []
+        for file_name in os.listdir(self.__directory):
+            match = self.__FILE_PATTERN.match(file_name)
+            if match is not None:
+                checkpoints.append((int(match.group(1)), os.path.join(self.__directory, file_name)))
+        checkpoints.sort()
+        return checkpoints
+
+# Reads a checkpoint written by CheckpointManager back into a packet
+def load_checkpoint(file_name):
+    packet = {}
+    with np.load(file_name) as data:
+        for key in data.files:
+            name, _, position = key.rpartition('.')
+            if name != '' and position.isdigit():
+                packet.setdefault(name, []).append((int(position), data[key]))
+            else:
+                packet[key] = data[key].item() if data[key].ndim == 0 else data[key]
+    for name, value in packet.items():
+        if isinstance(value, list):
+            packet[name] = [w for _, w in sorted(value, key=lambda entry: entry[0])]
+    return packet
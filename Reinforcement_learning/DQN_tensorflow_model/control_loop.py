@@ -0,0 +1,241 @@
+import collections
+import contextlib
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-stage latencies of the control loop, kept over a window of recent steps, and the total time spent in each stage.
+# Stages are recorded from the RPC worker threads as well as the driving thread.
+# With an instrumentation.Instrumentation, every latency is also added to its <stage>_seconds histogram, and the steps and
+# missed deadlines to its control_steps and missed_deadlines counters, so they are exported with the other metrics.
+class LatencyStats():
+    def __init__(self, window=10000, instrumentation=None):
+        self.__window = window
+        self.__instrumentation = instrumentation
+        self.__lock = threading.Lock()
+        self.__latencies = collections.OrderedDict()
+        self.__totals = collections.OrderedDict()
+        self.__num_steps = 0
+        self.__num_missed_deadlines = 0
+
+    @property
+    def num_steps(self):
+        return self.__num_steps
+
+    @property
+    def num_missed_deadlines(self):
+        return self.__num_missed_deadlines
+
+    def record(self, stage, seconds):
+        with self.__lock:
+            if stage not in self.__latencies:
+                self.__latencies[stage] = collections.deque(maxlen=self.__window)
+                self.__totals[stage] = [0, 0.0]
+            self.__latencies[stage].append(seconds)
+            self.__totals[stage][0] += 1
+            self.__totals[stage][1] += seconds
+        if self.__instrumentation is not None:
+            self.__instrumentation.observe(stage + '_seconds', seconds)
+
+    # Records how long the body of the with statement takes as a stage
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start)
+
+    def record_step(self, missed_deadline):
+        with self.__lock:
+            self.__num_steps += 1
+            if missed_deadline:
+                self.__num_missed_deadlines += 1
+        if self.__instrumentation is not None:
+            self.__instrumentation.count('control_steps')
+            if missed_deadline:
+                self.__instrumentation.count('missed_deadlines')
+
+    # Returns {stage: {'p50_ms', 'p99_ms', 'max_ms', 'count', 'total_seconds'}}. The percentiles are over the window, the count and total over everything.
+    def summary(self):
+        with self.__lock:
+            latencies = [(stage, list(stage_latencies), list(self.__totals[stage])) for stage, stage_latencies in self.__latencies.items()]
+
+        summary = collections.OrderedDict()
+        for stage, stage_latencies, (count, total_seconds) in latencies:
+            latencies_ms = 1000 * np.array(stage_latencies)
+            summary[stage] = {'p50_ms': float(np.percentile(latencies_ms, 50)), 'p99_ms': float(np.percentile(latencies_ms, 99)), 'max_ms': float(latencies_ms.max()),
+                              'count': count, 'total_seconds': total_seconds}
+        return summary
+
+    def summary_line(self):
+        stages = ', '.join('{0} {1:.1f}/{2:.1f} ms'.format(stage, s['p50_ms'], s['p99_ms']) for stage, s in self.summary().items())
+        return '{0} steps, {1} missed deadlines. p50/p99: {2}'.format(self.__num_steps, self.__num_missed_deadlines, stages)
+
+    def reset(self):
+        with self.__lock:
+            self.__latencies = collections.OrderedDict()
+            self.__totals = collections.OrderedDict()
+            self.__num_steps = 0
+            self.__num_missed_deadlines = 0
+
+# What the car looked like at the start of a control step
+Observation = collections.namedtuple('Observation', ['image_response', 'car_state', 'collision_info'])
+
+# Runs the car at a fixed control rate, overlapping the AirSim RPCs of each step.
+#
+# Each RPC stage (image, car state, collision info, controls) gets its own client connection and its own worker thread,
+# because a single AirSim client can't have two calls in flight. At every tick, the three observation RPCs are issued
+# at once, so a step waits for the slowest of them instead of their sum. The controls are sent asynchronously, so the
+# caller can store the previous transition while they are in flight.
+#
+# With vehicle_names, the loop drives several vehicles of the same AirSim instance in step: every vehicle gets its own
+# connections and workers, and observe_all and apply_all observe and control all of them at once.
+#
+# A step that takes longer than the control period counts as a missed deadline. The loop doesn't try to catch up on
+# missed ticks, it starts the next period when the late step finishes.
+#
+# Usage:
+#   loop.start()
+#   while driving:
+#       observation = loop.observe()
+#       ... pick an action ...
+#       loop.apply(car_controls)
+#       ... bookkeeping ...
+#       loop.wait_for_next_tick()
+class ControlLoop():
+    STAGES = ['image', 'car_state', 'collision', 'controls']
+
+    # client_factory returns a new, connected CarClient. image_requests is the argument of simGetImages.
+    def __init__(self, client_factory, image_requests, control_frequency_hz=20.0, stats=None, vehicle_names=None):
+        self.__image_requests = image_requests
+        self.__period = 1.0 / float(control_frequency_hz)
+        self.__stats = stats if stats is not None else LatencyStats()
+
+        # The RPCs of the default vehicle are made without a vehicle name
+        self.__vehicle_names = list(vehicle_names) if vehicle_names is not None else [None]
+
+        self.__clients = {}
+        self.__workers = {}
+        for vehicle in range(0, len(self.__vehicle_names), 1):
+            for stage in self.STAGES:
+                self.__clients[(stage, vehicle)] = client_factory()
+                self.__workers[(stage, vehicle)] = ThreadPoolExecutor(max_workers=1)
+
+        self.__pending_observations = None
+        self.__pending_controls = []
+        self.__deadline = None
+        self.__step_start = None
+
+    @property
+    def stats(self):
+        return self.__stats
+
+    @property
+    def period(self):
+        return self.__period
+
+    @property
+    def num_vehicles(self):
+        return len(self.__vehicle_names)
+
+    # Starts the first control period and prefetches its observation
+    def start(self):
+        self.__wait_for_controls()
+        self.__deadline = time.time() + self.__period
+        self.__prefetch()
+
+    # Returns the Observation prefetched at the start of the current period.
+    # Errors raised by the RPCs, such as timeouts, are raised here.
+    def observe(self):
+        return self.observe_all()[0]
+
+    # Returns the Observations of all vehicles, in the order of vehicle_names
+    def observe_all(self):
+        if self.__pending_observations is None:
+            self.__prefetch()
+
+        wait_start = time.time()
+        pending_observations = self.__pending_observations
+        self.__pending_observations = None
+        observations = [Observation(futures['image'].result()[0], futures['car_state'].result(), futures['collision'].result()) for futures in pending_observations]
+        self.__stats.record('observe_wait', time.time() - wait_start)
+        return observations
+
+    # Sends the controls without waiting for AirSim to acknowledge them.
+    # car_controls must not be modified afterwards, use a new object for every step.
+    def apply(self, car_controls):
+        self.apply_all([car_controls])
+
+    # Sends the controls of every vehicle, in the order of vehicle_names. Vehicles whose controls are None keep their controls.
+    def apply_all(self, car_controls):
+        self.__wait_for_controls()
+        for vehicle, controls in enumerate(car_controls):
+            if controls is not None:
+                self.__pending_controls.append(self.__submit('controls', vehicle, 'setCarControls', controls))
+
+    # Sleeps until the end of the current control period, then prefetches the next observation
+    def wait_for_next_tick(self):
+        self.__wait_for_controls()
+
+        now = time.time()
+        missed_deadline = now > self.__deadline
+        if missed_deadline:
+            self.__deadline = now + self.__period
+        else:
+            time.sleep(self.__deadline - now)
+            self.__deadline += self.__period
+
+        step_end = time.time()
+        if self.__step_start is not None:
+            self.__stats.record('step', step_end - self.__step_start)
+        self.__stats.record_step(missed_deadline)
+        self.__step_start = step_end
+        self.__prefetch()
+
+    # Drops any prefetched observation and waits for in-flight controls, e.g. before resetting the car
+    def stop(self):
+        if self.__pending_observations is not None:
+            for futures in self.__pending_observations:
+                for future in futures.values():
+                    future.exception()
+            self.__pending_observations = None
+        self.__wait_for_controls()
+        self.__step_start = None
+
+    def close(self):
+        self.stop()
+        for worker in self.__workers.values():
+            worker.shutdown(wait=True)
+
+    def __prefetch(self):
+        if self.__step_start is None:
+            self.__step_start = time.time()
+        self.__pending_observations = []
+        for vehicle in range(0, len(self.__vehicle_names), 1):
+            self.__pending_observations.append({
+                'image': self.__submit('image', vehicle, 'simGetImages', self.__image_requests),
+                'car_state': self.__submit('car_state', vehicle, 'getCarState'),
+                'collision': self.__submit('collision', vehicle, 'simGetCollisionInfo'),
+            })
+
+    def __wait_for_controls(self):
+        pending_controls = self.__pending_controls
+        self.__pending_controls = []
+        for future in pending_controls:
+            future.result()
+
+    # Calls method on the client of the stage and vehicle, on their worker thread, and records how long the call took
+    def __submit(self, stage, vehicle, method, *args):
+        client = self.__clients[(stage, vehicle)]
+        kwargs = {}
+        if self.__vehicle_names[vehicle] is not None:
+            kwargs['vehicle_name'] = self.__vehicle_names[vehicle]
+        stats = self.__stats
+        def call():
+            start = time.time()
+            result = getattr(client, method)(*args, **kwargs)
+            stats.record(stage, time.time() - start)
+            return result
+        return self.__workers[(stage, vehicle)].submit(call)
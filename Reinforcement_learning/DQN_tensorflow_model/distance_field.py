@@ -0,0 +1,136 @@
+import hashlib
+import math
+import os
+import numpy as np
+
+# The distance from any point on the map to the nearest road center line, used by the agent's reward function.
+#
+# The distances are computed once on a regular grid covering the center lines plus a margin, and looked up with
+# bilinear interpolation, so a lookup costs the same however many line segments there are. Points outside the grid
+# fall back to the exact distance to every segment.
+#
+# Building the grid takes a while for a large map, so it is cached on disk. The cache file name contains a hash of the
+# points file and of the grid settings, so editing the points file or changing the resolution builds a new grid.
+
+# Bump this when the way the grid is computed changes, so that old caches are not used
+CACHE_FORMAT_VERSION = 1
+
+# Reads the center line segments of reward_points.txt: one segment per line, as tab separated x1, y1, x2, y2.
+# Returns an array of shape (num_segments, 2, 2).
+def read_segments(file_name):
+    segments = []
+    with open(file_name, 'r') as f:
+        for line in f:
+            point_values = line.split('\t')
+            if len(point_values) < 4:
+                continue
+            segments.append([[float(point_values[0]), float(point_values[1])], [float(point_values[2]), float(point_values[3])]])
+    return np.array(segments, dtype=np.float64).reshape(-1, 2, 2)
+
+# The exact distance from each of the points, of shape (num_points, 2), to the nearest of the segments.
+# A segment whose ends are the same point is treated as that point.
+def exact_distances(points, segments):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return np.sqrt(_squared_distances(points[:, 0:1], points[:, 1:2], segments).min(axis=1))
+
+# The squared distances from the points (xs, ys) to each segment, broadcasting xs and ys against a trailing segment axis
+def _squared_distances(xs, ys, segments):
+    start_x = segments[:, 0, 0]
+    start_y = segments[:, 0, 1]
+    direction_x = segments[:, 1, 0] - start_x
+    direction_y = segments[:, 1, 1] - start_y
+    length_squared = direction_x ** 2 + direction_y ** 2
+    inverse_length_squared = np.where(length_squared > 0, 1.0 / np.where(length_squared > 0, length_squared, 1.0), 0)
+
+    offset_x = xs - start_x
+    offset_y = ys - start_y
+    t = np.clip((offset_x * direction_x + offset_y * direction_y) * inverse_length_squared, 0, 1)
+    return (offset_x - t * direction_x) ** 2 + (offset_y - t * direction_y) ** 2
+
+class DistanceField():
+    # Computes the grid over the bounding box of the segments, extended by margin on every side.
+    # resolution is the grid spacing, in the same units as the segments.
+    def __init__(self, segments, resolution=0.25, margin=25.0, grid=None, origin=None):
+        self.__segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+        if self.__segments.shape[0] == 0:
+            raise ValueError('A distance field needs at least one segment')
+        self.__resolution = float(resolution)
+
+        if grid is None:
+            lower = self.__segments.reshape(-1, 2).min(axis=0) - margin
+            upper = self.__segments.reshape(-1, 2).max(axis=0) + margin
+            origin = lower
+            shape = (int(math.ceil((upper[1] - lower[1]) / self.__resolution)) + 1, int(math.ceil((upper[0] - lower[0]) / self.__resolution)) + 1)
+            grid = self.__compute_grid(origin, shape)
+
+        self.__origin = np.asarray(origin, dtype=np.float64)
+        self.__grid = np.asarray(grid, dtype=np.float32)
+
+    @property
+    def segments(self):
+        return self.__segments
+
+    @property
+    def grid(self):
+        return self.__grid
+
+    @property
+    def origin(self):
+        return self.__origin
+
+    @property
+    def resolution(self):
+        return self.__resolution
+
+    # The distance from (x, y) to the nearest segment.
+    # Inside the grid this is interpolated from the four surrounding grid points, which is within the grid
+    # resolution of the exact distance. Outside the grid it is exact.
+    def distance(self, x, y):
+        grid_x = (x - self.__origin[0]) / self.__resolution
+        grid_y = (y - self.__origin[1]) / self.__resolution
+        column = int(math.floor(grid_x))
+        row = int(math.floor(grid_y))
+        if (column < 0 or row < 0 or column >= self.__grid.shape[1] - 1 or row >= self.__grid.shape[0] - 1):
+            return float(exact_distances([[x, y]], self.__segments)[0])
+
+        fx = grid_x - column
+        fy = grid_y - row
+        cell = self.__grid[row:row + 2, column:column + 2]
+        top = cell[0, 0] + fx * (cell[0, 1] - cell[0, 0])
+        bottom = cell[1, 0] + fx * (cell[1, 1] - cell[1, 0])
+        return float(top + fy * (bottom - top))
+
+    # Computes the grid one segment at a time, keeping the running minimum of the squared distances
+    def __compute_grid(self, origin, shape):
+        xs = origin[0] + self.__resolution * np.arange(shape[1])[np.newaxis, :]
+        ys = origin[1] + self.__resolution * np.arange(shape[0])[:, np.newaxis]
+        grid = np.full(shape, np.inf)
+        for i in range(0, self.__segments.shape[0], 1):
+            np.minimum(grid, _squared_distances(xs, ys, self.__segments[i:i + 1]), out=grid)
+        return np.sqrt(grid).astype(np.float32)
+
+# Returns the DistanceField of the segments in points_file, from the cache in cache_dir if it is there.
+# Otherwise the field is built and written to the cache, first to a temporary name and then renamed.
+def load_or_build(points_file, cache_dir, resolution=0.25, margin=25.0):
+    with open(points_file, 'rb') as f:
+        points_hash = hashlib.sha1(f.read())
+    points_hash.update('{0}:{1!r}:{2!r}'.format(CACHE_FORMAT_VERSION, float(resolution), float(margin)).encode('utf8'))
+    cache_file = os.path.join(cache_dir, 'distance_field_{0}.npz'.format(points_hash.hexdigest()))
+
+    if os.path.isfile(cache_file):
+        try:
+            with np.load(cache_file) as data:
+                print('Loaded distance field from {0}'.format(cache_file))
+                return DistanceField(data['segments'], float(data['resolution']), grid=data['grid'], origin=data['origin'])
+        except Exception as e:
+            print('Could not read distance field cache {0}, rebuilding it. Message is {1}'.format(cache_file, e))
+
+    distance_field = DistanceField(read_segments(points_file), resolution, margin)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    temp_file_name = cache_file + '.tmp'
+    with open(temp_file_name, 'wb') as f:
+        np.savez(f, segments=distance_field.segments, resolution=distance_field.resolution, grid=distance_field.grid, origin=distance_field.origin)
+    os.replace(temp_file_name, cache_file)
+    print('Wrote distance field of shape {0} to {1}'.format(distance_field.grid.shape, cache_file))
+    return distance_field
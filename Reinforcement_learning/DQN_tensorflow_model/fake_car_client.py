@@ -0,0 +1,164 @@
+import random
+import threading
+import time
+import types
+import numpy as np
+
+# A stand-in for airsim.CarClient, for running the driving loop without AirSim.
+#
+# Every call sleeps for an injected latency, optionally with uniform jitter, to emulate the RPC round trip.
+# Several clients can share one FakeCarSimulator, just as several AirSim clients talk to the same AirSim instance.
+# The simulator can limit how many calls it serves at once, to emulate an AirSim instance that is saturated.
+#
+# Each vehicle drives straight along x, accelerating with the throttle and slowing down with the brake, and collides after
+# a fixed number of control steps. The images are taken in turn from a fixed set of random frames, chosen by the vehicle's
+# step count, so runs with the same seed see the same frames.
+# Calls take a vehicle_name like the AirSim API does, the default vehicle is ''.
+
+class FakeCarSimulator():
+    def __init__(self, collide_after_steps=200, image_height=108, image_width=256, max_concurrent_calls=None, seed=0, num_frames=16):
+        self.__lock = threading.Lock()
+        self.__collide_after_steps = collide_after_steps
+        self.__image_height = image_height
+        self.__image_width = image_width
+        random_state = np.random.RandomState(seed)
+        self.__frames = [random_state.randint(0, 256, size=image_height * image_width * 4, dtype=np.uint8).tobytes() for _ in range(0, num_frames, 1)]
+        self.__call_slots = threading.Semaphore(max_concurrent_calls) if max_concurrent_calls is not None else None
+        self.__vehicles = {}
+
+    # Holds one of the simulator's call slots while the call is served
+    def serve(self, latency):
+        if self.__call_slots is None:
+            time.sleep(latency)
+            return
+        with self.__call_slots:
+            time.sleep(latency)
+
+    def reset(self, vehicle_name=None):
+        with self.__lock:
+            names = list(self.__vehicles.keys()) if vehicle_name is None else [vehicle_name]
+            for name in names:
+                self.__vehicles[name] = self.__new_vehicle()
+
+    def set_controls(self, car_controls, vehicle_name=''):
+        with self.__lock:
+            vehicle = self.__advance(vehicle_name)
+            vehicle['throttle'] = car_controls.throttle
+            vehicle['brake'] = car_controls.brake
+            vehicle['num_steps'] += 1
+            if vehicle['num_steps'] == self.__collide_after_steps:
+                vehicle['collision_time_stamp'] = int(1e9 * time.time())
+
+    def car_state(self, vehicle_name=''):
+        with self.__lock:
+            vehicle = self.__advance(vehicle_name)
+            position = types.SimpleNamespace(x_val=vehicle['x'], y_val=vehicle['y'], z_val=0.0)
+            kinematics = types.SimpleNamespace(position=position)
+            return types.SimpleNamespace(speed=vehicle['speed'], kinematics_estimated=kinematics)
+
+    # Like AirSim, the last collision is reported until the next one, with the time it happened
+    def collision_info(self, vehicle_name=''):
+        with self.__lock:
+            vehicle = self.__advance(vehicle_name)
+            return types.SimpleNamespace(has_collided=(vehicle['collision_time_stamp'] is not None), time_stamp=vehicle['collision_time_stamp'])
+
+    def vehicle_pose(self, vehicle_name=''):
+        with self.__lock:
+            vehicle = self.__advance(vehicle_name)
+            return types.SimpleNamespace(position=types.SimpleNamespace(x_val=vehicle['x'], y_val=vehicle['y'], z_val=0.0))
+
+    # Teleports the vehicle and restarts its episode, but keeps its last collision
+    def set_vehicle_pose(self, pose, vehicle_name=''):
+        with self.__lock:
+            vehicle = self.__advance(vehicle_name)
+            collision_time_stamp = vehicle['collision_time_stamp']
+            vehicle.update(self.__new_vehicle())
+            vehicle['x'] = pose.position.x_val
+            vehicle['y'] = pose.position.y_val
+            vehicle['collision_time_stamp'] = collision_time_stamp
+
+    # An uncompressed RGBA scene image response, like simGetImages returns for ImageRequest(0, Scene, False, False)
+    def image_response(self, vehicle_name=''):
+        with self.__lock:
+            vehicle = self.__advance(vehicle_name)
+            data = self.__frames[vehicle['num_steps'] % len(self.__frames)]
+        return types.SimpleNamespace(image_data_uint8=data, height=self.__image_height, width=self.__image_width)
+
+    def __new_vehicle(self):
+        return {'num_steps': 0, 'x': 0.0, 'y': 0.0, 'speed': 0.0, 'throttle': 0.0, 'brake': 0.0, 'last_update': time.time(), 'collision_time_stamp': None}
+
+    # Must be called with the lock held
+    def __advance(self, vehicle_name):
+        if vehicle_name not in self.__vehicles:
+            self.__vehicles[vehicle_name] = self.__new_vehicle()
+        vehicle = self.__vehicles[vehicle_name]
+        now = time.time()
+        elapsed = now - vehicle['last_update']
+        vehicle['speed'] = min(20.0, max(0.0, vehicle['speed'] + elapsed * (4.0 * vehicle['throttle'] - 8.0 * vehicle['brake'] - 0.5)))
+        vehicle['x'] += vehicle['speed'] * elapsed
+        vehicle['last_update'] = now
+        return vehicle
+
+class FakeCarClient():
+    # latency_sec is the latency of every call, or a dict from method name to latency with a 'default' entry
+    def __init__(self, simulator, latency_sec=0.005, jitter_sec=0.0):
+        self.__simulator = simulator
+        if isinstance(latency_sec, dict):
+            self.__latencies = dict(latency_sec)
+        else:
+            self.__latencies = {'default': latency_sec}
+        self.__jitter_sec = jitter_sec
+        self.__num_calls = 0
+
+    @property
+    def num_calls(self):
+        return self.__num_calls
+
+    def confirmConnection(self):
+        self.__wait('confirmConnection')
+
+    def enableApiControl(self, is_enabled, vehicle_name=''):
+        self.__wait('enableApiControl')
+
+    def reset(self):
+        self.__wait('reset')
+        self.__simulator.reset()
+
+    def setCarControls(self, car_controls, vehicle_name=''):
+        self.__wait('setCarControls')
+        self.__simulator.set_controls(car_controls, vehicle_name)
+
+    def getCarState(self, vehicle_name=''):
+        self.__wait('getCarState')
+        return self.__simulator.car_state(vehicle_name)
+
+    def simGetCollisionInfo(self, vehicle_name=''):
+        self.__wait('simGetCollisionInfo')
+        return self.__simulator.collision_info(vehicle_name)
+
+    def simGetVehiclePose(self, vehicle_name=''):
+        self.__wait('simGetVehiclePose')
+        return self.__simulator.vehicle_pose(vehicle_name)
+
+    def simSetVehiclePose(self, pose, ignore_collision, vehicle_name=''):
+        self.__wait('simSetVehiclePose')
+        self.__simulator.set_vehicle_pose(pose, vehicle_name)
+
+    def simGetImages(self, requests, vehicle_name=''):
+        self.__wait('simGetImages')
+        return [self.__simulator.image_response(vehicle_name) for _ in requests]
+
+    def __wait(self, method):
+        self.__num_calls += 1
+        latency = self.__latencies.get(method, self.__latencies.get('default', 0.0))
+        if self.__jitter_sec > 0:
+            latency += random.uniform(0, self.__jitter_sec)
+        if latency > 0:
+            self.__simulator.serve(latency)
+
+# The fields of airsim.CarControls that the agent sets
+class FakeCarControls():
+    def __init__(self, throttle=0, steering=0, brake=0):
+        self.throttle = throttle
+        self.steering = steering
+        self.brake = brake
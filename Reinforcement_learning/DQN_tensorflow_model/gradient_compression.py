@@ -0,0 +1,126 @@
+import numpy as np
+
+# Compression of the weight deltas the agent sends to the trainer.
+#
+# Two lossy steps can be combined:
+#   - top-k sparsification: only the topk_ratio fraction of entries with the largest magnitude is sent, with their indices
+#   - 8-bit stochastic quantization: the values are mapped onto 256 levels between their min and max,
+#     rounding up or down at random so that the decoded values are unbiased
+#
+# Whatever is lost is kept in a per-agent residual and added to the next update (error feedback),
+# so small deltas are delayed rather than dropped. The residual is taken against the values as the trainer will decode
+# them, after the float values go through the wire dtype (see model_packet.encode_binary).
+#
+# The compressed gradients are a packet (see model_packet.py) with these entries:
+#   gradient_encoding: {'topk_ratio': float or None, 'quantize_bits': 8 or None}
+#   gradient_shapes:   one int64 array per tensor with the tensor's shape
+#   gradient_indices:  one int32 array of flat indices per tensor (top-k only)
+#   gradient_values:   one float32 (or uint8 if quantized) array per tensor
+#   gradient_ranges:   one float32 [min, step] array per tensor (quantized only), never sent in a smaller float dtype
+
+class GradientCompressor():
+    def __init__(self, topk_ratio=None, quantize_bits=None, wire_dtype=np.float32):
+        if topk_ratio is not None and not (0 < topk_ratio <= 1):
+            raise ValueError('topk_ratio must be in (0, 1], got {0}'.format(topk_ratio))
+        if quantize_bits is not None and quantize_bits != 8:
+            raise ValueError('Only 8-bit quantization is supported, got {0}'.format(quantize_bits))
+
+        self.__topk_ratio = topk_ratio
+        self.__quantize_bits = quantize_bits
+        self.__wire_dtype = np.dtype(wire_dtype)
+        self.__residuals = None
+
+    # Compresses a list of gradient tensors into a packet.
+    # The part of each tensor that does not survive compression is carried into the next call.
+    def compress(self, gradients):
+        gradients = [np.asarray(g, dtype=np.float32) for g in gradients]
+        if self.__residuals is None:
+            self.__residuals = [np.zeros_like(g) for g in gradients]
+
+        packet = {}
+        packet['gradient_encoding'] = {'topk_ratio': self.__topk_ratio, 'quantize_bits': self.__quantize_bits}
+        packet['gradient_shapes'] = []
+        packet['gradient_values'] = []
+        if self.__topk_ratio is not None:
+            packet['gradient_indices'] = []
+        if self.__quantize_bits is not None:
+            packet['gradient_ranges'] = []
+
+        for i in range(0, len(gradients), 1):
+            corrected = (gradients[i] + self.__residuals[i]).reshape(-1)
+
+            if self.__topk_ratio is not None:
+                k = max(1, int(np.ceil(self.__topk_ratio * corrected.size)))
+                if k < corrected.size:
+                    indices = np.argpartition(np.abs(corrected), corrected.size - k)[corrected.size - k:]
+                else:
+                    indices = np.arange(corrected.size)
+                indices = np.sort(indices).astype(np.int32)
+                values = corrected[indices]
+                packet['gradient_indices'].append(indices)
+            else:
+                indices = None
+                values = corrected
+
+            if self.__quantize_bits is not None:
+                values, value_range = _quantize(values)
+                packet['gradient_ranges'].append(value_range)
+                sent = _dequantize(values, value_range)
+            else:
+                sent = values.astype(self.__wire_dtype).astype(np.float32)
+
+            packet['gradient_shapes'].append(np.array(gradients[i].shape, dtype=np.int64))
+            packet['gradient_values'].append(values)
+
+            # Whatever was not transmitted becomes the residual for the next update
+            residual = corrected.copy()
+            if indices is not None:
+                residual[indices] -= sent
+            else:
+                residual -= sent
+            self.__residuals[i] = residual.reshape(gradients[i].shape)
+
+        return packet
+
+# True if the packet holds compressed gradients rather than a plain 'gradients' list
+def is_compressed(packet):
+    return isinstance(packet, dict) and 'gradient_encoding' in packet
+
+# Rebuilds the dense gradient tensors from a packet produced by GradientCompressor.compress
+def decompress(packet):
+    encoding = packet['gradient_encoding']
+    gradients = []
+    for i in range(0, len(packet['gradient_shapes']), 1):
+        shape = tuple(int(d) for d in np.asarray(packet['gradient_shapes'][i]).reshape(-1))
+        values = np.asarray(packet['gradient_values'][i])
+
+        if encoding.get('quantize_bits') is not None:
+            values = _dequantize(values.astype(np.uint8), np.asarray(packet['gradient_ranges'][i], dtype=np.float32))
+        else:
+            values = values.astype(np.float32)
+
+        if encoding.get('topk_ratio') is not None:
+            dense = np.zeros(int(np.prod(shape, dtype=np.int64)), dtype=np.float32)
+            dense[np.asarray(packet['gradient_indices'][i], dtype=np.int64)] = values
+        else:
+            dense = values
+        gradients.append(dense.reshape(shape))
+
+    return gradients
+
+# Maps float values onto uint8 levels with stochastic rounding.
+# Returns the levels and the [min, step] needed to decode them.
+def _quantize(values):
+    if values.size == 0:
+        return values.astype(np.uint8), np.zeros(2, dtype=np.float32)
+    low = float(np.min(values))
+    high = float(np.max(values))
+    step = (high - low) / 255.0
+    if step == 0:
+        step = 1.0
+    scaled = (values - low) / step
+    levels = np.floor(scaled + np.random.random_sample(values.shape))
+    return np.clip(levels, 0, 255).astype(np.uint8), np.array([low, step], dtype=np.float32)
+
+def _dequantize(levels, value_range):
+    return (value_range[0] + levels.astype(np.float32) * value_range[1]).astype(np.float32)
@@ -0,0 +1,242 @@
+import bisect
+import collections
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Named counters, timers and histograms for the RL agents, with a periodic export to a CSV file and a Prometheus text endpoint.
+#
+# Timers are histograms of durations in seconds. Histograms count their observations in fixed buckets, so they take
+# constant memory however long the agent runs, and their quantiles can be estimated by Prometheus.
+#
+# A disabled Instrumentation does nothing: count and observe return at once, and timer returns a shared no-op context
+# manager, so the calls can stay in the hot paths of the agents. The module-level default instance is disabled until
+# configure is called, so code that is instrumented but never configured pays close to nothing.
+#
+# Usage:
+#   instruments = instrumentation.default_instrumentation()
+#   with instruments.timer('train'):
+#       ...
+#   instruments.count('transitions')
+#
+#   instrumentation.configure(csv_file='metrics.csv', port=9100)   # once, at startup
+
+# The upper bounds of the histogram buckets, in seconds for timers
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_METRIC_NAME_PATTERN = re.compile(r'[^a-zA-Z0-9_]')
+
+class _Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer():
+    def __init__(self, instrumentation, name):
+        self.__instrumentation = instrumentation
+        self.__name = name
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__instrumentation.observe(self.__name, time.perf_counter() - self.__start)
+        return False
+
+class Instrumentation():
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+        self.__enabled = enabled
+        self.__buckets = tuple(sorted(buckets))
+        self.__lock = threading.Lock()
+        self.__counters = collections.OrderedDict()
+        self.__histograms = collections.OrderedDict()
+        self.__start_time = time.time()
+
+        self.__export_thread = None
+        self.__stop_export = threading.Event()
+        self.__http_server = None
+
+    @property
+    def enabled(self):
+        return self.__enabled
+
+    def enable(self):
+        self.__enabled = True
+
+    def disable(self):
+        self.__enabled = False
+
+    # Adds amount to the counter name
+    def count(self, name, amount=1):
+        if not self.__enabled:
+            return
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    # Adds value to the histogram name
+    def observe(self, name, value):
+        if not self.__enabled:
+            return
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = _Histogram(self.__buckets)
+                self.__histograms[name] = histogram
+            histogram.observe(value)
+
+    # A context manager adding the time its body takes, in seconds, to the histogram name
+    def timer(self, name):
+        if not self.__enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    # Returns copies of the metrics: {'counters': {name: value}, 'histograms': {name: {'count', 'sum', 'buckets'}}}
+    # The buckets of a histogram are (upper bound, cumulative count) pairs ending with an infinite bound, as in Prometheus.
+    def snapshot(self):
+        with self.__lock:
+            counters = collections.OrderedDict(self.__counters)
+            histograms = collections.OrderedDict()
+            for name, histogram in self.__histograms.items():
+                cumulative_counts = []
+                total = 0
+                for bucket_count in histogram.bucket_counts:
+                    total += bucket_count
+                    cumulative_counts.append(total)
+                histograms[name] = {'count': histogram.count, 'sum': histogram.sum,
+                                    'buckets': list(zip(list(histogram.buckets) + [float('inf')], cumulative_counts))}
+        return {'counters': counters, 'histograms': histograms}
+
+    def reset(self):
+        with self.__lock:
+            self.__counters = collections.OrderedDict()
+            self.__histograms = collections.OrderedDict()
+            self.__start_time = time.time()
+
+    # The metrics in the Prometheus text exposition format. Counters get a _total suffix, histograms _bucket, _sum and _count.
+    def to_prometheus(self, prefix='dqn_'):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot['counters'].items():
+            metric = prefix + _METRIC_NAME_PATTERN.sub('_', name) + '_total'
+            lines.append('# TYPE {0} counter'.format(metric))
+            lines.append('{0} {1}'.format(metric, value))
+        for name, histogram in snapshot['histograms'].items():
+            metric = prefix + _METRIC_NAME_PATTERN.sub('_', name)
+            lines.append('# TYPE {0} histogram'.format(metric))
+            for upper_bound, cumulative_count in histogram['buckets']:
+                bound = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                lines.append('{0}_bucket{{le="{1}"}} {2}'.format(metric, bound, cumulative_count))
+            lines.append('{0}_sum {1!r}'.format(metric, histogram['sum']))
+            lines.append('{0}_count {1}'.format(metric, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    # Appends one row per metric to file_name, with the header if the file is new.
+    # Counters only fill in count, histograms fill in count, sum and mean.
+    def write_csv(self, file_name):
+        snapshot = self.snapshot()
+        now = time.time()
+        elapsed = now - self.__start_time
+        is_new_file = not os.path.isfile(file_name)
+        with open(file_name, 'a') as f:
+            if is_new_file:
+                f.write('time,elapsed_sec,metric,type,count,sum,mean\n')
+            for name, value in snapshot['counters'].items():
+                f.write('{0:.3f},{1:.3f},{2},counter,{3},,\n'.format(now, elapsed, name, value))
+            for name, histogram in snapshot['histograms'].items():
+                mean = histogram['sum'] / histogram['count'] if histogram['count'] > 0 else 0.0
+                f.write('{0:.3f},{1:.3f},{2},histogram,{3},{4!r},{5!r}\n'.format(now, elapsed, name, histogram['count'], histogram['sum'], mean))
+
+    # Enables the instrumentation and starts exporting it: every interval_sec to csv_file, and on request at
+    # http://<host>:<port>/metrics. Either can be None.
+    def start_export(self, csv_file=None, port=None, interval_sec=10.0, host='127.0.0.1'):
+        self.stop_export()
+        self.enable()
+
+        if port is not None:
+            instrumentation = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = instrumentation.to_prometheus().encode('utf8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    return
+
+            self.__http_server = HTTPServer((host, int(port)), MetricsHandler)
+            threading.Thread(target=self.__http_server.serve_forever, daemon=True).start()
+            print('Serving metrics on http://{0}:{1}/metrics'.format(host, self.__http_server.server_address[1]))
+
+        if csv_file is not None:
+            self.__stop_export.clear()
+            self.__export_thread = threading.Thread(target=self.__export_csv, args=(csv_file, float(interval_sec)), daemon=True)
+            self.__export_thread.start()
+
+    # Stops the exports, writing the CSV file one last time
+    def stop_export(self):
+        if self.__export_thread is not None:
+            self.__stop_export.set()
+            self.__export_thread.join()
+            self.__export_thread = None
+        if self.__http_server is not None:
+            self.__http_server.shutdown()
+            self.__http_server.server_close()
+            self.__http_server = None
+
+    def __export_csv(self, csv_file, interval_sec):
+        while not self.__stop_export.wait(interval_sec):
+            self.__try_write_csv(csv_file)
+        self.__try_write_csv(csv_file)
+
+    def __try_write_csv(self, csv_file):
+        try:
+            self.write_csv(csv_file)
+        except Exception as e:
+            print('Failed to write metrics to {0}. Message is {1}'.format(csv_file, e))
+
+# The peak resident set size of the process in MB, or None where the resource module is not available (Windows)
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak_rss / 1024.0
+
+_default_instrumentation = Instrumentation(enabled=False)
+
+# The instance shared by the agent, the model and the CNTK scripts
+def default_instrumentation():
+    return _default_instrumentation
+
+# Enables the default instrumentation and starts its exports. Does nothing if neither csv_file nor port is given.
+def configure(csv_file=None, port=None, interval_sec=10.0):
+    if csv_file is None and port is None:
+        return _default_instrumentation
+    _default_instrumentation.start_export(csv_file, port, interval_sec)
+    return _default_instrumentation
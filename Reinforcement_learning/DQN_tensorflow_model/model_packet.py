@@ -0,0 +1,129 @@
+import json
+import struct
+import numpy as np
+
+# Helpers to send RlModel weight and gradient packets over the network.
+#
+# A packet is a dictionary mapping names (e.g. 'action_model', 'gradients') to lists of arrays,
+# plus scalar entries such as 'epsilon' or 'batch_count'.
+# It can be encoded either as JSON (the original format, with nested lists) or as a compact binary blob:
+#
+#   magic (4 bytes) | header length (uint32, little endian) | JSON header | padding | tensor data
+#
+# The header lists the shape, dtype and offset of every tensor, and the scalar entries.
+# Tensor data is stored contiguously and aligned, so decoding is a zero-copy np.frombuffer per tensor.
+
+BINARY_CONTENT_TYPE = 'application/x-rl-model-packet'
+JSON_CONTENT_TYPE = 'application/json'
+
+_MAGIC = b'RLPK'
+_PREFIX = struct.Struct('<4sI')
+_ALIGNMENT = 64
+
+# Tensors that keep their dtype whatever the wire dtype: the [min, step] of quantized gradients, whose step underflows in float16
+_FULL_PRECISION_TENSORS = ('gradient_ranges',)
+
+def _aligned(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+# True if the value is a list of tensors rather than a scalar entry
+def _is_tensor_list(value):
+    return isinstance(value, (list, tuple)) and len(value) > 0 and (isinstance(value[0], (np.ndarray, list)))
+
+# Encodes a packet as binary.
+# Floating point tensors are converted to wire_dtype (float32 or float16), except those in _FULL_PRECISION_TENSORS.
+# Other tensors, such as the uint8 levels and int32 indices of compressed gradients, keep their dtype.
+def encode_binary(packet, wire_dtype=np.float32):
+    wire_dtype = np.dtype(wire_dtype)
+    if wire_dtype not in (np.dtype(np.float32), np.dtype(np.float16)):
+        raise ValueError('Unsupported wire dtype {0}'.format(wire_dtype))
+
+    header = {'tensors': {}, 'values': {}}
+    buffers = []
+    offset = 0
+    for name, value in packet.items():
+        if not _is_tensor_list(value):
+            header['values'][name] = value
+            continue
+
+        entries = []
+        for tensor in value:
+            tensor = np.asarray(tensor)
+            if tensor.dtype.kind == 'f' and name not in _FULL_PRECISION_TENSORS:
+                tensor = tensor.astype(wire_dtype, copy=False)
+            tensor = np.ascontiguousarray(tensor)
+            offset = _aligned(offset)
+            entries.append({'shape': list(tensor.shape), 'dtype': tensor.dtype.str, 'offset': offset})
+            buffers.append((offset, tensor))
+            offset += tensor.nbytes
+        header['tensors'][name] = entries
+
+    header_bytes = json.dumps(header).encode('utf8')
+    data_start = _aligned(_PREFIX.size + len(header_bytes))
+
+    blob = bytearray(data_start + offset)
+    _PREFIX.pack_into(blob, 0, _MAGIC, len(header_bytes))
+    blob[_PREFIX.size:_PREFIX.size + len(header_bytes)] = header_bytes
+    for tensor_offset, tensor in buffers:
+        start = data_start + tensor_offset
+        blob[start:start + tensor.nbytes] = memoryview(tensor.reshape(-1)).cast('B')
+
+    return bytes(blob)
+
+# Decodes a binary packet.
+# The tensors are read-only views on the supplied buffer, no data is copied.
+def decode_binary(blob):
+    magic, header_length = _PREFIX.unpack_from(blob, 0)
+    if magic != _MAGIC:
+        raise ValueError('Not a binary model packet')
+
+    header = json.loads(bytes(blob[_PREFIX.size:_PREFIX.size + header_length]).decode('utf8'))
+    data_start = _aligned(_PREFIX.size + header_length)
+
+    packet = dict(header['values'])
+    for name, entries in header['tensors'].items():
+        tensors = []
+        for entry in entries:
+            dtype = np.dtype(entry['dtype'])
+            count = int(np.prod(entry['shape'], dtype=np.int64))
+            tensor = np.frombuffer(blob, dtype=dtype, count=count, offset=data_start + entry['offset'])
+            tensors.append(tensor.reshape(entry['shape']))
+        packet[name] = tensors
+
+    return packet
+
+# Converts a packet into something json.dumps can serialize.
+# Numpy arrays are not JSON serializable by default.
+def to_json_compatible(packet):
+    result = {}
+    for name, value in packet.items():
+        if _is_tensor_list(value):
+            result[name] = [np.asarray(w).tolist() for w in value]
+        else:
+            result[name] = value
+    return result
+
+# Encodes a packet as JSON bytes
+def encode_json(packet):
+    return json.dumps(to_json_compatible(packet)).encode('utf8')
+
+# Encodes a packet in the format matching the content type
+def encode(packet, content_type, wire_dtype=np.float32):
+    if content_type == BINARY_CONTENT_TYPE:
+        return encode_binary(packet, wire_dtype)
+    return encode_json(packet)
+
+# Decodes a packet given its content type, falling back on JSON
+def decode(body, content_type):
+    if content_type is not None and content_type.split(';')[0].strip() == BINARY_CONTENT_TYPE:
+        return decode_binary(body)
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode('utf8')
+    return json.loads(body)
+
+# Picks the response content type from an HTTP Accept header.
+# Peers that do not ask for the binary format get JSON.
+def negotiate(accept_header):
+    if accept_header is not None and BINARY_CONTENT_TYPE in accept_header:
+        return BINARY_CONTENT_TYPE
+    return JSON_CONTENT_TYPE
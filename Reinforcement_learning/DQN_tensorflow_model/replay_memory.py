@@ -0,0 +1,290 @@
+import os
+import threading
+import numpy as np
+from sum_tree import SumTree
+
+# A fixed-capacity ring buffer of preallocated arrays holding the agent's experiences.
+# Frames are stored as uint8 (the camera produces 8-bit pixels), so nothing is lost compared to the float64 copies.
+# Appending is O(1): once the buffer is full, the oldest transition is overwritten in place.
+# Each transition also has a sampling priority kept in a sum-tree, so prioritized sampling is O(log N) per index.
+# A transition can be added without a predicted reward. It then gets the highest priority seen so far, so it is likely to
+# be sampled, until its priority is computed together with the other pending ones (see pending_indices).
+#
+# Consecutive states share all but one frame, so frames are not stored per state.
+# Every captured frame is written once into a frame ring and receives an id (a running counter).
+# A transition keeps the ids of history_length + 1 frames: the first history_length are the pre-state, the last history_length the post-state.
+# States are rebuilt with a fancy-index gather when a minibatch is sampled.
+#
+# With storage_dir, the arrays are np.memmap files of fixed-size slots in that directory instead of being held in RAM,
+# so the capacity can exceed the memory of the machine and the OS page cache keeps the recently used frames in memory.
+# The sum-tree of priorities always stays in RAM. The files are created anew, the contents of a previous run are not reused.
+#
+# When several vehicles record into the same memory, transitions are not added in the order of their oldest frame,
+# so the eviction in add_frame can miss a few transitions whose frames were overwritten. Those are never sampled.
+class ReplayMemory():
+    def __init__(self, capacity, frame_shape=(59, 255, 3), history_length=4, frame_capacity=None, priority_epsilon=0.01, storage_dir=None):
+        self.__capacity = int(capacity)
+        self.__storage_dir = storage_dir
+        if (self.__storage_dir is not None and not os.path.isdir(self.__storage_dir)):
+            os.makedirs(self.__storage_dir, exist_ok=True)
+        self.__frame_shape = tuple(frame_shape)
+        self.__history_length = int(history_length)
+        self.__priority_epsilon = float(priority_epsilon)
+        self.__priorities = SumTree(self.__capacity)
+        self.__max_priority = 1.0 + self.__priority_epsilon
+        self.__is_pending = np.zeros(self.__capacity, dtype=bool)
+        self.__start = 0
+        self.__count = 0
+
+        # Every epoch stores a few frames that are only part of a pre-state (the initial state buffer).
+        # Leave some headroom so that a full replay memory does not have to evict transitions for lack of frames.
+        if frame_capacity is None:
+            frame_capacity = self.__capacity + max(self.__capacity // 8, 8 * self.__history_length)
+        self.__frame_capacity = int(frame_capacity)
+        self.__frame_total = 0
+        # Held while a frame is written, so that a snapshot copying the frames on another thread never sees half a frame
+        self.__frames_lock = threading.Lock()
+        self.__frames = self.__allocate('frames', (self.__frame_capacity,) + self.__frame_shape, np.uint8)
+
+        self.__frame_ids = self.__allocate('frame_ids', (self.__capacity, self.__history_length + 1), np.int64)
+        self.__actions = self.__allocate('actions', (self.__capacity,), np.int8)
+        self.__rewards = self.__allocate('rewards', (self.__capacity,), np.float32)
+        self.__predicted_rewards = self.__allocate('predicted_rewards', (self.__capacity,), np.float32)
+        self.__is_not_terminal = self.__allocate('is_not_terminal', (self.__capacity,), np.float32)
+
+    # A zero-filled array, in RAM or in a memory-mapped file of storage_dir
+    def __allocate(self, name, shape, dtype):
+        if self.__storage_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.__storage_dir, name + '.dat'), dtype=dtype, mode='w+', shape=shape)
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def history_length(self):
+        return self.__history_length
+
+    @property
+    def storage_dir(self):
+        return self.__storage_dir
+
+    @property
+    def frame_capacity(self):
+        return self.__frame_capacity
+
+    # Writes the dirty pages of a memory-mapped replay memory back to its files. Does nothing in RAM.
+    def flush(self):
+        if self.__storage_dir is None:
+            return
+        for array in [self.__frames, self.__frame_ids, self.__actions, self.__rewards, self.__predicted_rewards, self.__is_not_terminal]:
+            array.flush()
+
+    # True once the memory cannot grow any more, either because every transition slot is used
+    # or because the frame ring has wrapped around and old transitions are being evicted.
+    def is_full(self):
+        return self.__count >= self.__capacity or self.__frame_total > self.__frame_capacity
+
+    # Stores a captured frame and returns its id.
+    # The transitions that reference the frame being overwritten are evicted first.
+    def add_frame(self, frame):
+        with self.__frames_lock:
+            frame_id = self.__frame_total
+            self.__frames[frame_id % self.__frame_capacity] = frame
+            self.__frame_total += 1
+
+        self.__evict_overwritten()
+        return frame_id
+
+    # Evicts the oldest transitions while their first frame has been overwritten
+    def __evict_overwritten(self):
+        oldest_live_frame = self.__frame_total - self.__frame_capacity
+        while self.__count > 0 and self.__frame_ids[self.__start, 0] < oldest_live_frame:
+            self.__priorities.update(self.__start, 0)
+            self.__is_pending[self.__start] = False
+            self.__start = (self.__start + 1) % self.__capacity
+            self.__count -= 1
+
+    # Returns the frames with the given ids, stacked along the first axis
+    def get_frames(self, frame_ids):
+        return self.__frames[np.asarray(frame_ids, dtype=np.int64) % self.__frame_capacity]
+
+    # Appends a single transition, overwriting the oldest one if the buffer is full, and returns its index.
+    # frame_ids holds the ids returned by add_frame for the pre-state frames followed by the newly observed frame.
+    # Without a predicted_reward, the transition's priority is provisional until update_priorities sets it.
+    def add(self, frame_ids, action, reward, predicted_reward=None, is_not_terminal=1):
+        if len(frame_ids) != self.__history_length + 1:
+            raise ValueError('Expected {0} frame ids, got {1}'.format(self.__history_length + 1, len(frame_ids)))
+
+        if self.__count == self.__capacity:
+            self.__start = (self.__start + 1) % self.__capacity
+        else:
+            self.__count += 1
+        pos = (self.__start + self.__count - 1) % self.__capacity
+
+        self.__frame_ids[pos] = frame_ids
+        self.__actions[pos] = action
+        self.__rewards[pos] = reward
+        self.__is_not_terminal[pos] = is_not_terminal
+        if predicted_reward is None:
+            self.__predicted_rewards[pos] = 0
+            self.__is_pending[pos] = True
+            self.__priorities.update(pos, self.__max_priority)
+        else:
+            self.__predicted_rewards[pos] = predicted_reward
+            self.__is_pending[pos] = False
+            self.__priorities.update(pos, self.__surprise_to_priority(abs(float(reward) - float(predicted_reward))))
+        return pos
+
+    # The indices of the transitions added without a predicted reward whose priority hasn't been updated since.
+    # Transitions whose frames have been overwritten are left out, as they can no longer be gathered.
+    def pending_indices(self):
+        indices = np.flatnonzero(self.__is_pending)
+        return indices[self.__frame_ids[indices, 0] >= self.__frame_total - self.__frame_capacity]
+
+    # Flags the most recently added transition as the end of an episode
+    def mark_last_terminal(self):
+        if self.__count == 0:
+            return
+        self.__is_not_terminal[(self.__start + self.__count - 1) % self.__capacity] = 0
+
+    # Draws count transition indices in a single vectorized pass.
+    # If prioritized, indices are drawn in proportion to their surprise factor, otherwise uniformly.
+    # Transitions whose frames have been overwritten are dropped from the sampling and redrawn.
+    # After max_redraws, the draws that are still invalid are made directly among the transitions that can be gathered,
+    # so exactly count indices are returned. Raises IndexError if there are none.
+    def sample_indices(self, count, prioritized, max_redraws=10):
+        if self.__count == 0:
+            raise IndexError('Replay memory is empty')
+        oldest_live_frame = self.__frame_total - self.__frame_capacity
+        indices = self.__draw_indices(count, prioritized)
+
+        for _ in range(0, max_redraws, 1):
+            invalid = self.__frame_ids[indices, 0] < oldest_live_frame
+            if not np.any(invalid):
+                return indices
+            self.__priorities.update(np.unique(indices[invalid]), 0)
+            indices[invalid] = self.__draw_indices(int(np.count_nonzero(invalid)), prioritized)
+
+        invalid = self.__frame_ids[indices, 0] < oldest_live_frame
+        if np.any(invalid):
+            valid = (self.__start + np.arange(self.__count)) % self.__capacity
+            valid = valid[self.__frame_ids[valid, 0] >= oldest_live_frame]
+            if valid.size == 0:
+                raise IndexError('No transition in the replay memory can be gathered')
+            probabilities = None
+            if prioritized:
+                priorities = self.__priorities.get(valid)
+                if np.sum(priorities) > 0:
+                    probabilities = priorities / np.sum(priorities)
+            indices[invalid] = np.random.choice(valid, int(np.count_nonzero(invalid)), p=probabilities)
+        return indices
+
+    def __draw_indices(self, count, prioritized):
+        if prioritized:
+            # The highest slot holding a transition: the last one added, or the end of the buffer once it has wrapped around
+            return self.__priorities.sample(count, min(self.__start + self.__count, self.__capacity) - 1)
+        return (self.__start + np.random.randint(0, self.__count, size=count)) % self.__capacity
+
+    # Sets new surprise factors for the given transitions, e.g. after they have been re-evaluated by the model.
+    # With predicted_rewards, the model's Q values of the transitions' actions are stored as well.
+    def update_priorities(self, indices, surprise, predicted_rewards=None):
+        priorities = self.__surprise_to_priority(np.abs(surprise))
+        self.__priorities.update(indices, priorities)
+        self.__is_pending[indices] = False
+        if (predicted_rewards is not None):
+            self.__predicted_rewards[indices] = predicted_rewards
+        if (np.size(priorities) > 0):
+            self.__max_priority = max(self.__max_priority, float(np.max(priorities)))
+
+    # The surprise factor is the difference between the predicted and the actual Q value.
+    # A small epsilon keeps transitions the model predicted perfectly from never being replayed.
+    def __surprise_to_priority(self, surprise):
+        return surprise + self.__priority_epsilon
+
+    # Returns copies of everything but the frames, for saving a snapshot (see replay_snapshot.py).
+    # Must be called from the thread that adds transitions.
+    def get_state(self):
+        return {
+            'capacity': self.__capacity,
+            'frame_capacity': self.__frame_capacity,
+            'frame_shape': np.array(self.__frame_shape),
+            'history_length': self.__history_length,
+            'start': self.__start,
+            'count': self.__count,
+            'frame_total': self.__frame_total,
+            'frame_ids': np.array(self.__frame_ids),
+            'actions': np.array(self.__actions),
+            'rewards': np.array(self.__rewards),
+            'predicted_rewards': np.array(self.__predicted_rewards),
+            'is_not_terminal': np.array(self.__is_not_terminal),
+            'priorities': self.__priorities.get(np.arange(self.__capacity)),
+            'is_pending': np.array(self.__is_pending),
+            'max_priority': self.__max_priority,
+        }
+
+    # Returns a copy of the frames in slots [start, end) of the frame ring, and the number of frames added so far when they were copied.
+    # This can be called from any thread.
+    def copy_frames(self, start, end):
+        with self.__frames_lock:
+            return np.array(self.__frames[start:end]), self.__frame_total
+
+    # Restores a snapshot: a state returned by get_state, and the frames as (start slot, frames, frame total) chunks from copy_frames.
+    #
+    # The chunks may have been copied while more frames were being added. A slot that was overwritten after get_state holds
+    # a frame newer than any transition, so the frame count is restored to the latest count among the chunks, and the
+    # transitions whose frames may have been overwritten are evicted.
+    def set_state(self, state, frame_chunks):
+        if (int(state['capacity']) != self.__capacity or int(state['frame_capacity']) != self.__frame_capacity
+                or tuple(state['frame_shape']) != self.__frame_shape or int(state['history_length']) != self.__history_length):
+            raise ValueError('The snapshot is of a replay memory with a different capacity or frame shape')
+
+        frame_total = int(state['frame_total'])
+        with self.__frames_lock:
+            for start, frames, chunk_frame_total in frame_chunks:
+                self.__frames[start:start + frames.shape[0]] = frames
+                frame_total = max(frame_total, int(chunk_frame_total))
+            self.__frame_total = frame_total
+
+        self.__start = int(state['start'])
+        self.__count = int(state['count'])
+        self.__frame_ids[:] = state['frame_ids']
+        self.__actions[:] = state['actions']
+        self.__rewards[:] = state['rewards']
+        self.__predicted_rewards[:] = state['predicted_rewards']
+        self.__is_not_terminal[:] = state['is_not_terminal']
+        self.__priorities.update(np.arange(self.__capacity), state['priorities'])
+        # Snapshots saved before priorities could be pending have neither of these
+        if 'is_pending' in state:
+            self.__is_pending[:] = state['is_pending']
+            self.__max_priority = float(state['max_priority'])
+        else:
+            self.__is_pending[:] = False
+        self.__evict_overwritten()
+
+    # Gathers the transitions at the given indices into a dictionary of arrays.
+    # This is the format consumed by RlModel.get_gradient_update_from_batches.
+    # If latest_only, the states only hold their most recent frame, shape (batch,) + frame_shape,
+    # otherwise they are full stacks of shape (batch, history_length) + frame_shape.
+    def gather(self, indices, latest_only=False):
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.__count == 0:
+            raise IndexError('Replay memory is empty')
+
+        frame_slots = self.__frame_ids[indices] % self.__frame_capacity
+        batches = {}
+        if latest_only:
+            batches['pre_states'] = self.__frames[frame_slots[:, -2]]
+            batches['post_states'] = self.__frames[frame_slots[:, -1]]
+        else:
+            batches['pre_states'] = self.__frames[frame_slots[:, :-1]]
+            batches['post_states'] = self.__frames[frame_slots[:, 1:]]
+        batches['actions'] = self.__actions[indices]
+        batches['rewards'] = self.__rewards[indices]
+        batches['predicted_rewards'] = self.__predicted_rewards[indices]
+        batches['is_not_terminal'] = self.__is_not_terminal[indices]
+        return batches
@@ -0,0 +1,121 @@
+import os
+import re
+import shutil
+import threading
+import time
+import numpy as np
+
+_SNAPSHOT_PATTERN = re.compile(r'^snapshot-(\d+)$')
+
+# Saves the replay memory to disk in the background, so that a restarted agent can reload it instead of filling it again.
+#
+# A snapshot is a directory holding state.npz, with everything but the frames, and the frames in compressed chunks of
+# chunk_frames frames each (frames-00000.npz, ...). The small state is copied when save() is called. The frames are copied
+# one chunk at a time on the writer thread while the agent keeps driving, so the agent never waits for more than one chunk.
+# See ReplayMemory.set_state for how frames added during the write are handled.
+#
+# A snapshot is written into a temporary directory, which is renamed when it is complete, and the older snapshots are
+# deleted after that. A crash while writing leaves the previous snapshot in place.
+class ReplaySnapshotWriter():
+    def __init__(self, directory, chunk_frames=256):
+        self.__directory = directory
+        self.__chunk_frames = int(chunk_frames)
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory, exist_ok=True)
+
+        existing = list_snapshots(self.__directory)
+        self.__next_index = existing[-1][0] + 1 if len(existing) > 0 else 0
+        self.__writer_thread = None
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    # True while a snapshot is being written
+    def is_writing(self):
+        return self.__writer_thread is not None and self.__writer_thread.is_alive()
+
+    # Starts writing a snapshot of the replay memory. Must be called from the thread that adds transitions.
+    # Returns False without doing anything if the previous snapshot is still being written.
+    def save(self, replay_memory):
+        if self.is_writing():
+            return False
+
+        state = replay_memory.get_state()
+        index = self.__next_index
+        self.__next_index += 1
+        self.__writer_thread = threading.Thread(target=self.__write, args=(index, replay_memory, state), daemon=True)
+        self.__writer_thread.start()
+        return True
+
+    # Blocks until the snapshot being written, if any, is complete
+    def flush(self):
+        if self.__writer_thread is not None:
+            self.__writer_thread.join()
+
+    def __write(self, index, replay_memory, state):
+        try:
+            start_time = time.time()
+            path = os.path.join(self.__directory, 'snapshot-{0:06d}'.format(index))
+            temp_path = path + '.tmp'
+            if os.path.isdir(temp_path):
+                shutil.rmtree(temp_path)
+            os.makedirs(temp_path)
+
+            # Slots past the number of frames ever added have never held a frame of a transition
+            num_slots = min(int(state['frame_total']), replay_memory.frame_capacity)
+            for chunk, start in enumerate(range(0, num_slots, self.__chunk_frames)):
+                frames, frame_total = replay_memory.copy_frames(start, min(num_slots, start + self.__chunk_frames))
+                with open(os.path.join(temp_path, 'frames-{0:05d}.npz'.format(chunk)), 'wb') as f:
+                    np.savez_compressed(f, start=start, frames=frames, frame_total=frame_total)
+
+            with open(os.path.join(temp_path, 'state.npz'), 'wb') as f:
+                np.savez(f, **state)
+            os.replace(temp_path, path)
+
+            for _, old_path in list_snapshots(self.__directory)[:-1]:
+                shutil.rmtree(old_path, ignore_errors=True)
+
+            print('Saved replay memory snapshot of {0} transitions to {1}: {2:.1f} MB in {3:.1f} s'.format(
+                int(state['count']), path, snapshot_size(path) / 1e6, time.time() - start_time))
+        except Exception as e:
+            print('Failed to save replay memory snapshot {0}. Message is {1}'.format(index, e))
+
+# The complete snapshots in directory as (index, path), oldest first
+def list_snapshots(directory):
+    if not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        match = _SNAPSHOT_PATTERN.match(name)
+        if match is not None:
+            snapshots.append((int(match.group(1)), os.path.join(directory, name)))
+    snapshots.sort()
+    return snapshots
+
+# The size of a snapshot on disk, in bytes
+def snapshot_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+# Loads the latest snapshot in directory into replay_memory, which must have the same capacity and frame shape.
+# Returns False if there is no snapshot to load.
+def load_latest_snapshot(directory, replay_memory):
+    snapshots = list_snapshots(directory)
+    if len(snapshots) == 0:
+        return False
+    path = snapshots[-1][1]
+
+    start_time = time.time()
+    with np.load(os.path.join(path, 'state.npz')) as data:
+        state = {key: data[key] for key in data.files}
+
+    def read_chunks():
+        for name in sorted(os.listdir(path)):
+            if name.startswith('frames-'):
+                with np.load(os.path.join(path, name)) as data:
+                    yield int(data['start']), data['frames'], int(data['frame_total'])
+
+    replay_memory.set_state(state, read_chunks())
+    print('Loaded replay memory snapshot {0} with {1} transitions: {2:.1f} MB in {3:.1f} s'.format(
+        path, len(replay_memory), snapshot_size(path) / 1e6, time.time() - start_time))
+    return True
@@ -3,7 +3,9 @@ import numpy as np
 import json
 import threading
 import os
-import h5py
+from checkpoint_manager import CheckpointManager
+import gradient_compression
+import instrumentation
 
 import tensorflow.compat.v1 as tf
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
@@ -25,8 +27,9 @@ K.set_session(session)
 
 # A wrapper class for the DQN model
 class RlModel():
-    def __init__(self, weights_path, train_conv_layers):
+    def __init__(self, weights_path, train_conv_layers, train_batch_size=32):
         self.__angle_values = [-1, -0.5, 0, 0.5, 1]
+        self.__train_batch_size = int(train_batch_size)
 
         self.__nb_actions = 5
         self.__gamma = 0.99
@@ -56,6 +59,13 @@ class RlModel():
 
         self.__data_dir=""
         self.__experiment_name="local_run"
+
+        # Snapshots of the weights after every training iteration, written in the background with retention.
+        # Created on the first training iteration, so that models that never train don't start a writer thread.
+        self.__weights_checkpoints = None
+
+        # Timers and counters of training and prediction, see instrumentation.py. They do nothing until the agent enables them.
+        self.__instrumentation = instrumentation.default_instrumentation()
         
         # If we are using pretrained weights for the conv layers, load them and verify the first layer.
         if (weights_path is not None and len(weights_path) > 0):
@@ -79,55 +89,147 @@ class RlModel():
         self.__target_context = tf.get_default_graph() #tf.compat.v1.get_default_graph() #tf.get_default_graph()
         self.__model_lock = threading.Lock()
 
-    # A helper function to read in the model from a JSON packet.
-    # This is used both to read the file from disk and from a network packet
-    def from_packet(self, packet):
+        self.__build_train_step()
+        self.__build_predict_step()
+        self.__build_td_error_step()
+
+    # Builds the graph for one DQN training step, so that a minibatch is trained with a single session call.
+    # Given the latest frames of the pre and post states, the actions taken, the rewards and the terminal flags, it
+    # computes the Bellman targets with the target model, the Q values of the taken actions with the action model,
+    # applies one optimizer step and returns the change of every weight of the action model.
+    def __build_train_step(self):
         with self.__action_context.as_default():
-            self.__action_model.set_weights([np.array(w) for w in packet['action_model']])
-            self.__action_context = tf.get_default_graph()
-        if 'target_model' in packet:
-            with self.__target_context.as_default():
-                self.__target_model.set_weights([np.array(w) for w in packet['target_model']])
-                self.__target_context = tf.get_default_graph()
+            pre_states = tf.placeholder(tf.float32, shape=(None, 59, 255, 3), name='train_pre_states')
+            post_states = tf.placeholder(tf.float32, shape=(None, 59, 255, 3), name='train_post_states')
+            actions = tf.placeholder(tf.int32, shape=(None,), name='train_actions')
+            rewards = tf.placeholder(tf.float32, shape=(None,), name='train_rewards')
+            is_not_terminal = tf.placeholder(tf.float32, shape=(None,), name='train_is_not_terminal')
+
+            # Apply the Bellman equation
+            q_futures = self.__target_model(post_states, training=False)
+            q_labels = tf.stop_gradient(rewards + (tf.reduce_max(q_futures, axis=1) * is_not_terminal * self.__gamma))
+
+            # Only the actions that were actually taken have a label.
+            # Fitting predicted labels for the other actions gives zero error there, so the Keras loss is
+            # the squared error of the taken action averaged over all of the outputs, which we reproduce here.
+            q_values = self.__action_model(pre_states, training=True)
+            q_taken = tf.reduce_sum(q_values * tf.one_hot(actions, self.__nb_actions), axis=1)
+            loss = tf.reduce_mean(tf.square(q_labels - q_taken)) / self.__nb_actions
+
+            # Copy the weights before the update so that the deltas can be computed in the same call
+            weights = self.__action_model.weights
+            weights_before = [tf.Variable(tf.zeros(w.shape, dtype=w.dtype), trainable=False) for w in weights]
+            snapshot = tf.group(*[tf.assign(b, w) for b, w in zip(weights_before, weights)])
+
+            # Step the optimizer the model was compiled with, so that this path and Keras fit share the Adam moments
+            optimizer = self.__action_model.optimizer
+            with tf.control_dependencies([snapshot]):
+                train_op = tf.group(*optimizer.get_updates(loss, self.__action_model.trainable_weights))
+            # Read both sides explicitly in the dependency scope: w - b on ref variables would use their cached values,
+            # which the control dependency does not order after the update
+            with tf.control_dependencies([train_op]):
+                deltas = [tf.identity(w) - b.read_value() for w, b in zip(weights, weights_before)]
+
+            session.run(tf.variables_initializer(weights_before + optimizer.variables()))
+            self.__train_step = session.make_callable([loss] + deltas, feed_list=[pre_states, post_states, actions, rewards, is_not_terminal])
+
+    # Builds the graph for predicting the Q values of a few states, bound to a session callable.
+    # This skips the per-call overhead of Keras predict, which dominates for a batch of one. The input is copied into a
+    # preallocated buffer, and the first call, which is much slower than the others, is made here rather than while driving.
+    def __build_predict_step(self):
+        with self.__action_context.as_default():
+            state = tf.placeholder(tf.float32, shape=(None, 59, 255, 3), name='predict_state')
+            q_values = self.__action_model(state, training=False)
+            self.__predict_step = session.make_callable(q_values, feed_list=[state])
 
-    # A helper function to write the model to a JSON packet.
-    # This is used to send the model across the network from the trainer to the agent
+        self.__predict_input = np.zeros((1, 59, 255, 3), dtype=np.float32)
+        self.__predict_step(self.__predict_input)
+
+    # Builds the graph for the TD errors of a batch of transitions, bound to a session callable: the Bellman target
+    # computed with the target model minus the action model's Q value of the action taken. Both models run in inference mode.
+    def __build_td_error_step(self):
+        with self.__action_context.as_default():
+            pre_states = tf.placeholder(tf.float32, shape=(None, 59, 255, 3), name='td_pre_states')
+            post_states = tf.placeholder(tf.float32, shape=(None, 59, 255, 3), name='td_post_states')
+            actions = tf.placeholder(tf.int32, shape=(None,), name='td_actions')
+            rewards = tf.placeholder(tf.float32, shape=(None,), name='td_rewards')
+            is_not_terminal = tf.placeholder(tf.float32, shape=(None,), name='td_is_not_terminal')
+
+            q_futures = self.__target_model(post_states, training=False)
+            q_labels = rewards + (tf.reduce_max(q_futures, axis=1) * is_not_terminal * self.__gamma)
+            q_taken = tf.reduce_sum(self.__action_model(pre_states, training=False) * tf.one_hot(actions, self.__nb_actions), axis=1)
+            self.__td_error_step = session.make_callable([q_taken, q_labels - q_taken], feed_list=[pre_states, post_states, actions, rewards, is_not_terminal])
+
+        self.__td_error_pre_states = np.zeros((0, 59, 255, 3), dtype=np.float32)
+        self.__td_error_post_states = np.zeros((0, 59, 255, 3), dtype=np.float32)
+
+    # A helper function to read in the model from a packet.
+    # This is used both to read the file from disk and from a network packet.
+    # The weights can be nested lists (JSON) or numpy arrays (binary packets, see model_packet.py).
+    # The weights are swapped under the model lock, so a concurrent predict_state never sees a half-updated model.
+    # A delta packet from the trainer only holds the tensors that changed, listed in 'action_model_indices' and 'target_model_indices'.
+    def from_packet(self, packet):
+        with self.__model_lock:
+            with self.__action_context.as_default():
+                self.__action_model.set_weights(self.__merge_weights(self.__action_model, packet, 'action_model'))
+                self.__action_context = tf.get_default_graph()
+            if 'target_model' in packet:
+                with self.__target_context.as_default():
+                    self.__target_model.set_weights(self.__merge_weights(self.__target_model, packet, 'target_model'))
+                    self.__target_context = tf.get_default_graph()
+
+    # Returns the full list of weights for a model after applying the (possibly partial) weights from a packet
+    def __merge_weights(self, model, packet, name):
+        received = [np.asarray(w, dtype=np.float32) for w in packet[name]]
+        if (name + '_indices') not in packet:
+            return received
+        weights = model.get_weights()
+        for i, w in zip(packet[name + '_indices'], received):
+            weights[int(i)] = w
+        return weights
+
+    # A helper function to write the model to a packet of numpy arrays.
+    # This is used to send the model across the network from the trainer to the agent.
+    # Use model_packet.encode_binary or model_packet.to_json_compatible to serialize it.
     def to_packet(self, get_target = True):
         packet = {}
         with self.__action_context.as_default():
-            packet['action_model'] = [w.tolist() for w in self.__action_model.get_weights()]
+            packet['action_model'] = self.__action_model.get_weights()
             self.__action_context = tf.get_default_graph()
         if get_target:
             with self.__target_context.as_default():
-                packet['target_model'] = [w.tolist() for w in self.__target_model.get_weights()]
+                packet['target_model'] = self.__target_model.get_weights()
 
         return packet
 
     # Updates the model with the supplied gradients
     # This is used by the trainer to accept a training iteration update from the agent
+    # The gradients are either a list of tensors or a compressed packet produced by gradient_compression.GradientCompressor
     def update_with_gradient(self, gradients, should_update_critic):
+        if gradient_compression.is_compressed(gradients):
+            gradients = gradient_compression.decompress(gradients)
+
         with self.__action_context.as_default():
             action_weights = self.__action_model.get_weights()
             if (len(action_weights) != len(gradients)):
                 raise ValueError('len of action_weights is {0}, but len gradients is {1}'.format(len(action_weights), len(gradients)))
             
-            print('UDPATE GRADIENT DEBUG START')
-            
-            dx = 0
-            for i in range(0, len(action_weights), 1):
-                action_weights[i] += gradients[i]
-                dx += np.sum(np.sum(np.abs(gradients[i])))
-            print('Moved weights {0}'.format(dx))
-            self.__action_model.set_weights(action_weights)
-            self.__action_context = tf.get_default_graph()
+            with self.__instrumentation.timer('model_apply_gradient_seconds'):
+                dx = 0
+                for i in range(0, len(action_weights), 1):
+                    action_weights[i] += np.asarray(gradients[i], dtype=action_weights[i].dtype)
+                    dx += np.sum(np.sum(np.abs(gradients[i])))
+                print('Moved weights {0}'.format(dx))
+                self.__action_model.set_weights(action_weights)
+                self.__action_context = tf.get_default_graph()
+            self.__instrumentation.count('model_gradients_applied')
 
             if (should_update_critic):
                 with self.__target_context.as_default():
                     print('Updating critic')
                     self.__target_model.set_weights([np.array(w, copy=True) for w in action_weights])
-            
-            print('UPDATE GRADIENT DEBUG END')
-            
+                self.__instrumentation.count('model_critic_updates')
+
     def update_critic(self):
         with self.__target_context.as_default():
             self.__target_model.set_weights([np.array(w, copy=True) for w in self.__action_model.get_weights()])
@@ -135,92 +237,156 @@ class RlModel():
             
     # Given a set of training data, trains the model and determine the gradients.
     # The agent will use this to compute the model updates to send to the trainer
-    def get_gradient_update_from_batches(self, batches):
-        pre_states = np.array(batches['pre_states'])
-        post_states = np.array(batches['post_states'])
-        rewards = np.array(batches['rewards'])
-        actions = list(batches['actions'])
-        is_not_terminal = np.array(batches['is_not_terminal'])
+    # The batches are the arrays gathered from the replay memory, so they are used as-is without copying.
+    # By default every minibatch is trained with the fused train step, use_fused_train_step=False trains with Keras predict and fit instead.
+    def get_gradient_update_from_batches(self, batches, use_fused_train_step=True):
+        pre_states = np.asarray(batches['pre_states'])
+        post_states = np.asarray(batches['post_states'])
+        rewards = np.asarray(batches['rewards'], dtype=np.float32)
+        actions = np.asarray(batches['actions'], dtype=np.int64)
+        is_not_terminal = np.asarray(batches['is_not_terminal'], dtype=np.float32)
         
         # For now, our model only takes a single image in as input. 
-        # Only read in the last image from each set of examples
-        pre_states = pre_states[:, 3, :, :, :]
-        post_states = post_states[:, 3, :, :, :]
-        
-        print('START GET GRADIENT UPDATE DEBUG')
+        # Only read in the last image from each set of examples, unless the replay memory already gathered just that frame
+        if (pre_states.ndim == 5):
+            pre_states = pre_states[:, 3, :, :, :]
+            post_states = post_states[:, 3, :, :, :]
+        pre_states = pre_states.astype(np.float32)
+        post_states = post_states.astype(np.float32)
         
+        with self.__instrumentation.timer('model_train_seconds'):
+            if use_fused_train_step:
+                gradients = self.__train_fused(pre_states, post_states, actions, rewards, is_not_terminal)
+            else:
+                gradients = self.__train_with_fit(pre_states, post_states, actions, rewards, is_not_terminal)
+        self.__instrumentation.count('model_train_examples', pre_states.shape[0])
+
+        dx = 0
+        for i in range(0, len(gradients), 1):
+            dx += np.sum(np.abs(gradients[i]))
+        print('change in weights from training iteration: {0}'.format(dx))
+
+        ##Adding checkpoint for saving weights
+        with self.__action_context.as_default():
+            new_weights = self.__action_model.get_weights()
+        if self.__weights_checkpoints is None:
+            checkpoint_weights = os.path.join(os.path.join(self.__data_dir, 'checkpoint_weight'), self.__experiment_name)
+            self.__weights_checkpoints = CheckpointManager(checkpoint_weights, keep_last=5, keep_every=100)
+        self.__weights_checkpoints.save('{0}'.format(int(time.time())), {'action_model': new_weights})
+
+        # The gradients are returned as numpy arrays, model_packet.py handles serializing them
+        return gradients
+
+    # Trains on the examples in minibatches of train_batch_size with one session call each, and returns the summed weight deltas
+    def __train_fused(self, pre_states, post_states, actions, rewards, is_not_terminal):
+        gradients = None
+        for start in range(0, pre_states.shape[0], self.__train_batch_size):
+            end = start + self.__train_batch_size
+            outputs = self.__train_step(pre_states[start:end], post_states[start:end], actions[start:end], rewards[start:end], is_not_terminal[start:end])
+            if gradients is None:
+                gradients = outputs[1:]
+            else:
+                for i in range(0, len(gradients), 1):
+                    gradients[i] += outputs[i + 1]
+        return gradients
+
+    # Trains on the examples with Keras: predict the labels, predict the targets, then fit
+    def __train_with_fit(self, pre_states, post_states, actions, rewards, is_not_terminal):
         # We only have labels for the action that the agent actually took.
         # To prevent the model from training the other actions, figure out what the model currently predicts for each input.
         # Then, the gradients with respect to those outputs will always be zero.
         with self.__action_context.as_default():
-            labels = self.__action_model.predict([pre_states], batch_size=32)
+            labels = self.__action_model.predict([pre_states], batch_size=self.__train_batch_size)
         
         # Find out what the target model will predict for each post-decision state.
         with self.__target_context.as_default():
-            q_futures = self.__target_model.predict([post_states], batch_size=32)
+            q_futures = self.__target_model.predict([post_states], batch_size=self.__train_batch_size)
 
         # Apply the Bellman equation
         q_futures_max = np.max(q_futures, axis=1)
         q_labels = (q_futures_max * is_not_terminal * self.__gamma) + rewards
         
         # Update the label only for the actions that were actually taken.
-        for i in range(0, len(actions), 1):
-            labels[i][actions[i]] = q_labels[i]
+        labels[np.arange(actions.shape[0]), actions] = q_labels
 
         # Perform a training iteration.
         with self.__action_context.as_default():
             original_weights = [np.array(w, copy=True) for w in self.__action_model.get_weights()]
-            self.__action_model.fit([pre_states], labels, epochs=1, batch_size=32, verbose=1)
+            self.__action_model.fit([pre_states], labels, epochs=1, batch_size=self.__train_batch_size, verbose=1)
             
             # Compute the gradients
             new_weights = self.__action_model.get_weights()
             gradients = []
-            dx = 0
             for i in range(0, len(original_weights), 1):
                 gradients.append(new_weights[i] - original_weights[i])
-                dx += np.sum(np.sum(np.abs(new_weights[i]-original_weights[i])))
-            print('change in weights from training iteration: {0}'.format(dx))
-
-            ##Adding checkpoint for saving weights
-            checkpoint_weights = os.path.join(os.path.join(self.__data_dir, 'checkpoint_weight'), self.__experiment_name)
-                
-            if not os.path.isdir(checkpoint_weights):
-                try:
-                    os.makedirs(checkpoint_weights)
-                except OSError as e:
-                    if e.errno != errno.EEXIST:
-                        raise
-                    
-            try:
-                curr_time = time.time()
-                file_name = os.path.join(checkpoint_weights,'{0}.h5'.format(curr_time))
-                hf = h5py.File(file_name, 'w')
-                hf.create_dataset('weights', data=new_weights)
-            except TypeError:
-                pass
-        
-        print('END GET GRADIENT UPDATE DEBUG')
-
-        # Numpy arrays are not JSON serializable by default
-        return [w.tolist() for w in gradients]
+        return gradients
 
     # Performs a state prediction given the model input
-    def predict_state(self, observation):
-        if (type(observation) == type([])):
-            observation = np.array(observation)
-        
+    # By default the prediction runs through the predict step, use_predict_step=False predicts with Keras instead.
+    def predict_state(self, observation, use_predict_step=True):
         # Our model only predicts on a single state.
-        # Take the latest image
-        observation = observation[3, :, :, :]
+        # Take the latest image. Frames are kept as uint8 until they are fed to the model.
+        observation = np.asarray(observation[3])
+        if use_predict_step:
+            predicted_states, predicted_rewards = self.predict_states([observation])
+            return (predicted_states[0], predicted_rewards[0])
+
         # 32 used to be 59
-        observation = observation.reshape(1,59,255,3)
-        with self.__action_context.as_default():
-            predicted_qs = self.__action_model.predict([observation])
+        observation = observation.reshape(1,59,255,3).astype(np.float32)
+        with self.__model_lock:
+            with self.__action_context.as_default():
+                predicted_qs = self.__action_model.predict([observation])
 
         # Select the action with the highest Q value
         predicted_state = np.argmax(predicted_qs)
         return (predicted_state, predicted_qs[0][predicted_state])
 
+    # Predicts the states of several inputs with one call of the predict step, e.g. one per vehicle.
+    # Each input is the latest frame of a state. Returns the selected states and their Q values, as arrays.
+    def predict_states(self, frames):
+        count = len(frames)
+        self.__instrumentation.count('model_predictions', count)
+        with self.__instrumentation.timer('model_predict_seconds'), self.__model_lock:
+            if (self.__predict_input.shape[0] < count):
+                self.__predict_input = np.zeros((count, 59, 255, 3), dtype=np.float32)
+
+            # The frames are converted to float32 as they are copied into the input buffer
+            for i in range(0, count, 1):
+                np.copyto(self.__predict_input[i], np.asarray(frames[i]).reshape(59,255,3))
+            predicted_qs = self.__predict_step(self.__predict_input[:count])
+
+        # Select the action with the highest Q value
+        predicted_states = np.argmax(predicted_qs, axis=1)
+        return (predicted_states, predicted_qs[np.arange(count), predicted_states])
+
+    # Computes the Q values of the actions taken and the TD errors of a set of transitions gathered from the replay memory
+    # (latest frame only), in forward passes of up to batch_size transitions. Returns both as float32 arrays.
+    # The agent uses this to compute the priorities of new transitions all at once instead of one per step.
+    def compute_td_errors(self, batches, batch_size=256):
+        pre_states = np.asarray(batches['pre_states'])
+        post_states = np.asarray(batches['post_states'])
+        actions = np.asarray(batches['actions'], dtype=np.int32)
+        rewards = np.asarray(batches['rewards'], dtype=np.float32)
+        is_not_terminal = np.asarray(batches['is_not_terminal'], dtype=np.float32)
+        count = pre_states.shape[0]
+
+        q_taken = np.zeros(count, dtype=np.float32)
+        td_errors = np.zeros(count, dtype=np.float32)
+        with self.__instrumentation.timer('model_td_error_seconds'), self.__model_lock:
+            if (self.__td_error_pre_states.shape[0] < min(count, batch_size)):
+                self.__td_error_pre_states = np.zeros((min(count, batch_size), 59, 255, 3), dtype=np.float32)
+                self.__td_error_post_states = np.zeros((min(count, batch_size), 59, 255, 3), dtype=np.float32)
+
+            # The frames are converted to float32 as they are copied into the input buffers
+            for start in range(0, count, batch_size):
+                end = min(count, start + batch_size)
+                np.copyto(self.__td_error_pre_states[:end - start], pre_states[start:end])
+                np.copyto(self.__td_error_post_states[:end - start], post_states[start:end])
+                q_taken[start:end], td_errors[start:end] = self.__td_error_step(self.__td_error_pre_states[:end - start], self.__td_error_post_states[:end - start],
+                                                                                 actions[start:end], rewards[start:end], is_not_terminal[start:end])
+        self.__instrumentation.count('model_td_errors', count)
+        return (q_taken, td_errors)
+
     # Convert the current state to control signals to drive the car.
     # As we are only predicting steering angle, we will use a simple controller to keep the car at a constant speed
     def state_to_control_signals(self, state, car_state):
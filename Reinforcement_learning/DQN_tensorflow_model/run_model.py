@@ -1,4 +1,6 @@
 from rl_model import RlModel
+from checkpoint_manager import load_checkpoint
+from camera_frames import decode_scene_image
 import numpy as np
 import time
 import sys
@@ -8,20 +10,22 @@ import PIL.ImageFilter
 import datetime
 import airsim
 
-MODEL_FILENAME = 'sample_model.json'
+# The checkpoint to run can be given on the command line
+MODEL_FILENAME = sys.argv[1] if len(sys.argv) > 1 else 'sample_model.json'
 weights_path = 'model_weights.h5'
 #model = RlModel(None, False)
 model = RlModel(weights_path, True)
-with open(MODEL_FILENAME, 'r') as f:
-    checkpoint_data = json.loads(f.read())
-    model.from_packet(checkpoint_data['model'])
+# Checkpoints written by the agent are .npz files, older ones are JSON
+if MODEL_FILENAME.endswith('.npz'):
+    model.from_packet(load_checkpoint(MODEL_FILENAME))
+else:
+    with open(MODEL_FILENAME, 'r') as f:
+        checkpoint_data = json.loads(f.read())
+        model.from_packet(checkpoint_data['model'])
 
 def get_image(car_client):
     image_response = car_client.simGetImages([ImageRequest("0", AirSimImageType.Scene, False, False)])[0]
-    image1d = np.fromstring(image_response.image_data_uint8, dtype=np.uint8)
-    image_rgba = image1d.reshape(108,256,4)
-    image_resized = image_rgba[49:108,0:255,0:3].astype(float)
-    return image_resized
+    return decode_scene_image(image_response)
 
 
 def append_to_ring_buffer(item, buffer, buffer_size):
@@ -0,0 +1,84 @@
+import numpy as np
+
+# A binary sum-tree over a fixed number of non-negative priorities.
+# Each internal node holds the sum of its two children, so the root is the total priority.
+# Updating priorities and drawing proportional samples are both O(log N), and both are vectorized over many indices at once.
+class SumTree():
+    def __init__(self, capacity):
+        self.__capacity = int(capacity)
+
+        # Round the number of leaves up to a power of two so that every leaf sits at the same depth
+        self.__depth = max(1, int(np.ceil(np.log2(max(self.__capacity, 1)))))
+        self.__num_leaves = 1 << self.__depth
+        self.__tree = np.zeros(2 * self.__num_leaves, dtype=np.float64)
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    # The sum of all of the priorities
+    def total(self):
+        return self.__tree[1]
+
+    # The priorities currently stored at the given leaf indices
+    def get(self, indices):
+        return self.__tree[np.asarray(indices, dtype=np.int64) + self.__num_leaves]
+
+    # Sets the priorities of the given leaf indices and propagates the new sums up to the root.
+    # If an index appears more than once, the last priority wins.
+    def update(self, indices, priorities):
+        indices = np.atleast_1d(np.asarray(indices, dtype=np.int64))
+        priorities = np.broadcast_to(np.asarray(priorities, dtype=np.float64), indices.shape)
+        if np.any(priorities < 0):
+            raise ValueError('Priorities must be non-negative')
+
+        # A single index, as when a transition is added, is cheaper to walk up with scalars
+        if indices.shape[0] == 1:
+            tree = self.__tree
+            node = int(indices[0]) + self.__num_leaves
+            tree[node] = priorities[0]
+            for _ in range(0, self.__depth, 1):
+                node >>= 1
+                tree[node] = tree[2 * node] + tree[2 * node + 1]
+            return
+
+        nodes = indices + self.__num_leaves
+        self.__tree[nodes] = priorities
+
+        # Walk up one level at a time, recomputing each touched parent from its two children
+        for _ in range(0, self.__depth, 1):
+            nodes = np.unique(nodes >> 1)
+            self.__tree[nodes] = self.__tree[2 * nodes] + self.__tree[2 * nodes + 1]
+
+    # Draws count leaf indices with probability proportional to their priority.
+    # The draws are stratified: the total is split into count equal segments and one value is drawn in each,
+    # which lowers the variance compared to independent draws.
+    # The strata come out in index order, so the result is shuffled before it is split into minibatches.
+    # last_index is the highest leaf that holds data, capacity - 1 by default.
+    def sample(self, count, last_index=None):
+        total = self.total()
+        if total <= 0:
+            raise ValueError('Cannot sample from a sum-tree with zero total priority')
+
+        segment = total / count
+        values = (np.arange(count) + np.random.random_sample(count)) * segment
+        values = np.minimum(values, np.nextafter(total, 0))
+
+        # Descend from the root, going right whenever the value exceeds the left subtree's sum
+        nodes = np.ones(count, dtype=np.int64)
+        for _ in range(0, self.__depth, 1):
+            left = 2 * nodes
+            left_sums = self.__tree[left]
+            go_right = values >= left_sums
+            values = values - (left_sums * go_right)
+            nodes = left + go_right
+
+        leaves = nodes - self.__num_leaves
+
+        # Floating point error can land a draw on an empty leaf past the end of the data.
+        # Clamp those onto the last leaf that holds data.
+        if last_index is None:
+            last_index = self.__capacity - 1
+        leaves = np.minimum(leaves, last_index)
+        np.random.shuffle(leaves)
+        return leaves
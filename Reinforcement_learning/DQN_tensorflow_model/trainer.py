@@ -0,0 +1,264 @@
+from rl_model import RlModel
+import model_packet
+import gradient_compression
+import numpy as np
+import threading
+import datetime
+import socket
+import time
+import json
+import sys
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# The parameter server that the distributed agents train against.
+# Every agent posts the weight deltas of its training iterations to /gradient_update and gets the latest model back.
+# Deltas that arrive while another update is being applied are summed and applied together, so a busy trainer does one
+# set_weights for many agents instead of one per agent.
+class ParameterServer():
+    def __init__(self, parameters):
+        required_parameters = ['data_dir', 'experiment_name', 'batch_update_frequency']
+        for required_parameter in required_parameters:
+            if required_parameter not in parameters:
+                raise ValueError('Missing required parameter {0}'.format(required_parameter))
+
+        print('Starting time: {0}'.format(datetime.datetime.utcnow()), file=sys.stderr)
+        self.__data_dir = parameters['data_dir']
+        self.__experiment_name = parameters['experiment_name']
+        self.__batch_update_frequency = int(parameters['batch_update_frequency'])
+
+        if 'train_conv_layers' in parameters:
+            train_conv_layers = bool((parameters['train_conv_layers'].lower().strip() == 'true'))
+        else:
+            train_conv_layers = False
+
+        if 'weights_path' in parameters:
+            weights_path = parameters['weights_path']
+        else:
+            weights_path = None
+
+        # The trainer owns the exploration schedule and sends epsilon to the agents with every model
+        self.__epsilon = float(parameters['initial_epsilon']) if 'initial_epsilon' in parameters else 1.0
+        self.__min_epsilon = float(parameters['min_epsilon']) if 'min_epsilon' in parameters else 0.1
+        self.__per_iter_epsilon_reduction = float(parameters['per_iter_epsilon_reduction']) if 'per_iter_epsilon_reduction' in parameters else 0.003
+
+        self.__model = RlModel(weights_path, train_conv_layers)
+        self.__model_lock = threading.Lock()
+        self.__version = 0
+
+        # The model version at which each tensor last changed, so agents can pull only what changed since their version.
+        # Frozen conv layers never change, and the target model only changes on critic updates.
+        num_tensors = len(self.__model.to_packet(get_target=False)['action_model'])
+        self.__tensor_versions = {'action_model': [0] * num_tensors, 'target_model': [0] * num_tensors}
+        self.__num_batches_run = 0
+        self.__last_critic_update_batch_count = 0
+
+        # Updates waiting to be applied by whichever request thread holds the model lock next
+        self.__pending_updates = []
+        self.__pending_lock = threading.Lock()
+
+        # The encoded model is cached per version and base version, so many agents polling the same version cost one encode.
+        # Responses are always encoded as float32 whatever wire_dtype the agents send their deltas in, so the cache is not keyed by dtype.
+        self.__encoded_model_cache = {}
+
+        # Throughput statistics
+        self.__start_time = time.time()
+        self.__num_updates_received = 0
+        self.__num_updates_applied = 0
+
+    @property
+    def version(self):
+        return self.__version
+
+    # Returns the latest model packet, encoded for the given content type.
+    # If the agent has base_version, only the tensors that changed since then are included.
+    # Returns None if base_version is the latest version.
+    def get_latest(self, content_type, base_version=None):
+        with self.__model_lock:
+            if (base_version is not None and base_version == self.__version):
+                return None
+            return self.__encode_latest(content_type, base_version)
+
+    # Queues an update from an agent, applies every queued update and returns the new model encoded for the given content type.
+    # The agent sends its model version along with the update, and gets back the tensors that changed since then.
+    def apply_update(self, packet, content_type):
+        base_version = int(packet['model_version']) if 'model_version' in packet else None
+        if gradient_compression.is_compressed(packet):
+            gradients = gradient_compression.decompress(packet)
+        else:
+            gradients = [np.asarray(g, dtype=np.float32) for g in packet['gradients']]
+        batch_count = int(packet['batch_count']) if 'batch_count' in packet else 1
+
+        with self.__pending_lock:
+            self.__pending_updates.append((gradients, batch_count))
+            self.__num_updates_received += 1
+
+        with self.__model_lock:
+            with self.__pending_lock:
+                pending_updates = self.__pending_updates
+                self.__pending_updates = []
+
+            # Another thread may already have applied our update along with its own
+            if len(pending_updates) > 0:
+                self.__apply_pending_updates(pending_updates)
+
+            return self.__encode_latest(content_type, base_version)
+
+    # Sums the pending deltas, applies them in one step and decides whether the critic should be updated
+    def __apply_pending_updates(self, pending_updates):
+        summed_gradients = [np.array(g, copy=True) for g in pending_updates[0][0]]
+        batch_count = pending_updates[0][1]
+        for gradients, update_batch_count in pending_updates[1:]:
+            for i in range(0, len(summed_gradients), 1):
+                summed_gradients[i] += gradients[i]
+            batch_count += update_batch_count
+
+        self.__num_batches_run += batch_count
+        should_update_critic = (self.__num_batches_run > self.__batch_update_frequency + self.__last_critic_update_batch_count)
+        if should_update_critic:
+            self.__last_critic_update_batch_count = self.__num_batches_run
+
+        self.__model.update_with_gradient(summed_gradients, should_update_critic)
+        self.__version += 1
+        self.__encoded_model_cache = {}
+
+        for i in range(0, len(summed_gradients), 1):
+            if np.any(summed_gradients[i]):
+                self.__tensor_versions['action_model'][i] = self.__version
+        if should_update_critic:
+            self.__tensor_versions['target_model'] = [self.__version] * len(summed_gradients)
+
+        self.__epsilon = max(self.__min_epsilon, self.__epsilon - (self.__per_iter_epsilon_reduction * len(pending_updates)))
+        self.__num_updates_applied += 1
+
+        if (self.__version % 100 == 0):
+            print(self.stats_line())
+
+    # Must be called with the model lock held
+    def __encode_latest(self, content_type, base_version=None):
+        # An agent that is ahead of us has talked to a previous trainer process, send it everything
+        if (base_version is not None and base_version > self.__version):
+            base_version = None
+
+        cache_key = (content_type, base_version)
+        if cache_key not in self.__encoded_model_cache:
+            packet = self.__model.to_packet(get_target=True)
+            if base_version is not None:
+                for name in ['action_model', 'target_model']:
+                    changed = [i for i, v in enumerate(self.__tensor_versions[name]) if v > base_version]
+                    packet[name] = [packet[name][i] for i in changed]
+                    packet[name + '_indices'] = changed
+            packet['epsilon'] = self.__epsilon
+            packet['version'] = self.__version
+            self.__encoded_model_cache[cache_key] = model_packet.encode(packet, content_type)
+        return self.__encoded_model_cache[cache_key]
+
+    # A one line summary of the aggregate update throughput
+    def stats_line(self):
+        elapsed = max(time.time() - self.__start_time, 1e-9)
+        return 'version {0}: {1} updates received ({2:.2f}/s), {3} applied, {4} batches, epsilon {5:.3f}'.format(
+            self.__version, self.__num_updates_received, self.__num_updates_received / elapsed,
+            self.__num_updates_applied, self.__num_batches_run, self.__epsilon)
+
+    # Writes the address of this trainer where the agents look for it: (data_dir)/trainer_ip/(experiment_name)/trainer_ip.txt
+    # The file is written to a temporary name first so that an agent never reads a partial address.
+    def write_ip_file(self, ip_address):
+        trainer_ip_dir = os.path.join(os.path.join(self.__data_dir, 'trainer_ip'), self.__experiment_name)
+        if not os.path.isdir(trainer_ip_dir):
+            os.makedirs(trainer_ip_dir, exist_ok=True)
+
+        file_name = os.path.join(trainer_ip_dir, 'trainer_ip.txt')
+        with open(file_name + '.tmp', 'w') as f:
+            f.write(ip_address)
+        os.replace(file_name + '.tmp', file_name)
+        print('Wrote trainer address {0} to {1}'.format(ip_address, file_name))
+
+# Serves /ping, /latest and /gradient_update for a ParameterServer.
+# Each request is handled on its own thread.
+class TrainerRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests from the same agent
+    protocol_version = 'HTTP/1.1'
+    parameter_server = None
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/ping':
+            self.__send(200, model_packet.JSON_CONTENT_TYPE, json.dumps({'message': 'pong'}).encode('utf8'))
+        elif path == '/latest':
+            content_type = model_packet.negotiate(self.headers.get('Accept'))
+            query = parse_qs(urlparse(self.path).query)
+            base_version = int(query['version'][0]) if 'version' in query else None
+            body = self.parameter_server.get_latest(content_type, base_version)
+            if body is None:
+                self.__send(304, content_type, b'')
+            else:
+                self.__send(200, content_type, body)
+        else:
+            self.__send(404, model_packet.JSON_CONTENT_TYPE, json.dumps({'message': 'not found'}).encode('utf8'))
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path != '/gradient_update':
+            self.__send(404, model_packet.JSON_CONTENT_TYPE, json.dumps({'message': 'not found'}).encode('utf8'))
+            return
+
+        request_content_type = self.headers.get('Content-Type', model_packet.JSON_CONTENT_TYPE).split(';')[0].strip()
+        if request_content_type not in (model_packet.BINARY_CONTENT_TYPE, model_packet.JSON_CONTENT_TYPE):
+            self.__send(415, model_packet.JSON_CONTENT_TYPE, json.dumps({'message': 'unsupported content type'}).encode('utf8'))
+            return
+
+        packet = model_packet.decode(body, request_content_type)
+        content_type = model_packet.negotiate(self.headers.get('Accept'))
+        self.__send(200, content_type, self.parameter_server.apply_update(packet, content_type))
+
+    def __send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The default handler logs every request to stderr, which is too noisy with many agents
+    def log_message(self, format, *args):
+        pass
+
+# Returns the address of this machine that other machines can reach
+def get_ip_address():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(('10.255.255.255', 1))
+        return s.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+    finally:
+        s.close()
+
+if __name__ == '__main__':
+    # Parse the command line parameters
+    parameters = {}
+    for arg in sys.argv:
+        if '=' in arg:
+            args = arg.split('=')
+            print('0: {0}, 1: {1}'.format(args[0], args[1]))
+            parameters[args[0].replace('--', '')] = args[1]
+
+    print('------------STARTING TRAINER----------------')
+    print(parameters)
+
+    port = int(parameters['port']) if 'port' in parameters else 80
+    ip_address = parameters['ip_address'] if 'ip_address' in parameters else get_ip_address()
+
+    parameter_server = ParameterServer(parameters)
+    TrainerRequestHandler.parameter_server = parameter_server
+    server = ThreadingHTTPServer(('0.0.0.0', port), TrainerRequestHandler)
+    server.daemon_threads = True
+
+    parameter_server.write_ip_file(ip_address)
+    print('Trainer listening on {0}:{1}'.format(ip_address, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(parameter_server.stats_line())
+        server.server_close()
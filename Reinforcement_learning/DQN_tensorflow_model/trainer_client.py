@@ -0,0 +1,146 @@
+import random
+import time
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+import model_packet
+
+# Returns how long to wait before retry number attempt (starting at 0).
+# The delay grows exponentially up to cap, and is drawn uniformly below that bound ("full jitter"),
+# so that many agents retrying against the same trainer do not all come back at the same time.
+def backoff_delay(attempt, base_delay=0.5, max_delay=30.0):
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+# True if a request failed before reaching the trainer (connect timeout or connection refused), so sending it again cannot
+# have it processed twice
+def failed_to_connect(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if len(error.args) > 0 else None
+    return isinstance(reason, NewConnectionError)
+
+# The agent's connection to the trainer.
+# All calls go through one requests session, so connections to the trainer are kept alive and reused.
+# The client also remembers which model version it has, so the trainer only sends the tensors that changed since then.
+class TrainerClient():
+    def __init__(self, port=80, wire_dtype=np.float32, pool_size=4, max_retries=8):
+        self.__port = port
+        self.__wire_dtype = np.dtype(wire_dtype)
+        self.__max_retries = max_retries
+        self.__address = None
+        self.__model_version = None
+
+        # If the trainer turns out to only understand JSON, we switch to JSON for the rest of the run.
+        self.__use_binary_packets = True
+
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session.mount('http://', adapter)
+
+    @property
+    def address(self):
+        return self.__address
+
+    @property
+    def model_version(self):
+        return self.__model_version
+
+    # Pings the trainer at each of the possible addresses in turn until one of them answers.
+    def connect(self, possible_addresses):
+        attempt = 0
+        while True:
+            for address in possible_addresses:
+                try:
+                    print('\tPinging {0}...'.format(address))
+                    response = self.__session.get(self.__url(address, 'ping'), timeout=10).json()
+                    if response['message'] != 'pong':
+                        raise ValueError('Received unexpected message: {0}'.format(response))
+                    print('Success!')
+                    self.__address = address
+                    return address
+                except Exception as e:
+                    print('Could not get response. Message is {0}'.format(e))
+
+            delay = backoff_delay(attempt)
+            print('Waiting {0:.1f} seconds and trying again...'.format(delay))
+            time.sleep(delay)
+            attempt += 1
+
+    # Gets the model from the trainer.
+    # Returns None if we already have the latest version, otherwise a packet that may only contain the changed tensors.
+    def get_latest(self):
+        params = {}
+        if self.__model_version is not None:
+            params['version'] = self.__model_version
+
+        response = self.__request('get', 'latest', True, params=params, headers={'Accept': self.__accept_header()})
+        if response.status_code == 304:
+            return None
+        return self.__read_model(response)
+
+    # Posts a packet to the trainer and returns the model packet it sends back.
+    # A trainer that does not understand binary packets answers 415, in which case the packet is resent as JSON.
+    # The trainer applies every update it receives, so the post is only retried if it never reached the trainer.
+    def post_packet(self, endpoint, packet):
+        packet = dict(packet)
+        if self.__model_version is not None:
+            packet['model_version'] = self.__model_version
+
+        while True:
+            if self.__use_binary_packets:
+                content_type = model_packet.BINARY_CONTENT_TYPE
+            else:
+                content_type = model_packet.JSON_CONTENT_TYPE
+
+            encode_start = time.time()
+            body = model_packet.encode(packet, content_type, self.__wire_dtype)
+            print('Sending {0} bytes to /{1} (encoded in {2:.1f} ms)'.format(len(body), endpoint, 1000 * (time.time() - encode_start)))
+
+            response = self.__request('post', endpoint, False, data=body, headers={'Content-Type': content_type, 'Accept': self.__accept_header()})
+            if (response.status_code == 415 and self.__use_binary_packets):
+                print('Trainer does not accept binary packets. Falling back to JSON.')
+                self.__use_binary_packets = False
+                continue
+
+            return self.__read_model(response)
+
+    # Decodes a model packet and remembers its version
+    def __read_model(self, response):
+        packet = model_packet.decode(response.content, response.headers.get('Content-Type'))
+        if 'version' in packet:
+            self.__model_version = packet['version']
+        return packet
+
+    # The packet formats we are willing to receive from the trainer, preferring binary
+    def __accept_header(self):
+        if self.__use_binary_packets:
+            return '{0}, {1};q=0.5'.format(model_packet.BINARY_CONTENT_TYPE, model_packet.JSON_CONTENT_TYPE)
+        return model_packet.JSON_CONTENT_TYPE
+
+    def __url(self, address, endpoint):
+        return 'http://{0}:{1}/{2}'.format(address, self.__port, endpoint)
+
+    # Sends a request to the trainer, retrying with jittered exponential backoff.
+    # Idempotent requests are retried on connection errors, timeouts and server errors, others only if they failed to connect.
+    def __request(self, method, endpoint, idempotent, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                response = self.__session.request(method, self.__url(self.__address, endpoint), timeout=60, **kwargs)
+                if response.status_code < 500:
+                    return response
+                if not idempotent:
+                    raise IOError('Request to /{0} failed with status {1}'.format(endpoint, response.status_code))
+                message = 'status {0}'.format(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not (idempotent or failed_to_connect(e)):
+                    raise IOError('Request to /{0} failed and may have reached the trainer: {1}'.format(endpoint, e))
+                message = str(e)
+
+            if attempt >= self.__max_retries:
+                raise IOError('Request to /{0} failed after {1} attempts: {2}'.format(endpoint, attempt + 1, message))
+            delay = backoff_delay(attempt)
+            print('Request to /{0} failed ({1}). Retrying in {2:.1f} seconds...'.format(endpoint, message, delay))
+            time.sleep(delay)
+            attempt += 1